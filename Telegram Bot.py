@@ -1,338 +1,185 @@
 import telebot
-import requests
 import os
 from dotenv import load_dotenv
-from database import (init_db, save_to_diary, get_diary_entries, get_dates_with_entries,
+from database import (init_db, save_to_diary, save_meal_to_diary, get_diary_entries, get_month_days,
                       get_daily_summary, get_today_summary, delete_diary_entry,
-                      translate_to_ru, translate_to_en)
-from datetime import datetime, timedelta
-import calendar
+                      translate_to_ru, translate_to_en, get_translation_cache_stats, close_connections)
+from datetime import datetime
+import signal
+import sys
+import tempfile
+import http_client
+import metrics
+from keyboards import (create_main_keyboard, create_food_suggestions_keyboard, generate_calendar,
+                       create_uncertain_photo_keyboard, create_retry_keyboard, create_save_keyboard,
+                       create_save_meal_keyboard, create_day_entries_keyboard)
+from logmeal import analyze_photo_with_logmeal, select_meal_items
+from imaging import choose_photo_size, prepare_image, dhash
+from nutrition import (get_nutritionix_data, get_nutritionix_batch, calculate_nutrition,
+                       get_nutrition_cache_stats, warm_nutrition_cache)
+from recipes import (generate_recipes_with_together, stream_recipes_with_together, check_recipes_format,
+                     EditThrottle, RECIPE_STREAMING, recipe_cache_key, get_cached_recipes, cache_recipes,
+                     schedule_recipe_variant, get_recipe_cache_stats)
+from pipeline import Pipeline, Done
+from cache import RecognitionCache
+from sessions import create_session_store
+from fuzzy import get_food_name_index
+from export import write_export, export_filename
+import dialog
 
 # --- Конфигурация --- #
 load_dotenv()
 bot = telebot.TeleBot(os.getenv('TELEGRAM_BOT_TOKEN'))
 
-# API Keys
-LOGMEAL_API_KEY = os.getenv('LOGMEAL_API_KEY')
-LOGMEAL_ENDPOINT = "https://api.logmeal.com/v2/image/segmentation/complete"
-LOGMEAL_HEADERS = {'Authorization': 'Bearer ' + LOGMEAL_API_KEY}
-
-NUTRITIONIX_APP_ID = os.getenv('NUTRITIONIX_APP_ID')
-NUTRITIONIX_APP_KEY = os.getenv('NUTRITIONIX_APP_KEY')
-NUTRITIONIX_ENDPOINT = "https://trackapi.nutritionix.com/v2/natural/nutrients"
-
-TOGETHER_API_KEY = os.getenv('TOGETHER_API_KEY')
-TOGETHER_API_ENDPOINT = "https://api.together.xyz/v1/completions"
-TOGETHER_MODEL = "deepseek-ai/deepseek-v3"
-
-# Глобальный словарь для временных данных
-user_food_data = {}
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip('/') + "/file/bot{0}/{1}"
+
+# Ожидающие шаги диалога (register_next_step_handler) сохраняются в файл и переживают
+# перезапуск процесса; supervisor.py задает каждому шарду свой файл
+NEXT_STEP_SAVE_FILE = os.getenv('NEXT_STEP_SAVE_FILE')
+if NEXT_STEP_SAVE_FILE:
+    bot.enable_save_next_step_handlers(delay=1, filename=NEXT_STEP_SAVE_FILE)
+
+# Конвейер распознавания фото: потоки на каждую стадию и размер очередей
+PHOTO_DOWNLOAD_WORKERS = int(os.getenv('PHOTO_DOWNLOAD_WORKERS', 4))
+PHOTO_PREPARE_WORKERS = int(os.getenv('PHOTO_PREPARE_WORKERS', 2))
+PHOTO_RECOGNITION_WORKERS = int(os.getenv('PHOTO_RECOGNITION_WORKERS', 2))
+PHOTO_NUTRITION_WORKERS = int(os.getenv('PHOTO_NUTRITION_WORKERS', 4))
+PHOTO_QUEUE_SIZE = int(os.getenv('PHOTO_QUEUE_SIZE', 8))
+PHOTO_PER_USER_LIMIT = int(os.getenv('PHOTO_PER_USER_LIMIT', 1))
+
+# Длительность long polling getUpdates: после SIGTERM бот ждет завершения текущего запроса,
+# поэтому значение должно быть меньше времени, которое дается процессу на остановку
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 5))
+
+# Сколько вариантов предлагать, если название введено с ошибкой
+FOOD_SUGGESTIONS = int(os.getenv('FOOD_SUGGESTIONS', 3))
+
+# Кэш распознавания: повторные и похожие фото не отправляются в Logmeal
+recognition_cache = RecognitionCache(
+    maxsize=int(os.getenv('RECOGNITION_CACHE_SIZE', 5000)),
+    ttl=int(os.getenv('RECOGNITION_CACHE_TTL', 7 * 24 * 3600))
+)
+
+# Блюдо, которое ждет ввода веса или сохранения (память процесса или общая база)
+food_sessions = create_session_store()
 
 # Инициализация БД
 init_db()
 
-def create_main_keyboard():
-    keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-
-    row1 = [
-        telebot.types.KeyboardButton("🍽 Потреблено сегодня"),
-        telebot.types.KeyboardButton("📜 Дневник"),
-        telebot.types.KeyboardButton("✍️ Ввести вручную")
-    ]
-
-    row2 = [
-        telebot.types.KeyboardButton("🧑‍🍳 Что приготовить?"),
-        telebot.types.KeyboardButton("❓ Помощь")
-    ]
-
-    keyboard.add(*row1)
-    keyboard.add(*row2)
-
-    return keyboard
-
-
-def analyze_photo_with_logmeal(file_path):
-    """Распознает еду на фото через Logmeal API с проверкой вероятности"""
-    try:
-        with open(file_path, 'rb') as image_file:
-            response = requests.post(
-                LOGMEAL_ENDPOINT,
-                files={'image': image_file},
-                headers=LOGMEAL_HEADERS
-            )
-        data = response.json()
-
-        recognition_result = data['segmentation_results'][0]['recognition_results'][0]
-        food_name = recognition_result['name']
-        prob = recognition_result.get('prob', 1.0)
-
-        return {
-            'food_name': food_name,
-            'prob': float(prob)
-        }
-    except Exception as e:
-        return {'error': str(e)}
-
-
-def get_nutritionix_data(food_name):
-    """Получает данные о КБЖУ из Nutritionix"""
-    headers = {
-        'x-app-id': NUTRITIONIX_APP_ID,
-        'x-app-key': NUTRITIONIX_APP_KEY,
-        'Content-Type': 'application/json'
-    }
-    payload = {'query': food_name}
-
-    response = requests.post(NUTRITIONIX_ENDPOINT, json=payload, headers=headers)
-    if response.status_code != 200:
-        return None
-
-    food = response.json()['foods'][0]
-    return {
-        'calories': food.get('nf_calories', 0),
-        'protein': food.get('nf_protein', 0),
-        'fat': food.get('nf_total_fat', 0),
-        'carbs': food.get('nf_total_carbohydrate', 0),
-        'serving_weight': food.get('serving_weight_grams', 100)
-    }
-
-
-def calculate_nutrition(portion_grams, nutrition_data):
-    """Пересчет КБЖУ с учетом исходного веса порции"""
-    if not nutrition_data or 'serving_weight' not in nutrition_data:
-        return None
-
-    base_weight = nutrition_data.get('serving_weight', 100)
-    coefficient = portion_grams / base_weight
-
-    return {
-        'calories': round(nutrition_data['calories'] * coefficient, 1),
-        'protein': round(nutrition_data['protein'] * coefficient, 1),
-        'fat': round(nutrition_data['fat'] * coefficient, 1),
-        'carbs': round(nutrition_data['carbs'] * coefficient, 1)
-    }
-
-
-def format_nutrition_response(food_name, nutrition_data, portion_grams):
-    """Форматирует ответ с КБЖУ"""
-    return (
-        f"🍏 {translate_to_ru(food_name)}\n"
-        f"⚖️ Порция: {portion_grams}г\n\n"
-        f"Энергетическая ценность:\n"
-        f"🔥 {nutrition_data['calories']} ккал\n"
-        f"🥩 {nutrition_data['protein']}г белков\n"
-        f"🥑 {nutrition_data['fat']}г жиров\n"
-        f"🍞 {nutrition_data['carbs']}г углеводов"
-    )
-
-
-def generate_calendar(year, month, marked_days=None):
-    """Генерирует календарь с жирным выделением дней с записями"""
-    if marked_days is None:
-        marked_days = []
-
-    cal = calendar.monthcalendar(year, month)
-    month_name = calendar.month_name[month]
-
-    keyboard = []
-
-    # Заголовок с месяцем и годом
-    keyboard.append([
-        telebot.types.InlineKeyboardButton(
-            f"<< {month_name} {year} >>",
-            callback_data="ignore"
-        )
-    ])
-
-    # Дни недели
-    week_days = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-    keyboard.append([
-        telebot.types.InlineKeyboardButton(day, callback_data="ignore")
-        for day in week_days
-    ])
-
-    # Недели
-    for week in cal:
-        week_buttons = []
-        for day in week:
-            if day == 0:
-                week_buttons.append(
-                    telebot.types.InlineKeyboardButton(" ", callback_data="ignore")
-                )
-            else:
-                date_str = f"{year}-{month:02d}-{day:02d}"
-                # Жирное выделение для дней с записями
-                day_text = f"*{day}*" if date_str in marked_days else str(day)
-                week_buttons.append(
-                    telebot.types.InlineKeyboardButton(
-                        day_text,
-                        callback_data=f"day_{date_str}"
-                    )
-                )
-        keyboard.append(week_buttons)
-
-    # Кнопки навигации
-    prev_month = month - 1 if month > 1 else 12
-    prev_year = year if month > 1 else year - 1
-    next_month = month + 1 if month < 12 else 1
-    next_year = year if month < 12 else year + 1
-
-    keyboard.append([
-        telebot.types.InlineKeyboardButton(
-            "◀️ Предыдущий месяц",
-            callback_data=f"month_{prev_year}_{prev_month}"
-        ),
-        telebot.types.InlineKeyboardButton(
-            "▶️ Следующий месяц",
-            callback_data=f"month_{next_year}_{next_month}"
-        )
-    ])
-
-    return telebot.types.InlineKeyboardMarkup(keyboard)
-
-
 def show_day_entries(chat_id, date_str):
     """Показывает записи за конкретный день с кнопками удаления"""
     entries = get_diary_entries(chat_id, date_str)
     summary = get_daily_summary(chat_id, date_str)
 
     if not entries:
-        bot.send_message(chat_id, f"🍽 Нет записей за {date_str}")
+        bot.send_message(chat_id, dialog.format_no_entries(date_str))
         return
 
-    # Формируем сообщение
-    message = f"📅 Дневник питания за {date_str}:\n\n"
-
-    for entry in entries:
-        message += (
-            f"⏰ {entry[2].split()[1][:5]} | {entry[3]}\n"
-            f"⚖️ {entry[4]}г | 🔥 {entry[5]} ккал\n"
-            f"🥩 {entry[6]}г белков | 🥑 {entry[7]}г жиров | 🍞 {entry[8]}г углеводов\n\n"
-        )
-
-    message += (
-        f"📊 Итого за день:\n"
-        f"🔥 {summary['calories']:.0f} ккал\n"
-        f"🥩 {summary['protein']:.1f}г белков\n"
-        f"🥑 {summary['fat']:.1f}г жиров\n"
-        f"🍞 {summary['carbs']:.1f}г углеводов"
-    )
-
-    # Создаем кнопки удаления для каждой записи
-    markup = telebot.types.InlineKeyboardMarkup()
-    for entry in entries:
-        markup.add(
-            telebot.types.InlineKeyboardButton(
-                f"❌ Удалить {entry[3][:15]}...",
-                callback_data=f"delete_{entry[0]}"
-            )
-        )
-
-    # Добавляем кнопку "Назад к календарю"
-    markup.add(
-        telebot.types.InlineKeyboardButton(
-            "🔙 Назад к календарю",
-            callback_data="back_to_calendar"
-        )
-    )
-
-    bot.send_message(chat_id, message, reply_markup=markup)
+    bot.send_message(chat_id, dialog.format_day_entries(date_str, entries, summary),
+                     reply_markup=create_day_entries_keyboard(entries))
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('delete_'))
+@metrics.handler
 def handle_delete_entry(call):
     try:
-        entry_id = int(call.data.split('_')[1])
+        entry_id = dialog.parse_entry_callback(call.data)
         delete_diary_entry(entry_id, call.message.chat.id)
 
         # Обновляем сообщение
-        bot.answer_callback_query(call.id, "✅ Запись удалена!")
+        bot.answer_callback_query(call.id, dialog.ENTRY_DELETED_TEXT)
 
-        # Получаем дату из оригинального сообщения
-        original_text = call.message.text
-        date_str = original_text.split("за ")[1].split(":")[0].strip()
-
-        # Показываем обновленный список записей
-        show_day_entries(call.message.chat.id, date_str)
+        # Показываем обновленный список записей за дату из оригинального сообщения
+        show_day_entries(call.message.chat.id, dialog.parse_day_entries_date(call.message.text))
 
     except Exception as e:
-        bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
+        bot.answer_callback_query(call.id, dialog.format_error(e))
 
 @bot.message_handler(commands=['start', 'help'])
+@metrics.handler
 def send_welcome(message):
-    keyboard = create_main_keyboard()
-    bot.reply_to(message,
-        "🍏 Добро пожаловать в Calorie Master!\n\n"
-        "Вы можете:\n"
-        "1. 📸 Отправить фото еды для анализа\n"
-        "2. ✍️ Ввести продукт вручную\n"
-        "3. 📅 Просматривать дневник питания\n\n"
-        "Выберите действие:",
-        reply_markup=keyboard
-    )
+    bot.reply_to(message, dialog.WELCOME_TEXT, reply_markup=create_main_keyboard())
 
 @bot.message_handler(func=lambda message: message.text == "📋 Меню")
+@metrics.handler
 def show_menu(message):
-    keyboard = create_main_keyboard()
-    bot.reply_to(message, "Главное меню:", reply_markup=keyboard)
+    bot.reply_to(message, dialog.MENU_TEXT, reply_markup=create_main_keyboard())
 
 @bot.message_handler(commands=['diary'])
+@metrics.handler
 def show_diary_menu(message):
     today = datetime.now()
-    marked_dates = get_dates_with_entries(message.chat.id)
+    marked_days = get_month_days(message.chat.id, today.year, today.month)
 
-    markup = generate_calendar(today.year, today.month, marked_dates)
+    markup = generate_calendar(today.year, today.month, marked_days)
 
-    bot.send_message(
-        message.chat.id,
-        "📅 Выберите дату для просмотра записей:",
-        reply_markup=markup
-    )
+    bot.send_message(message.chat.id, dialog.CALENDAR_TEXT, reply_markup=markup)
 
 
 @bot.message_handler(func=lambda message: message.text == "🍽 Потреблено сегодня")
+@metrics.handler
 def show_today_summary(message):
-    today_stats = get_today_summary(message.chat.id)
+    response = dialog.format_today_summary(get_today_summary(message.chat.id))
 
-    if today_stats['calories'] == 0:
-        bot.reply_to(message, "Сегодня еще нет записей в дневнике 🍽")
+    if response is None:
+        bot.reply_to(message, dialog.NO_ENTRIES_TODAY_TEXT)
         return
 
-    response = (
-        "📊 <b>Съедено сегодня:</b>\n\n"
-        f"🔥 <b>Калории:</b> {today_stats['calories']:.0f} ккал\n"
-        f"🥩 <b>Белки:</b> {today_stats['protein']:.1f}г\n"
-        f"🧈 <b>Жиры:</b> {today_stats['fat']:.1f}г\n"
-        f"🍞 <b>Углеводы:</b> {today_stats['carbs']:.1f}г\n\n"
-        "Чтобы добавить запись, отправьте фото еды 📸"
-    )
-
     bot.reply_to(message, response, parse_mode="HTML")
 
+@bot.message_handler(commands=['export'])
+@metrics.handler
+def handle_export(message):
+    """Выгружает весь дневник файлом: /export [csv|jsonl] [gz]"""
+    try:
+        fmt, compress = dialog.parse_export_args(message.text)
+
+        # Файл пишется на диск кусками, память не зависит от размера дневника
+        with tempfile.TemporaryFile() as f:
+            count = write_export(message.chat.id, f, fmt, compress)
+            if not count:
+                bot.reply_to(message, dialog.EMPTY_EXPORT_TEXT)
+                return
+
+            f.seek(0)
+            bot.send_document(
+                message.chat.id,
+                telebot.types.InputFile(f, file_name=export_filename(message.chat.id, fmt, compress)),
+                caption=dialog.format_export_caption(count)
+            )
+
+    except Exception as e:
+        bot.reply_to(message, dialog.format_error(e))
+
 @bot.message_handler(func=lambda message: message.text in ["❓ Помощь", "/help"])
+@metrics.handler
 def handle_help(message):
     send_welcome(message)
 
 @bot.message_handler(func=lambda message: message.text in ["📜 Дневник", "/diary"])
+@metrics.handler
 def handle_diary(message):
     show_diary_menu(message)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('day_'))
+@metrics.handler
 def handle_day_selection(call):
     """Обрабатывает выбор дня в календаре"""
-    date_str = call.data.split('_')[1]
-    show_day_entries(call.message.chat.id, date_str)
+    show_day_entries(call.message.chat.id, dialog.parse_day_callback(call.data))
     bot.answer_callback_query(call.id)
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('month_'))
+@metrics.handler
 def handle_month_change(call):
-    _, year, month = call.data.split('_')
-    year = int(year)
-    month = int(month)
-    marked_dates = get_dates_with_entries(call.message.chat.id)
+    year, month = dialog.parse_month_callback(call.data)
+    marked_days = get_month_days(call.message.chat.id, year, month)
 
-    markup = generate_calendar(year, month, marked_dates)
+    markup = generate_calendar(year, month, marked_days)
 
     bot.edit_message_reply_markup(
         chat_id=call.message.chat.id,
@@ -343,229 +190,263 @@ def handle_month_change(call):
 
 
 @bot.callback_query_handler(func=lambda call: call.data == 'back_to_calendar')
+@metrics.handler
 def handle_back_to_calendar(call):
     today = datetime.now()
-    marked_dates = get_dates_with_entries(call.message.chat.id)
+    marked_days = get_month_days(call.message.chat.id, today.year, today.month)
 
-    markup = generate_calendar(today.year, today.month, marked_dates)
+    markup = generate_calendar(today.year, today.month, marked_days)
 
     bot.edit_message_text(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
-        text="📅 Выберите дату для просмотра записей:",
+        text=dialog.CALENDAR_TEXT,
         reply_markup=markup
     )
     bot.answer_callback_query(call.id)
 
 
-@bot.message_handler(content_types=['photo'])
-def handle_photo(message):
-    try:
-        # Скачивание фото
-        file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
+def download_photo(task):
+    """Стадия конвейера: скачивание фото из Telegram"""
+    photo = choose_photo_size(task['message'].photo)
+    task['file_unique_id'] = photo.file_unique_id
+
+    # Это фото уже распознавали - скачивать и отправлять в Logmeal не нужно
+    task['logmeal_data'] = recognition_cache.get_by_file_id(photo.file_unique_id)
+    if task['logmeal_data']:
+        return task
+
+    with metrics.track('upstream', 'telegram_get_file'):
+        file_info = bot.get_file(photo.file_id)
+
+    # Фото остается в памяти и целиком передается в Logmeal
+    with metrics.track('upstream', 'telegram_download_file'):
+        task['image'] = bot.download_file(file_info.file_path)
+    return task
 
-        # Временное сохранение
-        photo_path = f"temp_{message.chat.id}.jpg"
-        with open(photo_path, 'wb') as f:
-            f.write(downloaded_file)
 
-        # Распознавание еды
-        logmeal_data = analyze_photo_with_logmeal(photo_path)
-        os.remove(photo_path)
+def prepare_photo(task):
+    """Стадия конвейера: уменьшение и пережатие фото перед отправкой"""
+    if task['logmeal_data']:
+        return task
 
+    task['image'] = prepare_image(task['image'])
+
+    # Похожее фото (пережатое, пересланное) уже распознавали
+    task['image_hash'] = dhash(task['image'])
+    task['logmeal_data'] = recognition_cache.get_similar(task['image_hash'])
+    return task
+
+
+def recognize_photo(task):
+    """Стадия конвейера: распознавание еды через Logmeal"""
+    logmeal_data = task['logmeal_data']
+    if not logmeal_data:
+        logmeal_data = analyze_photo_with_logmeal(task.pop('image'))
         if 'error' in logmeal_data:
             raise Exception(logmeal_data['error'])
+        recognition_cache.put(task['file_unique_id'], task['image_hash'], logmeal_data)
+        task['logmeal_data'] = logmeal_data
 
-        # Проверяем вероятность распознавания
-        if logmeal_data.get('prob', 1.0) < 0.5:  # Если prob < 50%
-            markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-            markup.row(
-                telebot.types.KeyboardButton("📸 Сделать новое фото"),
-                telebot.types.KeyboardButton("✍️ Ввести вручную")
-            )
+    task['food_name_ru'] = translate_to_ru(logmeal_data['food_name'])
 
-            bot.reply_to(message,
-                         f"🤔 Я не уверен, что это ({translate_to_ru(logmeal_data['food_name'])})\n"
-                         "Вероятность распознавания: {:.0f}%\n\n"
-                         "Попробуйте сделать более четкое фото или введите название вручную:".format(
-                             logmeal_data['prob'] * 100
-                         ),
-                         reply_markup=markup
-                         )
-            return
+    # При низкой вероятности КБЖУ не нужны - сразу отвечаем пользователю
+    if dialog.is_uncertain(logmeal_data):
+        return Done(task)
 
-        food_name = logmeal_data['food_name']
-        nutrition_data = get_nutritionix_data(food_name)
+    task['items'] = select_meal_items(logmeal_data)
+    for item in task['items']:
+        item['food_name_ru'] = translate_to_ru(item['food_name'])
+    return task
 
-        if not nutrition_data:
-            raise Exception("Не удалось получить данные о питательности")
 
-        user_food_data[message.chat.id] = {
-            'food_name': food_name,
-            'nutrition_per_100g': nutrition_data,
-            'photo_id': message.photo[-1].file_id
-        }
+def lookup_photo_nutrition(task):
+    """Стадия конвейера: КБЖУ всех блюд с фото одним пакетным запросом"""
+    nutrition = get_nutritionix_batch([item['food_name'] for item in task['items']])
+    task['items'] = dialog.attach_nutrition(task['items'], nutrition)
+    return task
 
-        bot.reply_to(message,
-                     f"🍴 Распознано: {translate_to_ru(food_name)} "
-                     f"(уверенность: {logmeal_data['prob'] * 100:.0f}%)\n"
-                     "📝 Введите вес порции в граммах:"
-                     )
 
-        # Регистрируем обработчик следующего сообщения
-        bot.register_next_step_handler(message, process_portion_size)
+def reply_photo_result(task):
+    """Отвечает пользователю по результатам конвейера"""
+    message = task['message']
+    logmeal_data = task['logmeal_data']
 
-    except Exception as e:
-        bot.reply_to(message, f"❌ Ошибка: {str(e)}")
+    # Проверяем вероятность распознавания
+    if dialog.is_uncertain(logmeal_data):
+        bot.reply_to(message, dialog.format_uncertain_photo(task['food_name_ru'], logmeal_data['prob']),
+                     reply_markup=create_uncertain_photo_keyboard())
+        return
 
+    if len(task['items']) > 1:
+        return ask_meal_portions(message, task['items'])
 
-def generate_recipes_with_together(ingredients):
-    try:
-        headers = {
-            "Authorization": f"Bearer {TOGETHER_API_KEY}",
-            "Content-Type": "application/json"
-        }
-
-        prompt = (
-            "Ты шеф-повар. Сгенерируй 3 разных рецепта используя ТОЛЬКО эти ингредиенты: "
-            f"{', '.join(ingredients)}.\n\n"
-            "Формат для каждого рецепта:\n"
-            "1. Название (максимум 5 слов)\n"
-            "• Ингредиенты: (только указанные)\n"
-            "• Время: (в минутах)\n"
-            "• Рецепт: (3 четких шага)\n"
-            "• КБЖУ на 100г ~ (в ккал)\n\n"
-            "Пример:\n"
-            "1. Омлет с сыром\n"
-            "• Ингредиенты: яйца, сыр\n"
-            "• Время: 10 мин\n"
-            "• Рецепт: 1. Взбейте яйца. 2. Добавьте сыр. 3. Жарьте 5 мин.\n"
-            "• КБЖУ на 100г ~ 🔥 110 ккал\n"
-            "• 🥩 14 г белков\n"
-            "• 🥑 8 г жиров\n"
-            "• 🍞 4 г углеводов"
-        )
-
-        payload = {
-            "model": TOGETHER_MODEL,
-            "prompt": prompt,
-            "max_tokens": 1500,
-            "temperature": 0.7,
-            "stop": ["###", "\n\n\n"]
-        }
-
-        response = requests.post(
-            TOGETHER_API_ENDPOINT,
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
-
-        # Проверка статуса ответа
-        if response.status_code != 200:
-            error_msg = response.json().get('error', {}).get('message', 'Unknown error')
-            raise Exception(f"API Error: {error_msg}")
-
-        result = response.json()["choices"][0]["text"]
-
-        # Проверка минимальной структуры ответа
-        if not all(x in result for x in ["• Ингредиенты:", "• Время:", "• Рецепт:"]):
-            raise Exception("Некорректный формат ответа")
-
-        return result
+    item = task['items'][0]
+    food_sessions.set(message.chat.id, dialog.photo_food_session(item, message.photo[-1].file_id))
 
-    except Exception as e:
-        raise Exception(f"Ошибка генерации рецептов: {str(e)}")
+    bot.reply_to(message, dialog.format_recognized(item))
+
+    # Регистрируем обработчик следующего сообщения
+    bot.register_next_step_handler(message, process_portion_size)
+
+
+photo_pipeline = Pipeline(
+    [
+        ('download', download_photo, PHOTO_DOWNLOAD_WORKERS),
+        ('prepare', prepare_photo, PHOTO_PREPARE_WORKERS),
+        ('recognize', recognize_photo, PHOTO_RECOGNITION_WORKERS),
+        ('nutrition', lookup_photo_nutrition, PHOTO_NUTRITION_WORKERS),
+    ],
+    queue_size=PHOTO_QUEUE_SIZE,
+    per_user_limit=PHOTO_PER_USER_LIMIT
+)
+
+
+@bot.message_handler(content_types=['photo'])
+@metrics.handler
+def handle_photo(message):
+    def on_error(e):
+        bot.reply_to(message, dialog.format_error(e))
+
+    position = photo_pipeline.submit(message.chat.id, {'message': message}, reply_photo_result, on_error)
+    if position:
+        bot.reply_to(message, f"⏳ Фото в очереди на распознавание, позиция {position}")
 
-    except requests.exceptions.Timeout:
-        raise Exception("Превышено время ожидания ответа от Together AI")
-    except Exception as e:
-        raise Exception(f"Ошибка генерации рецептов: {str(e)}")
 
 @bot.message_handler(func=lambda message: message.text == "🧑‍🍳 Что приготовить?")
+@metrics.handler
 def ask_for_ingredients(message):
-    bot.reply_to(message,
-                 "📝 Перечислите продукты через запятую:\n"
-                 "Пример: <i>яйца, молоко, мука, сыр</i>",
-                 parse_mode="HTML"
-                 )
+    bot.reply_to(message, dialog.ASK_INGREDIENTS_TEXT, parse_mode="HTML")
     bot.register_next_step_handler(message, handle_ingredients_list)
 
+@metrics.handler
 def handle_ingredients_list(message):
     try:
-        ingredients = [x.strip() for x in message.text.split(',') if x.strip()]
-
-        if len(ingredients) < 2:
-            raise ValueError("Нужно минимум 2 ингредиента")
-
-        typing_msg = bot.send_message(message.chat.id, "🧠 Придумываю рецепты...")
-
-        # Заменяем вызов API на Together AI версию
-        recipes = generate_recipes_with_together(ingredients)
+        ingredients = dialog.parse_ingredients(message.text)
+
+        # Тот же набор продуктов уже спрашивали - отвечаем из кэша без запроса к модели
+        key = recipe_cache_key([translate_to_en(ingredient) for ingredient in ingredients])
+        recipes, wants_variant = get_cached_recipes(key)
+        if recipes is not None:
+            bot.reply_to(message, dialog.format_recipes(ingredients, recipes), parse_mode="HTML")
+            if wants_variant:
+                schedule_recipe_variant(key, ingredients)
+            return
 
-        # Форматируем ответ
-        response = f"🍳 <b>Рецепты из {', '.join(ingredients)}:</b>\n\n{recipes}"
+        typing_msg = bot.send_message(message.chat.id, dialog.RECIPES_PENDING_TEXT)
 
-        bot.delete_message(message.chat.id, typing_msg.message_id)
-        bot.reply_to(message, response, parse_mode="HTML")
+        if not RECIPE_STREAMING:
+            recipes = generate_recipes_with_together(ingredients)
+            bot.delete_message(message.chat.id, typing_msg.message_id)
+            bot.reply_to(message, dialog.format_recipes(ingredients, recipes), parse_mode="HTML")
+        else:
+            # Показываем рецепты по мере генерации, правя то же сообщение
+            recipes = stream_recipes_to_message(typing_msg, ingredients)
+            bot.edit_message_text(dialog.format_recipes(ingredients, recipes),
+                                  typing_msg.chat.id, typing_msg.message_id, parse_mode="HTML")
+        cache_recipes(key, recipes)
 
     except Exception as e:
-        bot.reply_to(message, f"❌ Ошибка: {str(e)}")
+        bot.reply_to(message, dialog.format_error(e))
+
+def stream_recipes_to_message(typing_msg, ingredients):
+    """Правит сообщение по мере генерации (не чаще RECIPE_EDIT_INTERVAL), возвращает проверенный текст"""
+    throttle = EditThrottle()
+    text = ''
+    for chunk in stream_recipes_with_together(ingredients):
+        text += chunk
+        if not throttle.ready():
+            continue
+        try:
+            bot.edit_message_text(dialog.format_recipes_progress(ingredients, text),
+                                  typing_msg.chat.id, typing_msg.message_id)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                throttle.postpone(e.result_json.get('parameters', {}).get('retry_after', 5))
+    return check_recipes_format(text.strip())
+
 
 @bot.message_handler(func=lambda message: message.text == "📸 Сделать новое фото")
+@metrics.handler
 def ask_for_new_photo(message):
-    bot.reply_to(message, "📸 Пожалуйста, сделайте новое фото еды (лучше освещение, крупный план)")
+    bot.reply_to(message, dialog.NEW_PHOTO_TEXT)
 
 
 @bot.message_handler(func=lambda message: message.text in ["✍️ Ввести вручную", "Ввести вручную"])
+@metrics.handler
 def ask_for_food_name(message):
-    bot.reply_to(message,
-                 "📝 Введите название продукта или блюда:\n"
-                 "Пример: <i>банан, овсяная каша, куриная грудка</i>",
-                 parse_mode="HTML"
-                 )
+    bot.reply_to(message, dialog.ASK_FOOD_NAME_TEXT, parse_mode="HTML")
     bot.register_next_step_handler(message, handle_manual_input)
 
 
+@metrics.handler
 def handle_manual_input(message):
     try:
         # Если пользователь ввел "меню" - возвращаем в главное меню
-        if message.text.lower() == 'меню':
+        if dialog.is_menu_request(message.text):
             return show_main_menu(message)
 
-        food_name = translate_to_en(message.text.strip())
-        if not food_name:
-            raise ValueError("Название не может быть пустым")
+        text = dialog.parse_food_name(message.text)
 
-        nutrition_data = get_nutritionix_data(food_name)
+        # Известное название (в том числе с опечаткой) находим без запросов в сеть
+        entry, suggestions = dialog.match_food_name(get_food_name_index(), text, FOOD_SUGGESTIONS)
+        if entry is not None:
+            return lookup_manual_food(message, *entry)
+        if suggestions:
+            bot.reply_to(message, dialog.SUGGESTIONS_TEXT,
+                         reply_markup=create_food_suggestions_keyboard(suggestions))
+            return
 
-        if not nutrition_data:
-            markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-            markup.add("✍️ Уточнить запрос", "📋 Меню")
+        lookup_manual_food(message, text)
 
-            bot.reply_to(message,
-                         f"🔍 Не найдено данных для '{translate_to_ru(food_name)}'\n"
-                         "Попробуйте уточнить название:",
-                         reply_markup=markup
-                         )
-            bot.register_next_step_handler(message, handle_retry_input)
-            return
+    except Exception as e:
+        bot.reply_to(message, dialog.format_error(e))
+        show_main_menu(message)  # Возвращаем в меню при ошибке
 
-        user_food_data[message.chat.id] = {
-            'food_name': translate_to_ru(food_name),
-            'nutrition_per_100g': nutrition_data
-        }
 
-        bot.reply_to(message,
-                     f"🍴 Найдено: {translate_to_ru(food_name)}\n"
-                     "📝 Введите вес порции в граммах:"
-                     )
-        bot.register_next_step_handler(message, process_portion_size)
+@bot.callback_query_handler(func=lambda call: call.data.startswith('food_'))
+@metrics.handler
+def handle_food_suggestion(call):
+    """Выбор варианта из подсказок к ручному вводу"""
+    try:
+        bot.answer_callback_query(call.id)
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
+
+        choice = dialog.parse_suggestion_callback(call.data)
+        if choice == 'typed':
+            # Подсказки отправлены ответом на сообщение пользователя - берем текст оттуда
+            return lookup_manual_food(call.message, call.message.reply_to_message.text.strip())
+
+        entry = get_food_name_index().get_by_key(choice)
+        if entry is None:
+            raise ValueError("Подсказка устарела, введите название еще раз")
+        lookup_manual_food(call.message, *entry)
 
     except Exception as e:
-        bot.reply_to(message, f"❌ Ошибка: {str(e)}")
-        show_main_menu(message)  # Возвращаем в меню при ошибке
+        bot.send_message(call.message.chat.id, dialog.format_error(e))
+        show_main_menu(call)
+
+
+def lookup_manual_food(message, name, query=None, name_ru=None):
+    """
+    Ищет КБЖУ блюда и просит ввести вес порции.
+    query - английский запрос, если он уже известен (тогда перевод не нужен).
+    """
+    food_name = query or translate_to_en(name)
+    nutrition_data = get_nutritionix_data(food_name)
+
+    food_name_ru = name_ru or translate_to_ru(food_name)
+
+    if not nutrition_data:
+        bot.reply_to(message, dialog.format_not_found(food_name_ru), reply_markup=create_retry_keyboard())
+        bot.register_next_step_handler(message, handle_retry_input)
+        return
+
+    dialog.remember_food_names(get_food_name_index(), name, food_name, food_name_ru)
+    food_sessions.set(message.chat.id, dialog.manual_food_session(food_name_ru, nutrition_data))
+
+    bot.reply_to(message, dialog.format_found(food_name_ru))
+    bot.register_next_step_handler(message, process_portion_size)
 
 
 def show_main_menu(message_or_call):
@@ -575,89 +456,165 @@ def show_main_menu(message_or_call):
     else:  # Если это call
         chat_id = message_or_call.message.chat.id
 
-    keyboard = create_main_keyboard()
-    bot.send_message(
-        chat_id,
-        "Главное меню:",
-        reply_markup=keyboard
-    )
+    bot.send_message(chat_id, dialog.MENU_TEXT, reply_markup=create_main_keyboard())
 
+@metrics.handler
 def handle_retry_input(message):
-    if message.text == "✍️ Уточнить запрос":
+    if dialog.is_retry_request(message.text):
         ask_for_food_name(message)
     else:
         show_menu(message)
 
 
+@metrics.handler
 def process_portion_size(message):
     try:
         # Если пользователь ввел "меню" - возвращаем в главное меню
-        if message.text.lower() == 'меню':
+        if dialog.is_menu_request(message.text):
             return show_main_menu(message)
 
         chat_id = message.chat.id
-        portion_grams = float(message.text)
-
-        if portion_grams <= 0:
-            raise ValueError("Вес должен быть больше 0")
+        portion_grams = dialog.parse_portion(message.text)
 
-        food_info = user_food_data.get(chat_id)
+        food_info = food_sessions.get(chat_id)
         if not food_info:
-            raise Exception("Сессия устарела")
+            raise dialog.SessionExpired()
 
         nutrition = calculate_nutrition(portion_grams, food_info['nutrition_per_100g'])
+        response = dialog.format_nutrition_response(translate_to_ru(food_info['food_name']), nutrition,
+                                                    portion_grams)
 
-        response = format_nutrition_response(
-            food_info['food_name'],
-            nutrition,
-            portion_grams
-        )
+        bot.send_message(chat_id, response, reply_markup=create_save_keyboard(portion_grams))
 
-        markup = telebot.types.InlineKeyboardMarkup()
-        markup.add(telebot.types.InlineKeyboardButton(
-            "💾 Сохранить",
-            callback_data=f"save_{portion_grams}"
-        ))
+    except ValueError:
+        bot.reply_to(message, dialog.PORTION_FORMAT_TEXT)
+    except Exception as e:
+        bot.reply_to(message, dialog.format_error(e))
+    finally:
+        show_main_menu(message)  # Всегда возвращаем в меню после обработки
+
+
+def ask_meal_portions(message, items):
+    """Несколько блюд на фото: просим вес каждой позиции одним сообщением"""
+    food_sessions.set(message.chat.id, dialog.meal_session(items, message.photo[-1].file_id))
+    bot.reply_to(message, dialog.format_meal_question(items))
+    bot.register_next_step_handler(message, process_meal_portions)
+
+
+@metrics.handler
+def process_meal_portions(message):
+    try:
+        if dialog.is_menu_request(message.text):
+            return show_main_menu(message)
+
+        chat_id = message.chat.id
+        meal = food_sessions.get(chat_id)
+        if not meal or 'items' not in meal:
+            raise dialog.SessionExpired()
+
+        portions = dialog.parse_meal_portions(message.text, len(meal['items']))
+        if portions is None:
+            bot.reply_to(message, dialog.format_meal_portions_count(len(meal['items'])))
+            bot.register_next_step_handler(message, process_meal_portions)
+            return
+
+        meal['portions'] = portions
+        food_sessions.set(chat_id, meal)
 
-        bot.send_message(chat_id, response, reply_markup=markup)
+        bot.send_message(chat_id, dialog.format_meal_summary(meal['items'], portions),
+                         reply_markup=create_save_meal_keyboard())
+        show_main_menu(message)
 
     except ValueError:
-        bot.reply_to(message, "🔢 Пожалуйста, введите число (например: 200)")
+        bot.reply_to(message, dialog.MEAL_PORTIONS_FORMAT_TEXT)
+        bot.register_next_step_handler(message, process_meal_portions)
     except Exception as e:
-        bot.reply_to(message, f"❌ Ошибка: {str(e)}")
+        bot.reply_to(message, dialog.format_error(e))
+        show_main_menu(message)
+
+
+@bot.callback_query_handler(func=lambda call: call.data == 'savemeal')
+@metrics.handler
+def handle_save_meal(call):
+    try:
+        chat_id = call.message.chat.id
+        meal = food_sessions.get(chat_id)
+        items = dialog.meal_diary_items(meal)
+
+        if items is None:
+            bot.answer_callback_query(call.id, dialog.SESSION_EXPIRED_TEXT)
+            return
+
+        # Все позиции приема пищи - одной транзакцией
+        save_meal_to_diary(chat_id, items, photo_id=meal.get('photo_id'))
+        food_sessions.delete(chat_id)
+
+        bot.answer_callback_query(call.id, dialog.SAVED_TEXT)
+        bot.send_message(chat_id, dialog.MEAL_SAVED_TEXT)
+
+    except Exception as e:
+        bot.answer_callback_query(call.id, dialog.format_error(e))
     finally:
-        show_main_menu(message)  # Всегда возвращаем в меню после обработки
+        show_main_menu(call.message)
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('save_'))
+@metrics.handler
 def handle_save(call):
     try:
         chat_id = call.message.chat.id
-        portion_grams = float(call.data.split('_')[1])
-        food_info = user_food_data.get(chat_id)
+        portion_grams = dialog.parse_save_callback(call.data)
+        food_info = food_sessions.get(chat_id)
 
         if not food_info:
-            bot.answer_callback_query(call.id, "❌ Сессия устарела")
+            bot.answer_callback_query(call.id, dialog.SESSION_EXPIRED_TEXT)
             return
 
-        save_to_diary(
-            chat_id=chat_id,
-            food_name=food_info['food_name'],
-            portion_grams=portion_grams,
-            nutrition_data=calculate_nutrition(portion_grams, food_info['nutrition_per_100g']),
-            photo_id=food_info.get('photo_id')
-        )
+        save_to_diary(chat_id=chat_id, **dialog.diary_entry(food_info, portion_grams))
 
-        bot.answer_callback_query(call.id, "✅ Сохранено в дневник!")
-        bot.send_message(chat_id, "🍽 Запись добавлена в дневник")
+        bot.answer_callback_query(call.id, dialog.SAVED_TEXT)
+        bot.send_message(chat_id, dialog.ENTRY_SAVED_TEXT)
 
     except Exception as e:
-        bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
+        bot.answer_callback_query(call.id, dialog.format_error(e))
     finally:
         show_main_menu(call.message)  # Возвращаем в меню после сохранения
 
 
 # --- Запуск --- #
 if __name__ == '__main__':
-    print("🟢 Бот запущен")
-    bot.infinity_polling()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'warm-cache':
+        limit = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+        print(f"🔥 Прогрето записей: {warm_nutrition_cache(limit)}")
+        print(get_nutrition_cache_stats())
+        http_client.close_sessions()
+        close_connections()
+        sys.exit()
+
+    if NEXT_STEP_SAVE_FILE:
+        bot.load_next_step_handlers(filename=NEXT_STEP_SAVE_FILE)
+
+    metrics.register_stats('photo_pipeline', photo_pipeline.snapshot)
+    metrics.register_stats('recognition_cache', recognition_cache.stats)
+    metrics.register_stats('nutrition_cache', get_nutrition_cache_stats)
+    metrics.register_stats('translation_cache', get_translation_cache_stats)
+    metrics.register_stats('recipe_cache', get_recipe_cache_stats)
+    metrics.start_metrics_server()
+
+    print(f"🟢 Бот запущен (шард {os.getenv('SHARD_ID')})" if os.getenv('SHARD_ID') else "🟢 Бот запущен")
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == 'webhook':
+            # Обновления приходят по HTTP, обработчики выполняются в потоках по чатам
+            from webhook import run_webhook
+            run_webhook(bot)
+        else:
+            # SIGTERM (kill, остановка контейнера) завершает опрос, и блок finally
+            # дописывает отложенные записи дневника, как при Ctrl+C
+            signal.signal(signal.SIGTERM, lambda *_: bot.stop_polling())
+            bot.infinity_polling(long_polling_timeout=POLLING_TIMEOUT)
+    finally:
+        print(f"📊 Кэш рецептов: {get_recipe_cache_stats()}")
+        if NEXT_STEP_SAVE_FILE:
+            bot.next_step_backend.save_handlers()
+        http_client.close_sessions()
+        close_connections()
\ No newline at end of file
@@ -1,7 +1,7 @@
 import os
 from importlib.metadata import EntryPoint
 
-import requests
+import http_client
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 from PIL import Image
@@ -17,7 +17,8 @@ def recognize_food(file_path):
         valid_extensions = ['.jpg', '.jpeg', '.png']
         if not any(file_path.lower().endswith(ext) for ext in valid_extensions):
             return "Неподдерживаемый формат файла. Используйте JPG/PNG."
-        response = requests.post(ENDPOINT, files={'image': open(file_path, 'rb')}, headers=headers).json()
+        with open(file_path, 'rb') as image_file:
+            response = http_client.post('logmeal', ENDPOINT, files={'image': image_file}, headers=headers).json()
         return parse_response(response)
 
     except Exception as e: return f"Произошла ошибка: {str(e)}"
@@ -0,0 +1,565 @@
+import asyncio
+import os
+import signal
+import tempfile
+from datetime import datetime
+from dotenv import load_dotenv
+import telebot
+from telebot.async_telebot import AsyncTeleBot
+import metrics
+from database import (init_db, save_to_diary, save_meal_to_diary, get_diary_entries, get_month_days,
+                      get_daily_summary, get_today_summary, delete_diary_entry, get_translation_cache_stats,
+                      close_connections)
+from keyboards import (create_main_keyboard, create_food_suggestions_keyboard, generate_calendar,
+                       create_uncertain_photo_keyboard, create_retry_keyboard, create_save_keyboard,
+                       create_save_meal_keyboard, create_day_entries_keyboard)
+from nutrition import calculate_nutrition, get_nutrition_cache_stats
+from logmeal import select_meal_items
+from imaging import choose_photo_size, prepare_image, dhash
+from cache import RecognitionCache
+from sessions import create_session_store
+from export import write_export, export_filename
+from fuzzy import get_food_name_index
+from async_clients import (run_db, analyze_photo, get_nutrition, get_nutrition_batch, translate_to_ru,
+                           translate_to_en, generate_recipes, stream_recipes, add_recipe_variant,
+                           close_sessions)
+from recipes import (check_recipes_format, EditThrottle, RECIPE_STREAMING, recipe_cache_key,
+                     get_cached_recipes, cache_recipes, get_recipe_cache_stats)
+import dialog
+
+# --- Асинхронный режим бота --- #
+# Все обращения к внешним API идут через aiohttp, SQLite - через небольшой
+# пул потоков, поэтому один процесс обслуживает много пользователей сразу.
+load_dotenv()
+bot = AsyncTeleBot(os.getenv('TELEGRAM_BOT_TOKEN'))
+
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.asyncio_helper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+    telebot.asyncio_helper.FILE_URL = TELEGRAM_API_URL.rstrip('/') + "/file/bot{0}/{1}"
+
+# Кэш распознавания: повторные и похожие фото не отправляются в Logmeal
+recognition_cache = RecognitionCache(
+    maxsize=int(os.getenv('RECOGNITION_CACHE_SIZE', 5000)),
+    ttl=int(os.getenv('RECOGNITION_CACHE_TTL', 7 * 24 * 3600))
+)
+
+# Сколько вариантов предлагать, если название введено с ошибкой
+FOOD_SUGGESTIONS = int(os.getenv('FOOD_SUGGESTIONS', 3))
+
+# Блюдо, которое ждет ввода веса или сохранения
+food_sessions = create_session_store()
+
+# Фоновые задачи (ссылки нужны, чтобы их не собрал сборщик мусора)
+background_tasks = set()
+
+# Аналог register_next_step_handler: какой обработчик ждет следующее сообщение чата
+next_steps = {}
+
+init_db()
+
+
+def register_next_step(message, handler):
+    next_steps[message.chat.id] = handler
+
+
+@bot.message_handler(func=lambda message: message.chat.id in next_steps)
+async def handle_next_step(message):
+    handler = next_steps.pop(message.chat.id)
+    await handler(message)
+
+
+async def show_main_menu(message_or_call):
+    """Универсальная функция показа главного меню"""
+    if hasattr(message_or_call, 'chat'):  # Если это message
+        chat_id = message_or_call.chat.id
+    else:  # Если это call
+        chat_id = message_or_call.message.chat.id
+
+    await bot.send_message(chat_id, dialog.MENU_TEXT, reply_markup=create_main_keyboard())
+
+
+async def show_day_entries(chat_id, date_str):
+    """Показывает записи за конкретный день с кнопками удаления"""
+    entries, summary = await asyncio.gather(
+        run_db(get_diary_entries, chat_id, date_str),
+        run_db(get_daily_summary, chat_id, date_str)
+    )
+
+    if not entries:
+        await bot.send_message(chat_id, dialog.format_no_entries(date_str))
+        return
+
+    await bot.send_message(chat_id, dialog.format_day_entries(date_str, entries, summary),
+                           reply_markup=create_day_entries_keyboard(entries))
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('delete_'))
+@metrics.handler
+async def handle_delete_entry(call):
+    try:
+        entry_id = dialog.parse_entry_callback(call.data)
+        await run_db(delete_diary_entry, entry_id, call.message.chat.id)
+        await bot.answer_callback_query(call.id, dialog.ENTRY_DELETED_TEXT)
+
+        # Дата - из оригинального сообщения
+        await show_day_entries(call.message.chat.id, dialog.parse_day_entries_date(call.message.text))
+
+    except Exception as e:
+        await bot.answer_callback_query(call.id, dialog.format_error(e))
+
+
+@bot.message_handler(commands=['start', 'help'])
+@metrics.handler
+async def send_welcome(message):
+    await bot.reply_to(message, dialog.WELCOME_TEXT, reply_markup=create_main_keyboard())
+
+
+@bot.message_handler(func=lambda message: message.text == "📋 Меню")
+@metrics.handler
+async def show_menu(message):
+    await bot.reply_to(message, dialog.MENU_TEXT, reply_markup=create_main_keyboard())
+
+
+@bot.message_handler(commands=['diary'])
+@metrics.handler
+async def show_diary_menu(message):
+    today = datetime.now()
+    marked_days = await run_db(get_month_days, message.chat.id, today.year, today.month)
+
+    await bot.send_message(message.chat.id, dialog.CALENDAR_TEXT,
+                           reply_markup=generate_calendar(today.year, today.month, marked_days))
+
+
+@bot.message_handler(func=lambda message: message.text == "🍽 Потреблено сегодня")
+@metrics.handler
+async def show_today_summary(message):
+    response = dialog.format_today_summary(await run_db(get_today_summary, message.chat.id))
+
+    if response is None:
+        await bot.reply_to(message, dialog.NO_ENTRIES_TODAY_TEXT)
+        return
+
+    await bot.reply_to(message, response, parse_mode="HTML")
+
+
+@bot.message_handler(commands=['export'])
+@metrics.handler
+async def handle_export(message):
+    """Выгружает весь дневник файлом: /export [csv|jsonl] [gz]"""
+    try:
+        fmt, compress = dialog.parse_export_args(message.text)
+
+        with tempfile.TemporaryFile() as f:
+            count = await run_db(write_export, message.chat.id, f, fmt, compress)
+            if not count:
+                await bot.reply_to(message, dialog.EMPTY_EXPORT_TEXT)
+                return
+
+            f.seek(0)
+            await bot.send_document(
+                message.chat.id,
+                telebot.types.InputFile(f, file_name=export_filename(message.chat.id, fmt, compress)),
+                caption=dialog.format_export_caption(count)
+            )
+
+    except Exception as e:
+        await bot.reply_to(message, dialog.format_error(e))
+
+
+@bot.message_handler(func=lambda message: message.text in ["❓ Помощь", "/help"])
+@metrics.handler
+async def handle_help(message):
+    await send_welcome(message)
+
+
+@bot.message_handler(func=lambda message: message.text in ["📜 Дневник", "/diary"])
+@metrics.handler
+async def handle_diary(message):
+    await show_diary_menu(message)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('day_'))
+@metrics.handler
+async def handle_day_selection(call):
+    """Обрабатывает выбор дня в календаре"""
+    await show_day_entries(call.message.chat.id, dialog.parse_day_callback(call.data))
+    await bot.answer_callback_query(call.id)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('month_'))
+@metrics.handler
+async def handle_month_change(call):
+    year, month = dialog.parse_month_callback(call.data)
+    marked_days = await run_db(get_month_days, call.message.chat.id, year, month)
+
+    await bot.edit_message_reply_markup(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=generate_calendar(year, month, marked_days)
+    )
+    await bot.answer_callback_query(call.id)
+
+
+@bot.callback_query_handler(func=lambda call: call.data == 'back_to_calendar')
+@metrics.handler
+async def handle_back_to_calendar(call):
+    today = datetime.now()
+    marked_days = await run_db(get_month_days, call.message.chat.id, today.year, today.month)
+
+    await bot.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=dialog.CALENDAR_TEXT,
+        reply_markup=generate_calendar(today.year, today.month, marked_days)
+    )
+    await bot.answer_callback_query(call.id)
+
+
+@bot.message_handler(content_types=['photo'])
+@metrics.handler
+async def handle_photo(message):
+    try:
+        photo = choose_photo_size(message.photo)
+        logmeal_data = recognition_cache.get_by_file_id(photo.file_unique_id)
+
+        if not logmeal_data:
+            with metrics.track('upstream', 'telegram_get_file'):
+                file_info = await bot.get_file(photo.file_id)
+            with metrics.track('upstream', 'telegram_download_file'):
+                downloaded_file = await bot.download_file(file_info.file_path)
+
+            # Пережатие и хэш нагружают процессор, поэтому уходят из цикла событий
+            loop = asyncio.get_running_loop()
+            image = await loop.run_in_executor(None, prepare_image, downloaded_file)
+            image_hash = await loop.run_in_executor(None, dhash, image)
+
+            logmeal_data = recognition_cache.get_similar(image_hash)
+            if not logmeal_data:
+                logmeal_data = await analyze_photo(image)
+                if 'error' in logmeal_data:
+                    raise Exception(logmeal_data['error'])
+                recognition_cache.put(photo.file_unique_id, image_hash, logmeal_data)
+
+        if dialog.is_uncertain(logmeal_data):
+            await bot.reply_to(message,
+                               dialog.format_uncertain_photo(await translate_to_ru(logmeal_data['food_name']),
+                                                             logmeal_data['prob']),
+                               reply_markup=create_uncertain_photo_keyboard())
+            return
+
+        items = select_meal_items(logmeal_data)
+        nutrition, *names_ru = await asyncio.gather(
+            get_nutrition_batch([item['food_name'] for item in items]),
+            *(translate_to_ru(item['food_name']) for item in items)
+        )
+        items = dialog.attach_nutrition([dict(item, food_name_ru=food_name_ru)
+                                         for item, food_name_ru in zip(items, names_ru)], nutrition)
+        if len(items) > 1:
+            return await ask_meal_portions(message, items)
+
+        item = items[0]
+        await run_db(food_sessions.set, message.chat.id, dialog.photo_food_session(item, message.photo[-1].file_id))
+
+        await bot.reply_to(message, dialog.format_recognized(item))
+        register_next_step(message, process_portion_size)
+
+    except Exception as e:
+        await bot.reply_to(message, dialog.format_error(e))
+
+
+@bot.message_handler(func=lambda message: message.text == "🧑‍🍳 Что приготовить?")
+@metrics.handler
+async def ask_for_ingredients(message):
+    await bot.reply_to(message, dialog.ASK_INGREDIENTS_TEXT, parse_mode="HTML")
+    register_next_step(message, handle_ingredients_list)
+
+
+@metrics.handler
+async def handle_ingredients_list(message):
+    try:
+        ingredients = dialog.parse_ingredients(message.text)
+
+        # Тот же набор продуктов уже спрашивали - отвечаем из кэша без запроса к модели
+        key = recipe_cache_key(await asyncio.gather(*map(translate_to_en, ingredients)))
+        recipes, wants_variant = await run_db(get_cached_recipes, key)
+        if recipes is not None:
+            await bot.reply_to(message, dialog.format_recipes(ingredients, recipes), parse_mode="HTML")
+            if wants_variant:
+                task = asyncio.create_task(add_recipe_variant(key, ingredients))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+            return
+
+        typing_msg = await bot.send_message(message.chat.id, dialog.RECIPES_PENDING_TEXT)
+
+        if not RECIPE_STREAMING:
+            recipes = await generate_recipes(ingredients)
+            await bot.delete_message(message.chat.id, typing_msg.message_id)
+            await bot.reply_to(message, dialog.format_recipes(ingredients, recipes), parse_mode="HTML")
+        else:
+            # Показываем рецепты по мере генерации, правя то же сообщение
+            recipes = await stream_recipes_to_message(typing_msg, ingredients)
+            await bot.edit_message_text(dialog.format_recipes(ingredients, recipes),
+                                        typing_msg.chat.id, typing_msg.message_id, parse_mode="HTML")
+        await run_db(cache_recipes, key, recipes)
+
+    except Exception as e:
+        await bot.reply_to(message, dialog.format_error(e))
+
+
+async def stream_recipes_to_message(typing_msg, ingredients):
+    """Правит сообщение по мере генерации (не чаще RECIPE_EDIT_INTERVAL), возвращает проверенный текст"""
+    throttle = EditThrottle()
+    text = ''
+    async for chunk in stream_recipes(ingredients):
+        text += chunk
+        if not throttle.ready():
+            continue
+        try:
+            await bot.edit_message_text(dialog.format_recipes_progress(ingredients, text),
+                                        typing_msg.chat.id, typing_msg.message_id)
+        except telebot.asyncio_helper.ApiTelegramException as e:
+            if e.error_code == 429:
+                throttle.postpone(e.result_json.get('parameters', {}).get('retry_after', 5))
+    return check_recipes_format(text.strip())
+
+
+@bot.message_handler(func=lambda message: message.text == "📸 Сделать новое фото")
+@metrics.handler
+async def ask_for_new_photo(message):
+    await bot.reply_to(message, dialog.NEW_PHOTO_TEXT)
+
+
+@bot.message_handler(func=lambda message: message.text in ["✍️ Ввести вручную", "Ввести вручную"])
+@metrics.handler
+async def ask_for_food_name(message):
+    await bot.reply_to(message, dialog.ASK_FOOD_NAME_TEXT, parse_mode="HTML")
+    register_next_step(message, handle_manual_input)
+
+
+@metrics.handler
+async def handle_manual_input(message):
+    try:
+        if dialog.is_menu_request(message.text):
+            return await show_main_menu(message)
+
+        text = dialog.parse_food_name(message.text)
+
+        # Известное название (в том числе с опечаткой) находим без запросов в сеть
+        entry, suggestions = dialog.match_food_name(await run_db(get_food_name_index), text, FOOD_SUGGESTIONS)
+        if entry is not None:
+            return await lookup_manual_food(message, *entry)
+        if suggestions:
+            await bot.reply_to(message, dialog.SUGGESTIONS_TEXT,
+                               reply_markup=create_food_suggestions_keyboard(suggestions))
+            return
+
+        await lookup_manual_food(message, text)
+
+    except Exception as e:
+        await bot.reply_to(message, dialog.format_error(e))
+        await show_main_menu(message)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('food_'))
+@metrics.handler
+async def handle_food_suggestion(call):
+    """Выбор варианта из подсказок к ручному вводу"""
+    try:
+        await bot.answer_callback_query(call.id)
+        await bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
+
+        choice = dialog.parse_suggestion_callback(call.data)
+        if choice == 'typed':
+            # Подсказки отправлены ответом на сообщение пользователя - берем текст оттуда
+            return await lookup_manual_food(call.message, call.message.reply_to_message.text.strip())
+
+        entry = (await run_db(get_food_name_index)).get_by_key(choice)
+        if entry is None:
+            raise ValueError("Подсказка устарела, введите название еще раз")
+        await lookup_manual_food(call.message, *entry)
+
+    except Exception as e:
+        await bot.send_message(call.message.chat.id, dialog.format_error(e))
+        await show_main_menu(call)
+
+
+async def lookup_manual_food(message, name, query=None, name_ru=None):
+    """
+    Ищет КБЖУ блюда и просит ввести вес порции.
+    query - английский запрос, если он уже известен (тогда перевод не нужен).
+    """
+    food_name = query or await translate_to_en(name)
+    if name_ru:
+        nutrition_data, food_name_ru = await get_nutrition(food_name), name_ru
+    else:
+        nutrition_data, food_name_ru = await asyncio.gather(
+            get_nutrition(food_name),
+            translate_to_ru(food_name)
+        )
+
+    if not nutrition_data:
+        await bot.reply_to(message, dialog.format_not_found(food_name_ru), reply_markup=create_retry_keyboard())
+        register_next_step(message, handle_retry_input)
+        return
+
+    dialog.remember_food_names(await run_db(get_food_name_index), name, food_name, food_name_ru)
+    await run_db(food_sessions.set, message.chat.id, dialog.manual_food_session(food_name_ru, nutrition_data))
+
+    await bot.reply_to(message, dialog.format_found(food_name_ru))
+    register_next_step(message, process_portion_size)
+
+
+@metrics.handler
+async def handle_retry_input(message):
+    if dialog.is_retry_request(message.text):
+        await ask_for_food_name(message)
+    else:
+        await show_menu(message)
+
+
+@metrics.handler
+async def process_portion_size(message):
+    try:
+        if dialog.is_menu_request(message.text):
+            return await show_main_menu(message)
+
+        chat_id = message.chat.id
+        portion_grams = dialog.parse_portion(message.text)
+
+        food_info = await run_db(food_sessions.get, chat_id)
+        if not food_info:
+            raise dialog.SessionExpired()
+
+        nutrition = calculate_nutrition(portion_grams, food_info['nutrition_per_100g'])
+        response = dialog.format_nutrition_response(await translate_to_ru(food_info['food_name']), nutrition,
+                                                    portion_grams)
+
+        await bot.send_message(chat_id, response, reply_markup=create_save_keyboard(portion_grams))
+
+    except ValueError:
+        await bot.reply_to(message, dialog.PORTION_FORMAT_TEXT)
+    except Exception as e:
+        await bot.reply_to(message, dialog.format_error(e))
+    finally:
+        await show_main_menu(message)
+
+
+async def ask_meal_portions(message, items):
+    """Несколько блюд на фото: просим вес каждой позиции одним сообщением"""
+    await run_db(food_sessions.set, message.chat.id, dialog.meal_session(items, message.photo[-1].file_id))
+    await bot.reply_to(message, dialog.format_meal_question(items))
+    register_next_step(message, process_meal_portions)
+
+
+@metrics.handler
+async def process_meal_portions(message):
+    try:
+        if dialog.is_menu_request(message.text):
+            return await show_main_menu(message)
+
+        chat_id = message.chat.id
+        meal = await run_db(food_sessions.get, chat_id)
+        if not meal or 'items' not in meal:
+            raise dialog.SessionExpired()
+
+        portions = dialog.parse_meal_portions(message.text, len(meal['items']))
+        if portions is None:
+            await bot.reply_to(message, dialog.format_meal_portions_count(len(meal['items'])))
+            register_next_step(message, process_meal_portions)
+            return
+
+        meal['portions'] = portions
+        await run_db(food_sessions.set, chat_id, meal)
+
+        await bot.send_message(chat_id, dialog.format_meal_summary(meal['items'], portions),
+                               reply_markup=create_save_meal_keyboard())
+        await show_main_menu(message)
+
+    except ValueError:
+        await bot.reply_to(message, dialog.MEAL_PORTIONS_FORMAT_TEXT)
+        register_next_step(message, process_meal_portions)
+    except Exception as e:
+        await bot.reply_to(message, dialog.format_error(e))
+        await show_main_menu(message)
+
+
+@bot.callback_query_handler(func=lambda call: call.data == 'savemeal')
+@metrics.handler
+async def handle_save_meal(call):
+    try:
+        chat_id = call.message.chat.id
+        meal = await run_db(food_sessions.get, chat_id)
+        items = dialog.meal_diary_items(meal)
+
+        if items is None:
+            await bot.answer_callback_query(call.id, dialog.SESSION_EXPIRED_TEXT)
+            return
+
+        # Все позиции приема пищи - одной транзакцией
+        await run_db(save_meal_to_diary, chat_id, items, photo_id=meal.get('photo_id'))
+        await run_db(food_sessions.delete, chat_id)
+
+        await bot.answer_callback_query(call.id, dialog.SAVED_TEXT)
+        await bot.send_message(chat_id, dialog.MEAL_SAVED_TEXT)
+
+    except Exception as e:
+        await bot.answer_callback_query(call.id, dialog.format_error(e))
+    finally:
+        await show_main_menu(call.message)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('save_'))
+@metrics.handler
+async def handle_save(call):
+    try:
+        chat_id = call.message.chat.id
+        portion_grams = dialog.parse_save_callback(call.data)
+        food_info = await run_db(food_sessions.get, chat_id)
+
+        if not food_info:
+            await bot.answer_callback_query(call.id, dialog.SESSION_EXPIRED_TEXT)
+            return
+
+        # Перевод названия идет через общий кэш, поэтому в пуле БД он почти мгновенный
+        await translate_to_ru(food_info['food_name'])
+        await run_db(save_to_diary, chat_id=chat_id, **dialog.diary_entry(food_info, portion_grams))
+
+        await bot.answer_callback_query(call.id, dialog.SAVED_TEXT)
+        await bot.send_message(chat_id, dialog.ENTRY_SAVED_TEXT)
+
+    except Exception as e:
+        await bot.answer_callback_query(call.id, dialog.format_error(e))
+    finally:
+        await show_main_menu(call.message)
+
+
+async def main():
+    # Статистика собирается в потоке сервера метрик, вне цикла событий
+    metrics.register_stats('recognition_cache', recognition_cache.stats)
+    metrics.register_stats('nutrition_cache', get_nutrition_cache_stats)
+    metrics.register_stats('translation_cache', get_translation_cache_stats)
+    metrics.register_stats('recipe_cache', get_recipe_cache_stats)
+    metrics.start_metrics_server()
+
+    # SIGTERM (kill, остановка контейнера) отменяет опрос, и блок finally
+    # дописывает отложенные записи дневника, как при Ctrl+C
+    polling = asyncio.create_task(bot.infinity_polling())
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, polling.cancel)
+    try:
+        await polling
+    except asyncio.CancelledError:
+        pass
+    finally:
+        print(f"📊 Кэш рецептов: {await run_db(get_recipe_cache_stats)}")
+        await close_sessions()
+        await bot.close_session()
+        close_connections()
+
+
+# --- Запуск --- #
+if __name__ == '__main__':
+    print("🟢 Бот запущен (asyncio)")
+    asyncio.run(main())
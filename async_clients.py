@@ -0,0 +1,268 @@
+import asyncio
+import contextvars
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import metrics
+from http_client import CONNECT_TIMEOUT, UPSTREAMS, RETRY_STATUSES, RETRY_AFTER_STATUSES, RETRY_BACKOFF
+from database import (TRANSLATE_URL, build_translation_params, parse_translation_response,
+                      get_cached_translation, save_translation)
+from logmeal import LOGMEAL_ENDPOINT, LOGMEAL_HEADERS, parse_logmeal_response
+from nutrition import (NUTRITIONIX_ENDPOINT, nutritionix_headers, parse_nutritionix_food,
+                       normalize_food_query, get_stored_nutrition_data, cache_nutrition_data,
+                       nutrition_cache_stats, build_batch_query, match_batch_foods)
+from recipes import (TOGETHER_API_ENDPOINT, together_headers, build_recipe_payload, check_recipes_format,
+                     parse_stream_line, cache_recipes)
+
+# Одновременных соединений к одному API (в асинхронном режиме их не жалко)
+ASYNC_POOL_SIZE = 100
+
+# SQLite работает в небольшом отдельном пуле, чтобы не блокировать цикл событий
+DB_WORKERS = 4
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+_sessions = {}
+
+# Наборы ингредиентов, для которых сейчас догенерируется вариант рецептов
+_recipe_variants_in_progress = set()
+
+
+class Response:
+    """Прочитанный ответ: статус и тело, как у requests.Response"""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет функцию database.py в пуле потоков и ждет результат без блокировки"""
+    loop = asyncio.get_running_loop()
+    # Контекст переносится в поток, чтобы запросы к базе попали в трассировку обработчика
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_db_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def get_session(upstream):
+    """Возвращает общую aiohttp-сессию для указанного API"""
+    session = _sessions.get(upstream)
+    if session is None or session.closed:
+        config = UPSTREAMS[upstream]
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=ASYNC_POOL_SIZE, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=config['read_timeout'])
+        )
+        _sessions[upstream] = session
+    return session
+
+
+async def request(upstream, method, url, **kwargs):
+    """
+    Запрос с повторами и экспоненциальной задержкой, по тем же правилам, что
+    и http_client: POST повторяется только при ошибке соединения или 429/503
+    с Retry-After, таймаут чтения для него не повторяется.
+    Если data - функция, тело собирается заново для каждой попытки
+    (FormData в aiohttp нельзя отправить дважды).
+    """
+    retries = UPSTREAMS[upstream]['retries']
+    idempotent = UPSTREAMS[upstream].get('idempotent', False)
+    retry_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError) if idempotent \
+        else aiohttp.ClientConnectorError
+    make_data = kwargs.pop('data', None)
+    if kwargs.get('headers'):
+        # requests молча пропускает заголовки со значением None, aiohttp - падает
+        kwargs['headers'] = {k: v for k, v in kwargs['headers'].items() if v is not None}
+
+    for attempt in range(retries + 1):
+        if callable(make_data):
+            kwargs['data'] = make_data()
+        elif make_data is not None:
+            kwargs['data'] = make_data
+        delay = RETRY_BACKOFF * 2 ** attempt
+        try:
+            with metrics.track('upstream', upstream):
+                async with get_session(upstream).request(method, url, **kwargs) as response:
+                    body = await response.read()
+            if response.status >= 400:
+                metrics.inc('bot_upstream_errors_total', name=upstream, error=f"HTTP {response.status}")
+            retry_after = response.headers.get('Retry-After', '')
+            if idempotent:
+                retryable = response.status in RETRY_STATUSES
+            else:
+                retryable = response.status in RETRY_AFTER_STATUSES and retry_after.isdigit()
+            if not retryable or attempt == retries:
+                return Response(response.status, body)
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        except retry_errors:
+            if attempt == retries:
+                raise
+        await asyncio.sleep(delay)
+
+
+async def close_sessions():
+    for session in _sessions.values():
+        await session.close()
+    _sessions.clear()
+
+
+async def analyze_photo(image_bytes):
+    """Распознает еду на фото через Logmeal API"""
+    def make_form():
+        form = aiohttp.FormData()
+        form.add_field('image', image_bytes, filename='photo.jpg', content_type='image/jpeg')
+        return form
+
+    try:
+        response = await request('logmeal', 'POST', LOGMEAL_ENDPOINT, data=make_form,
+                                 headers=LOGMEAL_HEADERS)
+        return parse_logmeal_response(response.json())
+    except Exception as e:
+        return {'error': str(e)}
+
+
+async def get_nutrition(food_name):
+    """Получает данные о КБЖУ (локальная база продуктов, кэш, затем Nutritionix)"""
+    query = normalize_food_query(food_name)
+
+    nutrition_data = await run_db(get_stored_nutrition_data, query)
+    if nutrition_data:
+        return nutrition_data
+
+    nutrition_cache_stats.add('requests')
+    response = await request('nutritionix', 'POST', NUTRITIONIX_ENDPOINT, json={'query': query},
+                             headers=nutritionix_headers())
+    if response.status_code != 200:
+        return None
+
+    foods = response.json().get('foods')
+    if not foods:
+        return None
+    nutrition_data = parse_nutritionix_food(foods[0])
+    await run_db(cache_nutrition_data, query, nutrition_data)
+    return nutrition_data
+
+
+async def get_nutrition_batch(food_names):
+    """
+    КБЖУ сразу для нескольких блюд (список в том же порядке, None - не найдено).
+    Все, чего нет в локальной базе и кэше, запрашивается одним запросом к Nutritionix.
+    """
+    queries = [normalize_food_query(food_name) for food_name in food_names]
+    unique = list(dict.fromkeys(queries))
+    stored = await run_db(lambda: [get_stored_nutrition_data(query) for query in unique])
+    found = {query: nutrition_data for query, nutrition_data in zip(unique, stored) if nutrition_data}
+    missing = [query for query in unique if query not in found]
+
+    if len(missing) > 1:
+        nutrition_cache_stats.add('requests')
+        response = await request('nutritionix', 'POST', NUTRITIONIX_ENDPOINT,
+                                 json={'query': build_batch_query(missing)}, headers=nutritionix_headers())
+        if response.status_code == 200:
+            matched = match_batch_foods(missing, response.json().get('foods', []))
+            for query, food in matched.items():
+                found[query] = parse_nutritionix_food(food)
+                await run_db(cache_nutrition_data, query, found[query])
+
+    # Несопоставленные с ответом (или единственное) блюда - отдельными запросами параллельно
+    leftovers = [query for query in missing if query not in found]
+    for query, nutrition_data in zip(leftovers, await asyncio.gather(*map(get_nutrition, leftovers))):
+        if nutrition_data:
+            found[query] = nutrition_data
+
+    return [found.get(query) for query in queries]
+
+
+async def translate(text, target_lang):
+    """Перевод через Google Translate с общим кэшем переводов"""
+    cached = await run_db(get_cached_translation, text, target_lang)
+    if cached is not None:
+        return cached
+
+    response = await request('translate', 'GET', TRANSLATE_URL,
+                             params=build_translation_params(text, target_lang))
+    if response.status_code != 200:
+        raise Exception(f"API Error: {response.text}")
+
+    try:
+        result = parse_translation_response(response.json())
+    except ValueError:
+        result = None
+    if result is None:
+        return text
+
+    await run_db(save_translation, text, target_lang, result)
+    return result
+
+
+async def translate_to_ru(text):
+    return await translate(text, "ru")
+
+
+async def translate_to_en(text):
+    return await translate(text, "en")
+
+
+async def generate_recipes(ingredients):
+    try:
+        response = await request('together', 'POST', TOGETHER_API_ENDPOINT,
+                                 json=build_recipe_payload(ingredients), headers=together_headers())
+
+        # Проверка статуса ответа
+        if response.status_code != 200:
+            error_msg = response.json().get('error', {}).get('message', 'Unknown error')
+            raise Exception(f"API Error: {error_msg}")
+
+        return check_recipes_format(response.json()["choices"][0]["text"])
+
+    except asyncio.TimeoutError:
+        raise Exception("Превышено время ожидания ответа от Together AI")
+    except Exception as e:
+        raise Exception(f"Ошибка генерации рецептов: {str(e)}")
+
+
+async def add_recipe_variant(key, ingredients):
+    """Генерирует для кэша еще один вариант рецептов (в фоне, после ответа из кэша)"""
+    if key in _recipe_variants_in_progress:
+        return
+    _recipe_variants_in_progress.add(key)
+    try:
+        await run_db(cache_recipes, key, await generate_recipes(ingredients), shown=False)
+    except Exception as e:
+        print(f"⚠️ Не удалось сгенерировать вариант рецептов ({key}): {e}")
+    finally:
+        _recipe_variants_in_progress.discard(key)
+
+
+async def stream_recipes(ingredients):
+    """Генерирует рецепты потоком: отдает куски текста по мере их появления"""
+    try:
+        # Как и в синхронном режиме, замеряется время до заголовков ответа, а не вся генерация
+        with metrics.track('upstream', 'together'):
+            response = await get_session('together').post(TOGETHER_API_ENDPOINT,
+                                                          json=build_recipe_payload(ingredients, stream=True),
+                                                          headers=together_headers())
+        async with response:
+            if response.status != 200:
+                error_msg = (await response.json(content_type=None)).get('error', {}).get('message', 'Unknown error')
+                raise Exception(f"API Error: {error_msg}")
+
+            async for line in response.content:
+                chunk = parse_stream_line(line.decode('utf-8').strip())
+                if chunk is None:
+                    return
+                if chunk:
+                    yield chunk
+
+    except asyncio.TimeoutError:
+        raise Exception("Превышено время ожидания ответа от Together AI")
+    except Exception as e:
+        raise Exception(f"Ошибка генерации рецептов: {str(e)}")
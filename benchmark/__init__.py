@@ -0,0 +1 @@
+"""Нагрузочный тест бота: заглушки внешних API, сценарии пользователей и отчет (python -m benchmark.run)"""
@@ -0,0 +1,167 @@
+import random
+import time
+
+# Тексты, которыми бот сообщает об ошибке: шаг сценария сразу считается проваленным
+ERROR_PREFIXES = ('❌', '🔢', '🔍 Не найдено')
+
+MANUAL_FOODS = (
+    'яблоко', 'банан', 'гречка', 'куриная грудка', 'творог', 'овсяная каша',
+    # Нет в локальной базе - перевод и запрос в Nutritionix
+    'плов', 'шаурма', 'хачапури', 'сырники', 'окрошка', 'винегрет',
+    # С опечатками - поиск по индексу названий
+    'гречкаа', 'творох', 'яблако',
+)
+INGREDIENTS = (
+    'яйца', 'молоко', 'мука', 'сыр', 'помидоры', 'огурцы',
+    'курица', 'рис', 'картофель', 'лук', 'морковь', 'макароны',
+)
+
+
+class FlowError(Exception):
+    def __init__(self, step, reason):
+        super().__init__(f"{step}: {reason}")
+        self.step = step
+        self.reason = reason
+
+
+class UserSession:
+    """
+    Один пользователь бота: отправляет сообщения и нажатия кнопок через
+    заглушку Telegram и ждет нужных ответов бота, замеряя каждый шаг.
+    """
+
+    def __init__(self, telegram, chat_id, rng, step_timeout=30.0, typing=0.3):
+        self.telegram = telegram
+        self.chat_id = chat_id
+        self.rng = rng
+        self.step_timeout = step_timeout
+        self.typing = typing
+        self.steps = {}  # шаг сценария -> секунды ожидания ответа бота
+        self._cursor = 0
+        self._sent_at = None
+
+    def send(self, text=None, photo_index=None):
+        self._mark()
+        self.telegram.deliver(self.telegram.user_message(self.chat_id, text, photo_index))
+
+    def press(self, event, data):
+        self._mark()
+        self.telegram.deliver(self.telegram.user_callback(self.chat_id, event['message'], data))
+
+    def waited(self):
+        """Сколько всего пользователь ждал бота (без пауз на набор текста)"""
+        return sum(self.steps.values())
+
+    def expect(self, step, predicate):
+        """Ждет ответа бота, для которого predicate(текст, событие) истинно; ошибка бота - FlowError"""
+
+        def matches(event):
+            return event['text'].startswith(ERROR_PREFIXES) or predicate(event['text'], event)
+
+        found = self.telegram.wait_event(self.chat_id, self._cursor, matches, self.step_timeout)
+        if found is None:
+            raise FlowError(step, 'timeout')
+        index, event = found
+        self._cursor = index + 1
+        if event['text'].startswith(ERROR_PREFIXES):
+            raise FlowError(step, event['text'].splitlines()[0][:80])
+        self.steps[step] = event['time'] - self._sent_at
+        return event
+
+    def reset(self):
+        """После проваленного сценария: 'меню' снимает ожидающий шаг диалога"""
+        self.send('меню')
+        time.sleep(0.5)
+        self._cursor = self.telegram.event_count(self.chat_id)
+
+    def _mark(self):
+        # Человек отвечает не мгновенно; бот и не обязан успевать за мгновенным ответом
+        if self._sent_at is not None and self.typing:
+            time.sleep(self.typing * self.rng.uniform(0.5, 1.5))
+        self._cursor = max(self._cursor, self.telegram.event_count(self.chat_id))
+        self._sent_at = time.perf_counter()
+
+
+def inline_buttons(event):
+    markup = event.get('markup') or {}
+    return [button.get('callback_data', '') for row in markup.get('inline_keyboard', []) for button in row]
+
+
+def has_button(prefix):
+    return lambda text, event: any(data.startswith(prefix) for data in inline_buttons(event))
+
+
+def enter_portion_and_save(session):
+    """Вес порции -> карточка КБЖУ с кнопкой сохранения -> запись в дневник"""
+    session.send(str(session.rng.choice((100, 150, 200, 250))))
+    card = session.expect('portion', has_button('save_'))
+    session.press(card, inline_buttons(card)[0])
+    session.expect('save', lambda text, event: 'добавлена в дневник' in text)
+
+
+def photo_flow(session):
+    # Фото выбирается из общего пула: чем он меньше, тем чаще срабатывает кэш распознавания
+    session.send(photo_index=session.rng.randrange(len(session.telegram.photos)))
+    reply = session.expect('recognize', lambda text, event: 'Введите вес' in text or 'Я не уверен' in text)
+    text = reply['text']
+    if 'Я не уверен' in text:
+        return
+    if 'каждой позиции' not in text:
+        return enter_portion_and_save(session)
+
+    # Несколько блюд на фото: бот сам подсказывает формат ответа
+    session.send(text.split('например: ', 1)[1].splitlines()[0])
+    card = session.expect('portion', has_button('savemeal'))
+    session.press(card, 'savemeal')
+    session.expect('save', lambda text, event: 'добавлен в дневник' in text)
+
+
+def manual_flow(session):
+    session.send("✍️ Ввести вручную")
+    session.expect('ask_name', lambda text, event: 'Введите название' in text)
+    session.send(session.rng.choice(MANUAL_FOODS))
+    reply = session.expect('lookup', lambda text, event: 'Введите вес' in text or 'вы имели в виду' in text)
+    if 'вы имели в виду' in reply['text']:
+        session.press(reply, inline_buttons(reply)[0])
+        session.expect('suggestion', lambda text, event: 'Введите вес' in text)
+    enter_portion_and_save(session)
+
+
+def diary_flow(session):
+    session.send("🍽 Потреблено сегодня")
+    session.expect('today', lambda text, event: event['method'] == 'sendMessage'
+                   and bool(text) and not text.startswith("Главное меню"))
+    session.send("📜 Дневник")
+    session.expect('calendar', lambda text, event: 'Выберите дату' in text)
+
+
+def recipe_flow(session):
+    session.send("🧑‍🍳 Что приготовить?")
+    session.expect('ask_ingredients', lambda text, event: 'Перечислите продукты' in text)
+    session.send(', '.join(session.rng.sample(INGREDIENTS, session.rng.randint(2, 4))))
+    # При потоковой генерации бот правит сообщение; последняя правка - без курсора ▌
+    session.expect('recipes', lambda text, event: 'Рецепты из' in text and not text.endswith('▌'))
+
+
+FLOWS = {
+    'photo': photo_flow,
+    'manual': manual_flow,
+    'diary': diary_flow,
+    'recipe': recipe_flow,
+}
+
+
+def parse_mix(mix):
+    """'photo=4,manual=3,diary=2,recipe=1' -> {сценарий: вес}"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in FLOWS:
+            raise ValueError(f"Неизвестный сценарий: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def new_rng(seed, chat_id):
+    return random.Random(f"{seed}-{chat_id}")
@@ -0,0 +1,462 @@
+import ast
+import io
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+from PIL import Image
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHOTO_PATH = os.path.join(ROOT, 'ogurec.jpg')
+RECORDED_LOGMEAL = os.path.join(ROOT, 'api tests.py')
+
+# Переводы для названий, которые использует нагрузка; остальное возвращается как есть
+TRANSLATIONS = {
+    'яблоко': 'apple', 'гречка': 'buckwheat', 'куриная грудка': 'chicken breast', 'творог': 'cottage cheese',
+    'плов': 'pilaf', 'шаурма': 'shawarma', 'хачапури': 'khachapuri', 'сырники': 'syrniki',
+    'окрошка': 'okroshka', 'винегрет': 'vinaigrette salad', 'гречкаа': 'buckwheat', 'творох': 'cottage cheese',
+    'яйца': 'eggs', 'молоко': 'milk', 'мука': 'flour', 'сыр': 'cheese', 'помидоры': 'tomatoes',
+    'огурцы': 'cucumbers', 'курица': 'chicken', 'рис': 'rice', 'картофель': 'potatoes', 'лук': 'onion',
+    'морковь': 'carrot', 'макароны': 'pasta',
+}
+TRANSLATIONS.update({en: ru for ru, en in list(TRANSLATIONS.items())})
+
+RECIPE_TEXT = "\n\n".join(
+    f"{n}. {title}\n"
+    "• Ингредиенты: из списка\n"
+    f"• Время: {10 * n} мин\n"
+    "• Рецепт: 1. Подготовьте продукты. 2. Смешайте. 3. Готовьте до готовности.\n"
+    f"• КБЖУ на 100г ~ 🔥 {100 + 20 * n} ккал"
+    for n, title in enumerate(("Запеканка", "Салат", "Омлет"), 1)
+)
+
+
+def load_recorded_logmeal_response(path=RECORDED_LOGMEAL):
+    """Ответ сегментации Logmeal, записанный в комментарии api tests.py (строка '# response = {...}')"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('# response = '):
+                return ast.literal_eval(line[len('# response = '):].strip())
+    raise ValueError(f"В {path} нет записанного ответа Logmeal")
+
+
+def make_photo_pool(count, seed=0, path=PHOTO_PATH):
+    """
+    Разные фото для нагрузки: исходное фото с наложенной мозаикой. У каждого
+    свой перцептивный хэш, поэтому кэш похожих фото не прячет запросы к Logmeal.
+    """
+    rng = random.Random(seed)
+    base = Image.open(path).convert('RGB')
+    photos = []
+    for _ in range(count):
+        mosaic = Image.new('RGB', (4, 4))
+        mosaic.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(16)])
+        image = Image.blend(base, mosaic.resize(base.size, Image.Resampling.NEAREST), 0.6)
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=90)
+        photos.append(output.getvalue())
+    return photos, base.size
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.mock.dispatch(self)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UpstreamMock:
+    """
+    Заглушка внешнего API на свободном локальном порту. Перед ответом
+    ждет latency (±50%), с вероятностью error_rate отвечает ошибкой.
+    """
+
+    name = None
+    error_status = 503
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()  # HTTP-статус -> число ответов
+        self._random = random.Random(f"{self.name}-{seed}")
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name=f"mock-{self.name}", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self._lock:
+            calls = dict(self.calls)
+        return {
+            'requests': sum(calls.values()),
+            'injected_errors': calls.get(self.error_status, 0),
+            'latency_s': self.latency,
+            'error_rate': self.error_rate,
+        }
+
+    def _roll(self):
+        with self._lock:
+            delay = self.latency * self._random.uniform(0.5, 1.5) if self.latency else 0
+            failed = self._random.random() < self.error_rate
+        return delay, failed
+
+    def dispatch(self, request):
+        url = urlsplit(request.path)
+        body = request.rfile.read(int(request.headers.get('Content-Length', 0)))
+        params = dict(parse_qsl(url.query))
+        content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params.update(parse_qsl(body.decode('utf-8')))
+        elif content_type.startswith('multipart/form-data'):
+            params.update(self._parse_multipart(content_type, body))
+        elif content_type.startswith('application/json') and body:
+            params.update(json.loads(body))
+
+        delay, failed = self._roll()
+        time.sleep(delay)
+        if failed:
+            status, payload = self.error_response()
+        else:
+            status, payload = self.handle(url.path, params)
+        with self._lock:
+            self.calls[status] += 1
+
+        if hasattr(payload, '__next__'):
+            return self._stream(request, status, payload)
+        if isinstance(payload, (dict, list)):
+            body, content_type = json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json'
+        else:
+            body, content_type = payload, 'application/octet-stream'
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    @staticmethod
+    def _parse_multipart(content_type, body):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode('utf-8') + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name and part.get_filename() is None:
+                params[name] = part.get_content().strip() if part.get_content_maintype() == 'text' \
+                    else part.get_payload(decode=True).decode('utf-8')
+        return params
+
+    @staticmethod
+    def _stream(request, status, chunks):
+        """Потоковый ответ (server-sent events): без Content-Length, до закрытия соединения"""
+        request.send_response(status)
+        request.send_header('Content-Type', 'text/event-stream')
+        request.send_header('Connection', 'close')
+        request.end_headers()
+        request.close_connection = True
+        for chunk in chunks:
+            request.wfile.write(chunk)
+            request.wfile.flush()
+
+    def error_response(self):
+        return self.error_status, {'error': {'message': f"Injected {self.name} error"}}
+
+    def handle(self, path, params):
+        raise NotImplementedError
+
+
+class LogmealMock(UpstreamMock):
+    """Сегментация: повторяет записанный ответ Logmeal на любое фото"""
+
+    name = 'logmeal'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.response = load_recorded_logmeal_response()
+
+    def handle(self, path, params):
+        return 200, self.response
+
+
+class NutritionixMock(UpstreamMock):
+    """Natural nutrients: по продукту на каждое блюдо запроса, КБЖУ стабильны для названия"""
+
+    name = 'nutritionix'
+
+    def handle(self, path, params):
+        foods = []
+        for food_name in (part.strip() for part in str(params.get('query', '')).split(',')):
+            if not food_name:
+                continue
+            seed = zlib.crc32(food_name.encode('utf-8'))
+            foods.append({
+                'food_name': food_name,
+                'serving_weight_grams': 100 + seed % 200,
+                'nf_calories': 50 + seed % 400,
+                'nf_protein': round(seed % 300 / 10, 1),
+                'nf_total_fat': round(seed % 200 / 10, 1),
+                'nf_total_carbohydrate': round(seed % 500 / 10, 1),
+            })
+        if not foods:
+            return 404, {'message': "We couldn't match any of your foods"}
+        return 200, {'foods': foods}
+
+
+class TranslateMock(UpstreamMock):
+    """Google Translate (dj=1): перевод из TRANSLATIONS, иначе исходный текст"""
+
+    name = 'translate'
+
+    def handle(self, path, params):
+        text = params.get('q', '')
+        translated = TRANSLATIONS.get(text.strip().lower(), text)
+        return 200, {'sentences': [{'trans': translated, 'orig': text}], 'src': 'auto'}
+
+
+class TogetherMock(UpstreamMock):
+    """Completions: рецепты целиком или потоком по словам с паузой stream_interval"""
+
+    name = 'together'
+
+    def __init__(self, *args, stream_interval=0.02, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stream_interval = stream_interval
+
+    def handle(self, path, params):
+        if not params.get('stream'):
+            return 200, {'choices': [{'text': RECIPE_TEXT}]}
+        return 200, self._events()
+
+    def _events(self):
+        words = RECIPE_TEXT.split(' ')
+        for i in range(0, len(words), 4):
+            text = ' '.join(words[i:i + 4]) + ' '
+            yield f"data: {json.dumps({'choices': [{'text': text}]}, ensure_ascii=False)}\n\n".encode('utf-8')
+            time.sleep(self.stream_interval)
+        yield b"data: [DONE]\n\n"
+
+
+class TelegramMock(UpstreamMock):
+    """
+    Bot API: отдает обновления через getUpdates (или шлет их на вебхук бота),
+    принимает ответы бота и хранит их по чатам, чтобы нагрузка могла их дождаться.
+    """
+
+    name = 'telegram'
+    error_status = 429
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+    MESSAGE_METHODS = ('sendMessage', 'editMessageText', 'sendDocument', 'sendPhoto', 'editMessageReplyMarkup')
+
+    def __init__(self, *args, photo_pool=20, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.photos, self.photo_size = make_photo_pool(photo_pool)
+        self.webhook_url = None
+        self.polled = threading.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._updates = []
+        self._updates_cond = threading.Condition()
+        self._events = {}       # chat_id -> список ответов бота
+        self._messages = {}     # (chat_id, message_id) -> сообщение
+        self._callbacks = {}    # id нажатия кнопки -> chat_id
+        self._events_cond = threading.Condition()
+
+    def error_response(self):
+        return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                     'parameters': {'retry_after': 1}}
+
+    # --- Сторона пользователя --- #
+
+    def user_message(self, chat_id, text=None, photo_index=None):
+        """Сообщение от пользователя: текст или фото из пула (по номеру)"""
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        if photo_index is None:
+            message['text'] = text
+        else:
+            width, height = self.photo_size
+            message['photo'] = [
+                {'file_id': f"thumb{photo_index}", 'file_unique_id': f"uthumb{photo_index}",
+                 'width': 90, 'height': 90 * height // width},
+                {'file_id': f"photo{photo_index}", 'file_unique_id': f"uphoto{photo_index}",
+                 'width': width, 'height': height},
+            ]
+        with self._events_cond:
+            self._messages[(chat_id, message['message_id'])] = message
+        return {'message': message}
+
+    def user_callback(self, chat_id, message, data):
+        """Нажатие inline-кнопки под сообщением бота"""
+        callback_id = str(next(self._message_ids))
+        with self._events_cond:
+            self._callbacks[callback_id] = chat_id
+        return {'callback_query': {
+            'id': callback_id,
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'chat_instance': str(chat_id),
+            'message': message,
+            'data': data,
+        }}
+
+    def deliver(self, update):
+        """Отдает обновление боту: в очередь getUpdates или POST на вебхук"""
+        if self.webhook_url:
+            update['update_id'] = next(self._update_ids)
+            requests.post(self.webhook_url, json=update, timeout=30).raise_for_status()
+            return
+        with self._updates_cond:
+            # Номер выдается под блокировкой: очередь должна идти по возрастанию update_id,
+            # иначе бот сдвинет offset дальше еще не полученного обновления
+            update['update_id'] = next(self._update_ids)
+            self._updates.append(update)
+            self._updates_cond.notify_all()
+
+    def event_count(self, chat_id):
+        with self._events_cond:
+            return len(self._events.get(chat_id, ()))
+
+    def wait_event(self, chat_id, start, predicate, timeout):
+        """
+        Первое событие чата с номером >= start, для которого predicate вернул True.
+        Возвращает (номер, событие) или None по таймауту.
+        """
+        deadline = time.monotonic() + timeout
+        with self._events_cond:
+            index = start
+            while True:
+                events = self._events.get(chat_id, [])
+                while index < len(events):
+                    if predicate(events[index]):
+                        return index, events[index]
+                    index += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._events_cond.wait(remaining)
+
+    # --- Сторона бота --- #
+
+    def handle(self, path, params):
+        if path.startswith('/file/'):
+            # file_path = photos/photo<номер в пуле>.jpg
+            index = int(re.sub(r'\D', '', path.rsplit('/', 1)[-1]) or 0)
+            return 200, self.photos[index % len(self.photos)]
+
+        method = path.rsplit('/', 1)[-1]
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': self.BOT_USER}
+        if method == 'getFile':
+            file_id = params.get('file_id', '')
+            return 200, {'ok': True, 'result': {'file_id': file_id, 'file_unique_id': 'u' + file_id,
+                                                'file_size': 1, 'file_path': f"photos/{file_id}.jpg"}}
+        if method in self.MESSAGE_METHODS:
+            return 200, {'ok': True, 'result': self._record(method, params)}
+        if method == 'answerCallbackQuery':
+            # Ответ на нажатие кнопки тоже событие чата: в нем бывает текст ошибки
+            with self._events_cond:
+                chat_id = self._callbacks.pop(params.get('callback_query_id'), 0)
+            self._add_event(chat_id, {'method': method, 'text': params.get('text') or '', 'markup': None,
+                                      'message': None})
+        return 200, {'ok': True, 'result': True}
+
+    def _get_updates(self, params):
+        self.polled.set()
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), 10)
+        with self._updates_cond:
+            # Подтвержденные (update_id < offset) больше не нужны
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_cond.wait(deadline - time.monotonic())
+            return self._updates[:int(params.get('limit') or 100)]
+
+    def _record(self, method, params):
+        chat_id = int(params.get('chat_id') or 0)
+        markup = json.loads(params['reply_markup']) if params.get('reply_markup') else None
+        message_id = int(params['message_id']) if params.get('message_id') else next(self._message_ids)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'from': self.BOT_USER,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text') or params.get('caption') or '',
+        }
+        # В Message бывает только inline-клавиатура, обычная в ответ не попадает
+        if markup and 'inline_keyboard' in markup:
+            message['reply_markup'] = markup
+        reply_to = params.get('reply_to_message_id')
+        if params.get('reply_parameters'):
+            reply_to = json.loads(params['reply_parameters']).get('message_id')
+
+        with self._events_cond:
+            if reply_to and (chat_id, int(reply_to)) in self._messages:
+                message['reply_to_message'] = self._messages[(chat_id, int(reply_to))]
+        self._add_event(chat_id, {'method': method, 'text': message['text'], 'markup': markup, 'message': message})
+        return message
+
+    def _add_event(self, chat_id, event):
+        event['time'] = time.perf_counter()
+        with self._events_cond:
+            self._events.setdefault(chat_id, []).append(event)
+            self._events_cond.notify_all()
+
+
+def start_mocks(latency, error_rate, seed=0, stream_interval=0.02, photo_pool=20):
+    """Запускает все заглушки; latency и error_rate - словари по имени API"""
+    mocks = {
+        'telegram': TelegramMock(latency.get('telegram', 0), error_rate.get('telegram', 0), seed,
+                                 photo_pool=photo_pool),
+        'logmeal': LogmealMock(latency.get('logmeal', 0), error_rate.get('logmeal', 0), seed),
+        'nutritionix': NutritionixMock(latency.get('nutritionix', 0), error_rate.get('nutritionix', 0), seed),
+        'translate': TranslateMock(latency.get('translate', 0), error_rate.get('translate', 0), seed),
+        'together': TogetherMock(latency.get('together', 0), error_rate.get('together', 0), seed,
+                                 stream_interval=stream_interval),
+    }
+    for mock in mocks.values():
+        mock.start()
+    return mocks
+
+
+def mock_env(mocks):
+    """Переменные окружения, которые направляют бота на заглушки"""
+    return {
+        'TELEGRAM_API_URL': mocks['telegram'].url,
+        'LOGMEAL_ENDPOINT': mocks['logmeal'].url + '/v2/image/segmentation/complete',
+        'NUTRITIONIX_ENDPOINT': mocks['nutritionix'].url + '/v2/natural/nutrients',
+        'TRANSLATE_URL': mocks['translate'].url + '/translate_a/single',
+        'TOGETHER_API_ENDPOINT': mocks['together'].url + '/v1/completions',
+    }
@@ -0,0 +1,390 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter
+from datetime import datetime
+
+from benchmark.flows import FLOWS, FlowError, UserSession, new_rng, parse_mix
+from benchmark.mocks import ROOT, start_mocks, mock_env
+
+# Версия формата отчета: меняется, если отчеты разных версий нельзя сравнивать
+REPORT_SCHEMA = 1
+RESULTS_DIR = os.path.join(ROOT, 'benchmark', 'results')
+BOT_TOKEN = '123456:BENCH'
+
+# Задержки внешних API по умолчанию, в секундах (близко к тому, что видно в проде)
+DEFAULT_LATENCY = {'telegram': 0.03, 'logmeal': 0.8, 'nutritionix': 0.15, 'translate': 0.1, 'together': 0.3}
+DEFAULT_MIX = 'photo=3,manual=3,diary=2,recipe=2'
+
+MODES = ('sync', 'webhook', 'async', 'sharded')
+
+
+def parse_per_upstream(value, defaults=None):
+    """'logmeal=0.5,together=1' -> {'logmeal': 0.5, 'together': 1.0, ...остальное из defaults}"""
+    result = dict(defaults or {})
+    for part in filter(None, (value or '').split(',')):
+        name, _, number = part.partition('=')
+        result[name.strip()] = float(number)
+    return result
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class BotProcess:
+    """Бот в отдельном процессе, направленный на заглушки; файлы базы - во временном каталоге"""
+
+    def __init__(self, mode, mocks, workdir, shards=2):
+        self.mode = mode
+        self.mocks = mocks
+        self.workdir = workdir
+        self.log_path = os.path.join(workdir, 'bot.log')
+        self.health_urls = []
+        self.env = dict(os.environ)
+        self.env.update(mock_env(mocks))
+        self.env.update({
+            'TELEGRAM_BOT_TOKEN': BOT_TOKEN,
+            'LOGMEAL_API_KEY': 'bench',
+            'NUTRITIONIX_APP_ID': 'bench',
+            'NUTRITIONIX_APP_KEY': 'bench',
+            'TOGETHER_API_KEY': 'bench',
+            'FOOD_DIARY_DB': os.path.join(workdir, 'food_diary.db'),
+            'FOODS_DB': os.path.join(workdir, 'foods.db'),
+            'PYTHONUNBUFFERED': '1',
+            # Пустые значения, а не удаление: иначе их подставит load_dotenv из .env
+            'WEBHOOK_URL': '',
+            'WEBHOOK_SECRET': '',
+            'NEXT_STEP_SAVE_FILE': '',
+            'METRICS_PORT': '0',
+        })
+
+        bot_script = os.path.join(ROOT, 'Telegram Bot.py')
+        if mode == 'sync':
+            self.command = [sys.executable, bot_script]
+        elif mode == 'async':
+            self.command = [sys.executable, os.path.join(ROOT, 'async_bot.py')]
+        elif mode == 'webhook':
+            port = self._webhook(free_port())
+            self.command = [sys.executable, bot_script, 'webhook']
+            self.health_urls = [f"http://127.0.0.1:{port}/"]
+        elif mode == 'sharded':
+            port = self._webhook(free_port())
+            base_port = free_port()
+            self.env.update({
+                'SHARD_BASE_PORT': str(base_port),
+                'SHARD_STATE_DIR': os.path.join(workdir, '.handler-saves'),
+            })
+            self.command = [sys.executable, os.path.join(ROOT, 'supervisor.py'), '--shards', str(shards)]
+            # Маршрутизатор отвечает сразу, поэтому ждем и сами шарды
+            self.health_urls = [f"http://127.0.0.1:{port}/"] + [
+                f"http://127.0.0.1:{base_port + i}/" for i in range(shards)
+            ]
+        else:
+            raise ValueError(f"Неизвестный режим: {mode}")
+        self.process = None
+
+    def _webhook(self, port):
+        self.env.update({'WEBHOOK_HOST': '127.0.0.1', 'WEBHOOK_PORT': str(port), 'WEBHOOK_PATH': '/telegram'})
+        self.mocks['telegram'].webhook_url = f"http://127.0.0.1:{port}/telegram"
+        return port
+
+    def start(self, timeout=120):
+        with open(self.log_path, 'ab') as log:
+            self.process = subprocess.Popen(self.command, cwd=self.workdir, env=self.env,
+                                            stdout=log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Бот завершился с кодом {self.process.returncode}\n{self.log_tail()}")
+            if self._ready():
+                return
+            time.sleep(0.2)
+        raise RuntimeError(f"Бот не запустился за {timeout} с\n{self.log_tail()}")
+
+    def _ready(self):
+        if not self.health_urls:
+            # В режиме polling бот готов, когда впервые спросил getUpdates
+            return self.mocks['telegram'].polled.is_set()
+        for url in self.health_urls:
+            try:
+                urllib.request.urlopen(url, timeout=1).read()
+            except OSError:
+                return False
+        return True
+
+    def stop(self, timeout=30):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def log_tail(self, lines=30):
+        try:
+            with open(self.log_path, encoding='utf-8', errors='replace') as f:
+                return ''.join(f.readlines()[-lines:])
+        except OSError:
+            return ''
+
+
+def run_user(telegram, chat_id, weights, args, warmup_end, deadline, results, lock):
+    """Один пользователь: сценарии по весам из --mix, пока не выйдет время"""
+    rng = new_rng(args.seed, chat_id)
+    names, flow_weights = list(weights), list(weights.values())
+    # Пользователи стартуют не одновременно, а в течение первой секунды
+    time.sleep(rng.random())
+    while time.monotonic() < deadline:
+        flow = rng.choices(names, flow_weights)[0]
+        session = UserSession(telegram, chat_id, rng, args.step_timeout, args.typing)
+        started_at = time.monotonic()
+        error = None
+        try:
+            FLOWS[flow](session)
+        except FlowError as e:
+            error = str(e) if e.reason == 'timeout' else f"{e.step}: bot error"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:120]
+
+        if started_at >= warmup_end:
+            with lock:
+                results.append({'flow': flow, 'seconds': session.waited(), 'error': error, 'steps': session.steps})
+        if error:
+            session.reset()
+        if args.think:
+            time.sleep(rng.uniform(0, 2 * args.think))
+
+
+def percentile(values, q):
+    """Перцентиль по ближайшему рангу; values отсортированы"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+def latency_summary(seconds):
+    values = sorted(seconds)
+    if not values:
+        return None
+    summary = {f"p{int(q * 100)}": percentile(values, q) for q in (0.5, 0.95, 0.99)}
+    summary['max'] = values[-1]
+    summary['mean'] = sum(values) / len(values)
+    return {key: round(value * 1000, 1) for key, value in summary.items()}
+
+
+def summarize(results, window):
+    """
+    Итоги по сценариям: пропускная способность и задержки только успешных прохождений.
+    Задержка сценария - суммарное ожидание ответов бота, без пауз пользователя.
+    """
+    flows = {}
+    for name in sorted({result['flow'] for result in results}):
+        flow_results = [result for result in results if result['flow'] == name]
+        completed = [result for result in flow_results if not result['error']]
+        steps = {}
+        for result in completed:
+            for step, seconds in result['steps'].items():
+                steps.setdefault(step, []).append(seconds)
+        flows[name] = {
+            'completed': len(completed),
+            'failed': len(flow_results) - len(completed),
+            'throughput_per_s': round(len(completed) / window, 3),
+            'latency_ms': latency_summary([result['seconds'] for result in completed]),
+            'steps_ms': {step: latency_summary(values) for step, values in steps.items()},
+            'errors': dict(Counter(result['error'] for result in flow_results if result['error'])),
+        }
+
+    completed = [result for result in results if not result['error']]
+    total = {
+        'completed': len(completed),
+        'failed': len(results) - len(completed),
+        'throughput_per_s': round(len(completed) / window, 3),
+        'latency_ms': latency_summary([result['seconds'] for result in completed]),
+    }
+    return flows, total
+
+
+def compare_reports(report, baseline, max_regression=None):
+    """
+    Строки сравнения с базовым отчетом и список регрессий: рост p95 или
+    падение пропускной способности больше чем на max_regression процентов.
+    """
+
+    def change(new, old):
+        return (new - old) / old * 100 if old else 0.0
+
+    lines, regressions = [], []
+    if baseline.get('schema') != report['schema']:
+        lines.append(f"⚠️ Формат отчета {baseline.get('schema')} != {report['schema']}, сравнение может быть неточным")
+    for name, flow in sorted(report['flows'].items()):
+        old = baseline.get('flows', {}).get(name)
+        if not old or not old.get('latency_ms') or not flow['latency_ms']:
+            continue
+        p95 = change(flow['latency_ms']['p95'], old['latency_ms']['p95'])
+        throughput = change(flow['throughput_per_s'], old['throughput_per_s'])
+        lines.append(
+            f"{name:8} p50 {change(flow['latency_ms']['p50'], old['latency_ms']['p50']):+6.1f}%"
+            f"  p95 {p95:+6.1f}%  p99 {change(flow['latency_ms']['p99'], old['latency_ms']['p99']):+6.1f}%"
+            f"  rps {throughput:+6.1f}%"
+        )
+        if max_regression is not None and (p95 > max_regression or -throughput > max_regression):
+            regressions.append(name)
+    return lines, regressions
+
+
+def print_summary(report):
+    print(f"\n📊 {report['config']['mode']}, пользователей: {report['config']['users']}, "
+          f"замер: {report['config']['duration']} с")
+    print(f"{'сценарий':8} {'готово':>7} {'ошибок':>7} {'в сек':>7} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8}")
+    for name, flow in sorted(report['flows'].items()) + [('всего', report['total'])]:
+        latency = flow['latency_ms'] or {}
+        print(f"{name:8} {flow['completed']:7} {flow['failed']:7} {flow['throughput_per_s']:7.2f} "
+              f"{latency.get('p50', '-'):>8} {latency.get('p95', '-'):>8} {latency.get('p99', '-'):>8}")
+        for error, count in sorted(flow.get('errors', {}).items(), key=lambda item: -item[1])[:3]:
+            print(f"         ⚠️ {count} × {error}")
+
+
+def run(args):
+    latency = parse_per_upstream(args.latency, DEFAULT_LATENCY)
+    errors = parse_per_upstream(args.errors)
+    weights = parse_mix(args.mix)
+
+    mocks = start_mocks(latency, errors, seed=args.seed, stream_interval=args.stream_interval,
+                        photo_pool=args.photo_pool)
+    workdir = tempfile.mkdtemp(prefix='bot-bench-')
+    bot = BotProcess(args.mode, mocks, workdir, shards=args.shards)
+    try:
+        print(f"🚀 Запуск бота ({args.mode}), каталог {workdir}")
+        bot.start()
+
+        results, lock = [], threading.Lock()
+        started = time.monotonic()
+        warmup_end = started + args.warmup
+        deadline = warmup_end + args.duration
+        users = [
+            threading.Thread(
+                target=run_user, name=f"user-{i}", daemon=True,
+                args=(mocks['telegram'], 100000 + i, weights, args, warmup_end, deadline, results, lock)
+            )
+            for i in range(args.users)
+        ]
+        print(f"👥 Пользователей: {args.users}, прогрев {args.warmup} с, замер {args.duration} с")
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        # Сценарии, начатые до конца замера, дорабатывают после него: делим на фактическое окно
+        window = max(time.monotonic() - warmup_end, args.duration)
+    finally:
+        bot.stop()
+        for mock in mocks.values():
+            mock.stop()
+
+    flows, total = summarize(results, window)
+    return {
+        'schema': REPORT_SCHEMA,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'config': {
+            'mode': args.mode,
+            'shards': args.shards if args.mode == 'sharded' else None,
+            'users': args.users,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'think': args.think,
+            'typing': args.typing,
+            'mix': weights,
+            'latency': latency,
+            'errors': errors,
+            'seed': args.seed,
+            'photo_pool': args.photo_pool,
+            'python': sys.version.split()[0],
+            'cpu_count': os.cpu_count(),
+        },
+        'window_s': round(window, 2),
+        'flows': flows,
+        'total': total,
+        'upstreams': {name: mock.stats() for name, mock in mocks.items()},
+    }, workdir
+
+
+# Пример использования (из корня репозитория):
+#   python -m benchmark.run --mode sync --users 20 --duration 60
+#   python -m benchmark.run --mode sharded --shards 4 --users 100 --latency logmeal=1.5 --errors logmeal=0.05
+#   python -m benchmark.run --mode async --compare benchmark/results/sync-20240101-120000.json --max-regression 10
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушками внешних API")
+    parser.add_argument('--mode', choices=MODES, default='sync', help="как запускать бота")
+    parser.add_argument('--shards', type=int, default=2, help="число шардов в режиме sharded")
+    parser.add_argument('--users', type=int, default=20, help="число одновременных пользователей")
+    parser.add_argument('--duration', type=float, default=60, help="длительность замера, с")
+    parser.add_argument('--warmup', type=float, default=5, help="прогрев без учета результатов, с")
+    parser.add_argument('--think', type=float, default=0.5, help="средняя пауза пользователя между сценариями, с")
+    parser.add_argument('--typing', type=float, default=0.3, help="средняя пауза перед ответом боту внутри сценария, с")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="веса сценариев: photo=3,manual=3,diary=2,recipe=2")
+    parser.add_argument('--latency', help="задержки API, с: telegram=0.03,logmeal=0.8,...")
+    parser.add_argument('--errors', help="доля ошибок API: logmeal=0.05,nutritionix=0.01,...")
+    parser.add_argument('--stream-interval', type=float, default=0.02, help="пауза между кусками потока рецептов, с")
+    parser.add_argument('--photo-pool', type=int, default=20, help="число разных фото (меньше - чаще кэш)")
+    parser.add_argument('--step-timeout', type=float, default=30, help="сколько ждать ответа бота на шаг, с")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="файл отчета (по умолчанию benchmark/results/<режим>-<время>.json)")
+    parser.add_argument('--compare', help="базовый отчет для сравнения")
+    parser.add_argument('--max-regression', type=float,
+                        help="код выхода 1, если p95 вырос или пропускная способность упала больше чем на N%%")
+    parser.add_argument('--keep-workdir', action='store_true', help="не удалять базы и журнал бота")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    report, workdir = run(args)
+    print_summary(report)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{args.mode}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 Отчет: {output}")
+
+    if args.keep_workdir:
+        print(f"📁 Базы и журнал бота: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    exit_code = 0
+    if baseline is not None:
+        lines, regressions = compare_reports(report, baseline, args.max_regression)
+        print(f"\n🔍 Сравнение с {args.compare}:")
+        print('\n'.join(lines) or "нет общих сценариев")
+        if regressions:
+            print(f"❌ Регрессия больше {args.max_regression}%: {', '.join(regressions)}")
+            exit_code = 1
+    sys.exit(exit_code)
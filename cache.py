@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением размера и необязательным TTL"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Возвращает значение по ключу и отмечает его как недавно использованное"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Кладет значение в кэш, вытесняя самые старые записи при переполнении"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Удаляет запись из кэша"""
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        """Снимок ключей (от старых к новым)"""
+        with self._lock:
+            return list(self._data)
+
+    def stats(self):
+        """Возвращает счетчики попаданий и промахов"""
+        with self._lock:
+            size, hits, misses = len(self._data), self.hits, self.misses
+        total = hits + misses
+        return {
+            'size': size,
+            'maxsize': self.maxsize,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / total if total else 0.0
+        }
+
+
+class StatsCounter:
+    """
+    Счетчики статистики, которые увеличиваются из разных потоков
+    (пул бота, run_db, цикл событий): += на dict без блокировки теряет инкременты.
+    """
+
+    def __init__(self, *names):
+        self._counts = dict.fromkeys(names, 0)
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self._counts[name] += value
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._counts[name]
+
+    def snapshot(self):
+        """Согласованная копия всех счетчиков"""
+        with self._lock:
+            return dict(self._counts)
+
+
+class RecognitionCache:
+    """
+    Кэш результатов распознавания фото с двумя ключами:
+    file_unique_id из Telegram (точный повтор или пересланное фото)
+    и перцептивный хэш (то же блюдо, пережатое или чуть обрезанное).
+    """
+
+    def __init__(self, maxsize=5000, ttl=7 * 24 * 3600, max_distance=6):
+        self.max_distance = max_distance
+        self.counts = StatsCounter('exact_hits', 'similar_hits', 'misses')
+        self._by_file_id = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._by_hash = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def get_by_file_id(self, file_unique_id):
+        """Результат для уже виденного файла Telegram"""
+        result = self._by_file_id.get(file_unique_id)
+        if result is not None:
+            self.counts.add('exact_hits')
+        return result
+
+    def get_similar(self, image_hash):
+        """
+        Результат для похожего фото: ближайший хэш с расстоянием
+        Хэмминга не больше max_distance. Промах засчитывается здесь,
+        потому что это последняя проверка перед запросом к Logmeal.
+        """
+        best_hash, best_distance = None, self.max_distance + 1
+        for known_hash in self._by_hash.keys():
+            distance = (known_hash ^ image_hash).bit_count()
+            if distance < best_distance:
+                best_hash, best_distance = known_hash, distance
+
+        result = self._by_hash.get(best_hash) if best_hash is not None else None
+        self.counts.add('similar_hits' if result is not None else 'misses')
+        return result
+
+    def put(self, file_unique_id, image_hash, result):
+        self._by_file_id.set(file_unique_id, result)
+        if image_hash is not None:
+            self._by_hash.set(image_hash, result)
+
+    def stats(self):
+        counts = self.counts.snapshot()
+        hits = counts['exact_hits'] + counts['similar_hits']
+        total = hits + counts['misses']
+        return {
+            'size': len(self._by_file_id),
+            **counts,
+            'hit_ratio': hits / total if total else 0.0
+        }
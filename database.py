@@ -1,108 +1,683 @@
+import atexit
+import itertools
+import os
+import queue
 import sqlite3
+import threading
+import time
+import weakref
 from datetime import datetime
-import requests
+from dotenv import load_dotenv
+import http_client
+import metrics
+from cache import LRUCache
+
+load_dotenv()
+
+# Путь к файлу базы (можно переопределить через .env)
+DB_PATH = os.getenv('FOOD_DIARY_DB', 'food_diary.db')
+
+# Сколько подготовленных SQL-выражений хранит каждое соединение
+STATEMENT_CACHE_SIZE = 128
+
+# Версия схемы в PRAGMA user_version: миграции с полным проходом по таблицам выполняются один раз
+SCHEMA_VERSION = 1
+
+TRANSLATE_URL = os.getenv('TRANSLATE_URL', "https://translate.googleapis.com/translate_a/single")
+
+# Переводы: горячий слой в памяти поверх таблицы translations
+_translation_cache = LRUCache(maxsize=int(os.getenv('TRANSLATION_CACHE_SIZE', 5000)))
+_translation_stats = {'db_hits': 0}
+_translation_stats_lock = threading.Lock()
+
+# Отложенная запись дневника: записи копятся в очереди и сохраняются пачками
+DIARY_WRITE_BEHIND = os.getenv('DIARY_WRITE_BEHIND', '0') == '1'
+DIARY_FLUSH_INTERVAL = float(os.getenv('DIARY_FLUSH_INTERVAL', 0.5))
+DIARY_BATCH_SIZE = int(os.getenv('DIARY_BATCH_SIZE', 500))
+
+# Кэши КБЖУ и рецептов вытесняются не при каждой вставке (COUNT(*) по всей таблице),
+# а раз в CACHE_EVICT_EVERY вставок процесса: таблица может ненадолго превысить лимит на эту величину
+CACHE_EVICT_EVERY = int(os.getenv('CACHE_EVICT_EVERY', 100))
+_nutrition_cache_writes = itertools.count()
+_recipe_cache_writes = itertools.count()
+
+# Дни с записями по месяцам: (chat_id, год, месяц) -> битовая маска дней
+_month_days_cache = LRUCache(maxsize=int(os.getenv('MONTH_DAYS_CACHE_SIZE', 10000)), ttl=600)
+# Поколения ключей кэша (по хэшу ключа, чтобы таблица не росла): запись меняет поколение,
+# и маска, прочитанная до ее коммита, в кэш уже не попадет
+MONTH_DAYS_STRIPES = 1024
+_month_days_generations = [0] * MONTH_DAYS_STRIPES
+_month_days_lock = threading.Lock()
+
+_local = threading.local()
+
+
+class _ThreadConnection:
+    """
+    Соединение потока в threading.local. Когда поток завершается, Python
+    освобождает его local-данные, и финализатор закрывает соединение -
+    короткоживущие потоки (например, обработчики HTTP-сервера метрик) не
+    оставляют после себя открытых файлов.
+    """
+
+    __slots__ = ('conn', 'close', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.close = weakref.finalize(self, conn.close)
+
+
+def _connect():
+    """Открывает соединение и настраивает его под частые короткие запросы"""
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-16000')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA busy_timeout=30000')
+    return conn
+
+
+def get_connection():
+    """
+    Возвращает соединение текущего потока.
+    Соединение открывается один раз на поток и переиспользуется,
+    вместе с ним переиспользуются и подготовленные выражения.
+    Закрывается при завершении потока или в close_connections().
+    """
+    holder = getattr(_local, 'holder', None)
+    if holder is None:
+        holder = _ThreadConnection(_connect())
+        _local.holder = holder
+    return holder.conn
+
+
+def close_connections():
+    """
+    При остановке: дописывает очередь отложенных записей и закрывает соединение
+    текущего потока. Соединения других потоков (конвейер, webhook) не трогаются -
+    они могут еще выполнять запрос; их закроет финализатор, когда поток завершится.
+    """
+    stop_diary_writer()
+    holder = getattr(_local, 'holder', None)
+    if holder is not None:
+        del _local.holder
+        holder.close()
+
 
 def init_db():
-    """Инициализирует базу данных"""
-    conn = sqlite3.connect('food_diary.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS diary (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER,
-        date TEXT,
-        food_name TEXT,
-        portion_grams REAL,
-        calories REAL,
-        protein REAL,
-        fat REAL,
-        carbs REAL,
-        photo_id TEXT
+    """Инициализирует базу данных и применяет миграции схемы"""
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS diary (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            date TEXT,
+            food_name TEXT,
+            portion_grams REAL,
+            calories REAL,
+            protein REAL,
+            fat REAL,
+            carbs REAL,
+            photo_id TEXT,
+            day TEXT
+        )
+        ''')
+
+        # Миграция старых баз: колонка day хранит дату без времени,
+        # чтобы выборки по дню шли по индексу, а не через date(date).
+        # Заполнение day - полный проход по diary, поэтому выполняется один раз
+        # и отмечается в user_version; новые записи пишут day сами
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(diary)')}
+            if 'day' not in columns:
+                conn.execute('ALTER TABLE diary ADD COLUMN day TEXT')
+            conn.execute('UPDATE diary SET day = date(date) WHERE day IS NULL')
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+        _create_diary_indexes(conn)
+
+        # Итоги по дням: обновляются вместе с diary, сводка за день - одна строка по ключу
+        has_totals = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_totals'"
+        ).fetchone()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            chat_id INTEGER,
+            day TEXT,
+            calories REAL,
+            protein REAL,
+            fat REAL,
+            carbs REAL,
+            entry_count INTEGER,
+            PRIMARY KEY (chat_id, day)
+        ) WITHOUT ROWID
+        ''')
+        if not has_totals:
+            _rebuild_daily_totals(conn)
+
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS translations (
+            source TEXT,
+            target_lang TEXT,
+            result TEXT,
+            PRIMARY KEY (source, target_lang)
+        ) WITHOUT ROWID
+        ''')
+
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS nutrition_cache (
+            query TEXT PRIMARY KEY,
+            calories REAL,
+            protein REAL,
+            fat REAL,
+            carbs REAL,
+            serving_weight REAL,
+            created_at REAL,
+            last_used REAL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_nutrition_cache_last_used ON nutrition_cache (last_used)')
+
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            chat_id INTEGER PRIMARY KEY,
+            data BLOB,
+            expires_at REAL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)')
+
+        # Ответы модели с рецептами: несколько вариантов на один набор ингредиентов
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS recipe_cache (
+            ingredients TEXT,
+            variant INTEGER,
+            text TEXT,
+            created_at REAL,
+            last_used REAL,
+            shown_at REAL,
+            PRIMARY KEY (ingredients, variant)
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_recipe_cache_last_used ON recipe_cache (last_used)')
+        # last_used - для вытеснения, shown_at - для ротации (NULL - вариант еще не показывали)
+        recipe_columns = {row[1] for row in conn.execute('PRAGMA table_info(recipe_cache)')}
+        if 'shown_at' not in recipe_columns:
+            conn.execute('ALTER TABLE recipe_cache ADD COLUMN shown_at REAL')
+            conn.execute('UPDATE recipe_cache SET shown_at = NULLIF(last_used, 0)')
+            conn.execute('UPDATE recipe_cache SET last_used = created_at WHERE last_used = 0')
+
+        # Чекпоинты массового импорта: сколько записей файла уже обработано
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_progress (
+            source TEXT PRIMARY KEY,
+            position INTEGER,
+            imported INTEGER,
+            rejected INTEGER
+        )
+        ''')
+
+
+# Индексы diary: при массовом импорте снимаются и строятся заново в конце
+DIARY_INDEXES = {
+    'idx_diary_chat_day': 'diary (chat_id, day)',
+    'idx_diary_chat_date': 'diary (chat_id, date)',
+}
+
+
+def _create_diary_indexes(conn):
+    for name, definition in DIARY_INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
+
+
+def drop_diary_indexes():
+    """Удаляет индексы diary перед массовой вставкой"""
+    conn = get_connection()
+    with conn:
+        for name in DIARY_INDEXES:
+            conn.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+def create_diary_indexes():
+    """Строит индексы diary (после массовой вставки)"""
+    conn = get_connection()
+    with conn:
+        _create_diary_indexes(conn)
+
+
+INSERT_DIARY_SQL = '''
+INSERT INTO diary (chat_id, date, food_name, portion_grams, calories, protein, fat, carbs, photo_id, day)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def _diary_row(chat_id, food_name_ru, portion_grams, nutrition_data, photo_id, now):
+    return (
+        chat_id,
+        now.strftime("%Y-%m-%d %H:%M:%S"),
+        food_name_ru,
+        portion_grams,
+        nutrition_data['calories'],
+        nutrition_data['protein'],
+        nutrition_data['fat'],
+        nutrition_data['carbs'],
+        photo_id,  # Может быть None
+        now.strftime("%Y-%m-%d")
     )
-    ''')
-    conn.commit()
-    conn.close()
 
 
+@metrics.timed('db')
 def save_to_diary(chat_id, food_name, portion_grams, nutrition_data, photo_id=None):
-    """Сохраняет запись в дневник питания (photo_id теперь необязательный)"""
-    conn = sqlite3.connect('food_diary.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    INSERT INTO diary (chat_id, date, food_name, portion_grams, calories, protein, fat, carbs, photo_id)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    Сохраняет запись в дневник питания (photo_id теперь необязательный).
+    В режиме DIARY_WRITE_BEHIND запись только ставится в очередь писателя.
+    """
+    if DIARY_WRITE_BEHIND:
+        _get_diary_writer().enqueue(chat_id, [(food_name, portion_grams, nutrition_data)], photo_id)
+        return
+
+    now = datetime.now()
+    row = _diary_row(chat_id, translate_to_ru(food_name), portion_grams, nutrition_data, photo_id, now)
+    conn = get_connection()
+    with conn:
+        conn.execute(INSERT_DIARY_SQL, row)
+        _add_to_daily_totals(conn, chat_id, row[9], nutrition_data, 1)
+    _invalidate_month_days(chat_id, row[9])
+
+
+@metrics.timed('db')
+def insert_diary_rows(rows, source=None, position=0, rejected=0):
+    """
+    Вставляет готовые строки (формат _diary_row) одной транзакцией.
+    Названия не переводятся, daily_totals не обновляется - после
+    массовой вставки итоги пересчитываются rebuild_daily_totals().
+    Если указан source, в той же транзакции сохраняется прогресс импорта,
+    так что после сбоя пачка не загрузится дважды.
+    """
+    conn = get_connection()
+    with conn:
+        conn.executemany(INSERT_DIARY_SQL, rows)
+        if source is not None:
+            conn.execute('''
+            INSERT INTO import_progress (source, position, imported, rejected)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (source) DO UPDATE SET
+                position = excluded.position,
+                imported = imported + excluded.imported,
+                rejected = excluded.rejected
+            ''', (source, position, len(rows), rejected))
+
+
+@metrics.timed('db')
+def get_import_progress(source):
+    """Возвращает (позиция, загружено, отклонено) незавершенного импорта или None"""
+    return get_connection().execute(
+        'SELECT position, imported, rejected FROM import_progress WHERE source = ?', (source,)
+    ).fetchone()
+
+
+@metrics.timed('db')
+def delete_import_progress(source):
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM import_progress WHERE source = ?', (source,))
+
+
+@metrics.timed('db')
+def save_meal_to_diary(chat_id, items, photo_id=None):
+    """
+    Сохраняет несколько блюд одного приема пищи одной транзакцией.
+    items - список (food_name, portion_grams, nutrition_data).
+    """
+    if not items:
+        return
+    now = datetime.now()
+    if DIARY_WRITE_BEHIND:
+        _get_diary_writer().enqueue(chat_id, items, photo_id, now)
+        return
+
+    rows = [_diary_row(chat_id, translate_to_ru(food_name), portion_grams, nutrition_data, photo_id, now)
+            for food_name, portion_grams, nutrition_data in items]
+    totals = {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
+    for _, _, nutrition_data in items:
+        for key in totals:
+            totals[key] += nutrition_data[key]
+
+    conn = get_connection()
+    with conn:
+        conn.executemany(INSERT_DIARY_SQL, rows)
+        _add_to_daily_totals(conn, chat_id, rows[0][9], totals, len(rows))
+    _invalidate_month_days(chat_id, rows[0][9])
+
+
+class DiaryWriter:
+    """
+    Писатель дневника в отдельном потоке: забирает записи из очереди и
+    сохраняет их пачками (executemany в одной транзакции). Чтения по чату
+    с несохраненными записями сначала дожидаются их записи.
+    """
+
+    # Сколько раз повторять пачку, если база занята
+    RETRIES = 3
+
+    def __init__(self, flush_interval=DIARY_FLUSH_INTERVAL, batch_size=DIARY_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._pending = {}  # chat_id -> число несохраненных записей
+        self._cond = threading.Condition()
+        self._flush_now = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="diary-writer", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, chat_id, items, photo_id=None, now=None):
+        """
+        Ставит записи в очередь. items - список (food_name, portion_grams, nutrition_data).
+        Строки собираются и проверяются здесь, в потоке вызывающего: ошибка
+        в данных (нет ключа, не число) достается ему, а не потоку писателя.
+        """
+        now = now or datetime.now()
+        rows = [
+            _diary_row(chat_id, food_name, float(portion_grams),
+                       {key: float(nutrition_data[key]) for key in ('calories', 'protein', 'fat', 'carbs')},
+                       photo_id, now)
+            for food_name, portion_grams, nutrition_data in items
+        ]
+        with self._cond:
+            self._pending[chat_id] = self._pending.get(chat_id, 0) + len(rows)
+        for row in rows:
+            self._queue.put(row)
+
+    def wait_for_chat(self, chat_id):
+        """Дожидается сохранения всех записей чата (чтение своих записей)"""
+        with self._cond:
+            if not self._pending.get(chat_id):
+                return
+            self._flush_now.set()
+            self._cond.wait_for(lambda: not self._pending.get(chat_id))
+
+    def stop(self):
+        """Сохраняет все, что осталось в очереди, и останавливает поток"""
+        self._queue.put(None)
+        self._flush_now.set()
+        self._thread.join()
+
+    def _collect(self):
+        """Собирает пачку: до batch_size записей или пока не истечет flush_interval"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            timeout = 0 if self._flush_now.is_set() else deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._flush_now.clear()
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            stopping = batch[-1] is None
+            rows = [row for row in batch if row is not None]
+            if rows:
+                try:
+                    self._write(rows)
+                except Exception as e:
+                    # Поток писателя не должен умирать: без него зависнут все wait_for_chat
+                    print(f"⚠️ Ошибка писателя дневника: {e}")
+            if stopping:
+                return
+
+    @metrics.timed('db', 'diary_writer_flush')
+    def _write(self, rows):
+        """
+        Сохраняет пачку одной транзакцией; если не вышло - по одной строке,
+        чтобы ошибка в одной записи не стоила записей других чатов.
+        Несохраненная строка попадает в лог целиком. Ожидающие чтения
+        отпускаются в любом случае.
+        """
+        try:
+            rows = [self._translated(row) for row in rows]
+            try:
+                self._insert(rows)
+            except Exception as e:
+                print(f"⚠️ Не удалось сохранить пачку из {len(rows)} записей дневника, сохраняю по одной: {e}")
+                for row in rows:
+                    try:
+                        self._insert([row])
+                    except Exception as e:
+                        print(f"❌ Запись дневника потеряна: {row}: {e}")
+            for chat_id, day in {(row[0], row[9]) for row in rows}:
+                _invalidate_month_days(chat_id, day)
+        finally:
+            with self._cond:
+                for row in rows:
+                    self._pending[row[0]] -= 1
+                    if not self._pending[row[0]]:
+                        del self._pending[row[0]]
+                self._cond.notify_all()
+
+    @staticmethod
+    def _translated(row):
+        try:
+            return row[:2] + (translate_to_ru(row[2]),) + row[3:]
+        except Exception:
+            return row  # запись важнее перевода
+
+    def _insert(self, rows):
+        """Строки и итоги их дней - одной транзакцией; занятую базу повторяет RETRIES раз"""
+        totals = {}
+        for row in rows:
+            day_totals = totals.setdefault((row[0], row[9]), {'calories': 0, 'protein': 0, 'fat': 0,
+                                                              'carbs': 0, 'entries': 0})
+            day_totals['calories'] += row[4]
+            day_totals['protein'] += row[5]
+            day_totals['fat'] += row[6]
+            day_totals['carbs'] += row[7]
+            day_totals['entries'] += 1
+
+        for attempt in range(self.RETRIES):
+            try:
+                conn = get_connection()
+                with conn:
+                    conn.executemany(INSERT_DIARY_SQL, rows)
+                    for (chat_id, day), day_totals in totals.items():
+                        _add_to_daily_totals(conn, chat_id, day, day_totals, day_totals['entries'])
+                return
+            except sqlite3.OperationalError as e:
+                if attempt == self.RETRIES - 1:
+                    raise
+                print(f"⚠️ База занята, повтор записи {len(rows)} строк дневника: {e}")
+                time.sleep(1 + attempt)
+
+
+_diary_writer = None
+_diary_writer_lock = threading.Lock()
+
+
+def _get_diary_writer():
+    global _diary_writer
+    if _diary_writer is None:
+        with _diary_writer_lock:
+            if _diary_writer is None:
+                _diary_writer = DiaryWriter()
+    return _diary_writer
+
+
+def _wait_for_pending_writes(chat_id):
+    if _diary_writer is not None:
+        _diary_writer.wait_for_chat(chat_id)
+
+
+def stop_diary_writer():
+    """Дописывает очередь отложенных записей на диск и останавливает писателя"""
+    global _diary_writer
+    with _diary_writer_lock:
+        if _diary_writer is not None:
+            _diary_writer.stop()
+            _diary_writer = None
+
+
+atexit.register(stop_diary_writer)
+
+
+def _add_to_daily_totals(conn, chat_id, day, nutrition_data, entry_count):
+    """Прибавляет КБЖУ к итогам дня (для удаления - с отрицательными значениями)"""
+    conn.execute('''
+    INSERT INTO daily_totals (chat_id, day, calories, protein, fat, carbs, entry_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (chat_id, day) DO UPDATE SET
+        calories = calories + excluded.calories,
+        protein = protein + excluded.protein,
+        fat = fat + excluded.fat,
+        carbs = carbs + excluded.carbs,
+        entry_count = entry_count + excluded.entry_count
     ''', (
         chat_id,
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        translate_to_ru(food_name),
-        portion_grams,
+        day,
         nutrition_data['calories'],
         nutrition_data['protein'],
         nutrition_data['fat'],
         nutrition_data['carbs'],
-        photo_id  # Может быть None
+        entry_count
     ))
-    conn.commit()
-    conn.close()
+    if entry_count < 0:
+        conn.execute(
+            'DELETE FROM daily_totals WHERE chat_id = ? AND day = ? AND entry_count <= 0',
+            (chat_id, day)
+        )
 
 
-def get_dates_with_entries(chat_id):
-    """Возвращает список дат, в которые есть записи"""
-    conn = sqlite3.connect('food_diary.db')
-    cursor = conn.cursor()
+def _rebuild_daily_totals(conn):
+    conn.execute('DELETE FROM daily_totals')
+    conn.execute('''
+    INSERT INTO daily_totals (chat_id, day, calories, protein, fat, carbs, entry_count)
+    SELECT chat_id, day, SUM(calories), SUM(protein), SUM(fat), SUM(carbs), COUNT(*)
+    FROM diary
+    GROUP BY chat_id, day
+    ''')
+
+
+@metrics.timed('db')
+def rebuild_daily_totals():
+    """Пересчитывает daily_totals по всем записям дневника"""
+    conn = get_connection()
+    with conn:
+        _rebuild_daily_totals(conn)
+    with _month_days_lock:
+        for stripe in range(MONTH_DAYS_STRIPES):
+            _month_days_generations[stripe] += 1
+        _month_days_cache.clear()
+    return conn.execute('SELECT COUNT(*) FROM daily_totals').fetchone()[0]
 
-    cursor.execute('''
-    SELECT DISTINCT date(date) as entry_date 
-    FROM diary 
-    WHERE chat_id = ?
-    ORDER BY entry_date DESC
-    ''', (chat_id,))
 
-    dates = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return dates
+def _invalidate_month_days(chat_id, day):
+    year, month, _ = day.split('-')
+    key = (chat_id, int(year), int(month))
+    with _month_days_lock:
+        _month_days_generations[hash(key) % MONTH_DAYS_STRIPES] += 1
+        _month_days_cache.pop(key)
 
+
+@metrics.timed('db')
+def get_month_days(chat_id, year, month):
+    """
+    Возвращает битовую маску дней месяца с записями (бит N - N-е число).
+    Результат кэшируется до ближайшего сохранения или удаления записи в этом месяце.
+    """
+    _wait_for_pending_writes(chat_id)
+    key = (chat_id, year, month)
+    days = _month_days_cache.get(key)
+    if days is not None:
+        return days
+
+    stripe = hash(key) % MONTH_DAYS_STRIPES
+    generation = _month_days_generations[stripe]
+    first_day = f"{year}-{month:02d}-01"
+    next_month = f"{year + month // 12}-{month % 12 + 1:02d}-01"
+    cursor = get_connection().execute('''
+    SELECT day FROM daily_totals
+    WHERE chat_id = ? AND day >= ? AND day < ?
+    ''', (chat_id, first_day, next_month))
+
+    days = 0
+    for (day,) in cursor:
+        days |= 1 << int(day[8:10])
+    # Пока шел запрос, запись в этом месяце могла закоммититься: такую маску не кэшируем
+    with _month_days_lock:
+        if _month_days_generations[stripe] == generation:
+            _month_days_cache.set(key, days)
+    return days
+
+
+@metrics.timed('db')
 def get_diary_entries(chat_id, date=None):
     """Возвращает записи дневника за указанную дату (или все)"""
-    conn = sqlite3.connect('food_diary.db')
-    cursor = conn.cursor()
+    _wait_for_pending_writes(chat_id)
+    conn = get_connection()
 
     if date:
-        # Ищем записи за конкретную дату (без времени)
-        cursor.execute('''
+        # Диапазон по (chat_id, date): записи дня уже отсортированы в индексе
+        cursor = conn.execute('''
         SELECT * FROM diary 
-        WHERE chat_id = ? AND date(date) = ?
+        WHERE chat_id = ? AND date >= ? AND date < date(?, '+1 day')
         ORDER BY date DESC
-        ''', (chat_id, date))
+        ''', (chat_id, date, date))
     else:
-        cursor.execute('''
+        cursor = conn.execute('''
         SELECT * FROM diary 
         WHERE chat_id = ? 
         ORDER BY date DESC
         ''', (chat_id,))
 
-    entries = cursor.fetchall()
-    conn.close()
-    return entries
+    return cursor.fetchall()
 
 
+def iter_diary_entries(chat_id, chunk_size=1000):
+    """
+    Отдает записи чата кусками по chunk_size в хронологическом порядке.
+    SQLite читает строки по мере fetchmany, поэтому вся история
+    в память не загружается.
+    """
+    _wait_for_pending_writes(chat_id)
+    cursor = get_connection().execute('''
+    SELECT date, food_name, portion_grams, calories, protein, fat, carbs
+    FROM diary
+    WHERE chat_id = ?
+    ORDER BY date
+    ''', (chat_id,))
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cursor.close()
+
+
+@metrics.timed('db')
 def get_daily_summary(chat_id, date):
     """Возвращает суммарную статистику за указанный день"""
-    conn = sqlite3.connect('food_diary.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-    SELECT 
-        SUM(calories) as total_calories,
-        SUM(protein) as total_protein,
-        SUM(fat) as total_fat,
-        SUM(carbs) as total_carbs
-    FROM diary 
-    WHERE chat_id = ? AND date(date) = ?
-    ''', (chat_id, date))
-
-    summary = cursor.fetchone()
-    conn.close()
+    _wait_for_pending_writes(chat_id)
+    summary = get_connection().execute('''
+    SELECT calories, protein, fat, carbs
+    FROM daily_totals
+    WHERE chat_id = ? AND day = ?
+    ''', (chat_id, date)).fetchone()
+
+    if not summary:
+        return {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
 
     return {
         'calories': summary[0] or 0,
@@ -114,46 +689,183 @@ def get_daily_summary(chat_id, date):
 
 def get_today_summary(chat_id):
     """Возвращает суммарные КБЖУ за сегодня"""
-    conn = sqlite3.connect('food_diary.db')
-    cursor = conn.cursor()
-
     today = datetime.now().strftime("%Y-%m-%d")
-    cursor.execute('''
-    SELECT 
-        SUM(calories) as total_calories,
-        SUM(protein) as total_protein,
-        SUM(fat) as total_fat,
-        SUM(carbs) as total_carbs
-    FROM diary 
-    WHERE chat_id = ? AND date(date) = ?
-    ''', (chat_id, today))
-
-    summary = cursor.fetchone()
-    conn.close()
+    return get_daily_summary(chat_id, today)
+
+@metrics.timed('db')
+def delete_diary_entry(entry_id, chat_id):
+    """Удаляет запись из дневника по ID"""
+    _wait_for_pending_writes(chat_id)
+    conn = get_connection()
+    with conn:
+        entry = conn.execute(
+            'SELECT day, calories, protein, fat, carbs FROM diary WHERE id = ? AND chat_id = ?',
+            (entry_id, chat_id)
+        ).fetchone()
+        if not entry:
+            return
+
+        conn.execute('DELETE FROM diary WHERE id = ? AND chat_id = ?', (entry_id, chat_id))
+        _add_to_daily_totals(conn, chat_id, entry[0], {
+            'calories': -entry[1],
+            'protein': -entry[2],
+            'fat': -entry[3],
+            'carbs': -entry[4]
+        }, -1)
+    _invalidate_month_days(chat_id, entry[0])
+
+
+@metrics.timed('db')
+def get_cached_nutrition(query, ttl):
+    """Возвращает КБЖУ на порцию из кэша или None, если записи нет или она устарела"""
+    conn = get_connection()
+    row = conn.execute('''
+    SELECT calories, protein, fat, carbs, serving_weight, created_at
+    FROM nutrition_cache
+    WHERE query = ?
+    ''', (query,)).fetchone()
+    if not row:
+        return None
+
+    now = time.time()
+    with conn:
+        if now - row[5] > ttl:
+            conn.execute('DELETE FROM nutrition_cache WHERE query = ?', (query,))
+            return None
+        conn.execute('UPDATE nutrition_cache SET last_used = ? WHERE query = ?', (now, query))
 
     return {
-        'calories': summary[0] or 0,
-        'protein': summary[1] or 0,
-        'fat': summary[2] or 0,
-        'carbs': summary[3] or 0
+        'calories': row[0],
+        'protein': row[1],
+        'fat': row[2],
+        'carbs': row[3],
+        'serving_weight': row[4]
     }
 
-def delete_diary_entry(entry_id, chat_id):
-    """Удаляет запись из дневника по ID"""
-    conn = sqlite3.connect('food_diary.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM diary WHERE id = ? AND chat_id = ?', (entry_id, chat_id))
-    conn.commit()
-    conn.close()
 
+@metrics.timed('db')
+def save_cached_nutrition(query, nutrition_data, max_entries):
+    """Сохраняет КБЖУ в кэш; раз в CACHE_EVICT_EVERY вставок вытесняет давно не использованные записи"""
+    now = time.time()
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+        INSERT OR REPLACE INTO nutrition_cache
+            (query, calories, protein, fat, carbs, serving_weight, created_at, last_used)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            query,
+            nutrition_data['calories'],
+            nutrition_data['protein'],
+            nutrition_data['fat'],
+            nutrition_data['carbs'],
+            nutrition_data['serving_weight'],
+            now,
+            now
+        ))
+        if next(_nutrition_cache_writes) % CACHE_EVICT_EVERY:
+            return
+        conn.execute('''
+        DELETE FROM nutrition_cache
+        WHERE query IN (
+            SELECT query FROM nutrition_cache
+            ORDER BY last_used ASC
+            LIMIT max((SELECT COUNT(*) FROM nutrition_cache) - ?, 0)
+        )
+        ''', (max_entries,))
 
-def translate_to_ru(text: str, target_lang: str = "ru") -> str:
+
+@metrics.timed('db')
+def get_nutrition_cache_size():
+    """Количество записей в постоянном кэше КБЖУ"""
+    return get_connection().execute('SELECT COUNT(*) FROM nutrition_cache').fetchone()[0]
+
+
+@metrics.timed('db')
+def get_cached_recipe_variants(ingredients, ttl):
     """
-    Улучшенный перевод через Google Translate API
+    Свежие варианты рецептов для набора ингредиентов: [(variant, text)],
+    сначала еще не показанные, затем те, что дольше всех не показывали. Устаревшие удаляются.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM recipe_cache WHERE ingredients = ? AND created_at < ?',
+                     (ingredients, time.time() - ttl))
+    return conn.execute('''
+    SELECT variant, text FROM recipe_cache
+    WHERE ingredients = ?
+    ORDER BY shown_at ASC, variant ASC
+    ''', (ingredients,)).fetchall()
+
+
+@metrics.timed('db')
+def touch_cached_recipe(ingredients, variant):
+    """Отмечает вариант как показанный (для ротации и вытеснения)"""
+    conn = get_connection()
+    with conn:
+        now = time.time()
+        conn.execute('UPDATE recipe_cache SET last_used = ?, shown_at = ? WHERE ingredients = ? AND variant = ?',
+                     (now, now, ingredients, variant))
+
+
+@metrics.timed('db')
+def save_cached_recipe(ingredients, text, max_entries, shown=True):
+    """
+    Добавляет новый вариант рецептов; раз в CACHE_EVICT_EVERY вставок вытесняет
+    давно не использованные записи.
+    Новый вариант считается свежим для вытеснения в любом случае, а еще
+    не показанный (shown=False) при ротации будет выбран первым.
+    """
+    now = time.time()
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+        INSERT INTO recipe_cache (ingredients, variant, text, created_at, last_used, shown_at)
+        VALUES (?, (SELECT COALESCE(MAX(variant), 0) + 1 FROM recipe_cache WHERE ingredients = ?), ?, ?, ?, ?)
+        ''', (ingredients, ingredients, text, now, now, now if shown else None))
+        if next(_recipe_cache_writes) % CACHE_EVICT_EVERY:
+            return
+        conn.execute('''
+        DELETE FROM recipe_cache
+        WHERE rowid IN (
+            SELECT rowid FROM recipe_cache
+            ORDER BY last_used ASC
+            LIMIT max((SELECT COUNT(*) FROM recipe_cache) - ?, 0)
+        )
+        ''', (max_entries,))
+
+
+@metrics.timed('db')
+def get_recipe_cache_size():
+    """Количество вариантов в кэше рецептов"""
+    return get_connection().execute('SELECT COUNT(*) FROM recipe_cache').fetchone()[0]
+
+
+@metrics.timed('db')
+def get_known_food_names(limit=None):
+    """
+    Названия блюд из дневника (самые частые первыми) вместе с английским
+    исходником из кэша переводов, если он там есть: [(название, source или None)]
     """
-    url = "https://translate.googleapis.com/translate_a/single"
+    cursor = get_connection().execute('''
+    SELECT names.food_name, MIN(translations.source)
+    FROM (
+        SELECT food_name, COUNT(*) AS uses
+        FROM diary
+        GROUP BY food_name
+        ORDER BY uses DESC
+        LIMIT ?
+    ) AS names
+    LEFT JOIN translations ON translations.target_lang = 'ru' AND translations.result = names.food_name
+    GROUP BY names.food_name
+    ORDER BY MAX(names.uses) DESC
+    ''', (limit if limit else -1,))
+    return cursor.fetchall()
 
-    params = {
+
+def build_translation_params(text, target_lang):
+    """Параметры запроса к Google Translate"""
+    return {
         "client": "gtx",
         "sl": "auto",
         "tl": target_lang,
@@ -164,40 +876,146 @@ def translate_to_ru(text: str, target_lang: str = "ru") -> str:
         "dj": "1"
     }
 
-    response = requests.get(url, params=params)
+
+def parse_translation_response(result):
+    """Достает перевод из ответа Google Translate; None, если перевода нет"""
+    if 'sentences' in result:
+        return ' '.join(s['trans'] for s in result['sentences'])
+    return None
+
+
+@metrics.timed('db')
+def get_session_data(chat_id):
+    """Данные незавершенной записи пользователя или None, если их нет или они устарели"""
+    row = get_connection().execute(
+        'SELECT data FROM sessions WHERE chat_id = ? AND expires_at > ?', (chat_id, time.time())
+    ).fetchone()
+    return row[0] if row else None
+
+
+@metrics.timed('db')
+def save_session_data(chat_id, data, ttl):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO sessions (chat_id, data, expires_at) VALUES (?, ?, ?)',
+            (chat_id, data, time.time() + ttl)
+        )
+
+
+@metrics.timed('db')
+def delete_session_data(chat_id):
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM sessions WHERE chat_id = ?', (chat_id,))
+
+
+@metrics.timed('db')
+def purge_sessions(max_entries):
+    """Удаляет устаревшие сессии и самые старые сверх max_entries"""
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),))
+        conn.execute('''
+        DELETE FROM sessions
+        WHERE chat_id IN (
+            SELECT chat_id FROM sessions
+            ORDER BY expires_at ASC
+            LIMIT max((SELECT COUNT(*) FROM sessions) - ?, 0)
+        )
+        ''', (max_entries,))
+
+
+def _request_translation(text, target_lang):
+    """Запрос к Google Translate; возвращает None, если перевода в ответе нет"""
+    params = build_translation_params(text, target_lang)
+
+    response = http_client.get('translate', TRANSLATE_URL, params=params)
     if response.status_code != 200:
         raise Exception(f"API Error: {response.text}")
 
     try:
-        result = response.json()
-        if 'sentences' in result:
-            return ' '.join(s['trans'] for s in result['sentences'])
-        return text
+        return parse_translation_response(response.json())
     except:
+        return None
+
+
+@metrics.timed('db')
+def get_cached_translation(text, target_lang):
+    """Ищет перевод в памяти, затем в таблице translations; None, если не найден"""
+    key = (text, target_lang)
+    cached = _translation_cache.get(key)
+    if cached is not None:
+        return cached
+
+    row = get_connection().execute(
+        'SELECT result FROM translations WHERE source = ? AND target_lang = ?', key
+    ).fetchone()
+    if row:
+        with _translation_stats_lock:
+            _translation_stats['db_hits'] += 1
+        _translation_cache.set(key, row[0])
+        return row[0]
+    return None
+
+
+@metrics.timed('db')
+def save_translation(text, target_lang, result):
+    """Запоминает перевод в обоих уровнях кэша"""
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO translations (source, target_lang, result) VALUES (?, ?, ?)',
+            (text, target_lang, result)
+        )
+    _translation_cache.set((text, target_lang), result)
+
+
+def _translate(text, target_lang):
+    """
+    Перевод с двумя уровнями кэша: LRU в памяти и таблица translations.
+    В сеть уходят только тексты, которые еще ни разу не переводились.
+    """
+    cached = get_cached_translation(text, target_lang)
+    if cached is not None:
+        return cached
+
+    result = _request_translation(text, target_lang)
+    if result is None:
         return text
 
+    save_translation(text, target_lang, result)
+    return result
+
+
+def get_translation_cache_stats():
+    """Статистика кэша переводов: попадания в памяти, в базе и сетевые запросы"""
+    stats = _translation_cache.stats()
+    with _translation_stats_lock:
+        stats['db_hits'] = _translation_stats['db_hits']
+    # Каждый промах памяти - это либо попадание в базу, либо запрос в сеть
+    stats['requests'] = stats['misses'] - stats['db_hits']
+    return stats
+
+
+def translate_to_ru(text: str, target_lang: str = "ru") -> str:
+    """
+    Улучшенный перевод через Google Translate API
+    """
+    return _translate(text, target_lang)
+
 def translate_to_en(text: str, target_lang: str = "en") -> str:
-    url = "https://translate.googleapis.com/translate_a/single"
+    return _translate(text, target_lang)
 
-    params = {
-        "client": "gtx",
-        "sl": "auto",
-        "tl": target_lang,
-        "dt": "t",
-        "q": text,
-        "ie": "UTF-8",
-        "oe": "UTF-8",
-        "dj": "1"
-    }
 
-    response = requests.get(url, params=params)
-    if response.status_code != 200:
-        raise Exception(f"API Error: {response.text}")
+if __name__ == '__main__':
+    import argparse
 
-    try:
-        result = response.json()
-        if 'sentences' in result:
-            return ' '.join(s['trans'] for s in result['sentences'])
-        return text
-    except:
-        return text
+    parser = argparse.ArgumentParser(description="Обслуживание базы дневника питания")
+    parser.add_argument('command', choices=['rebuild-totals'])
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == 'rebuild-totals':
+        print(f"📊 Пересчитано дней: {rebuild_daily_totals()}")
+    close_connections()
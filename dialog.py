@@ -0,0 +1,370 @@
+from export import EXPORT_FORMATS
+from fuzzy import normalize as normalize_food_name
+from nutrition import calculate_nutrition
+
+# --- Логика диалога, общая для обоих ботов --- #
+# Тексты ответов, разбор ввода и решения по шагам сценария. Здесь нет обращений
+# к Telegram, сети и базе: "Telegram Bot.py" и async_bot.py отличаются только вводом-выводом.
+
+WELCOME_TEXT = (
+    "🍏 Добро пожаловать в Calorie Master!\n\n"
+    "Вы можете:\n"
+    "1. 📸 Отправить фото еды для анализа\n"
+    "2. ✍️ Ввести продукт вручную\n"
+    "3. 📅 Просматривать дневник питания\n"
+    "4. 📤 Выгрузить дневник командой /export\n\n"
+    "Выберите действие:"
+)
+MENU_TEXT = "Главное меню:"
+CALENDAR_TEXT = "📅 Выберите дату для просмотра записей:"
+NO_ENTRIES_TODAY_TEXT = "Сегодня еще нет записей в дневнике 🍽"
+EMPTY_EXPORT_TEXT = "🍽 В дневнике пока нет записей"
+ASK_INGREDIENTS_TEXT = (
+    "📝 Перечислите продукты через запятую:\n"
+    "Пример: <i>яйца, молоко, мука, сыр</i>"
+)
+RECIPES_PENDING_TEXT = "🧠 Придумываю рецепты..."
+NEW_PHOTO_TEXT = "📸 Пожалуйста, сделайте новое фото еды (лучше освещение, крупный план)"
+ASK_FOOD_NAME_TEXT = (
+    "📝 Введите название продукта или блюда:\n"
+    "Пример: <i>банан, овсяная каша, куриная грудка</i>"
+)
+SUGGESTIONS_TEXT = "🤔 Возможно, вы имели в виду:"
+PORTION_FORMAT_TEXT = "🔢 Пожалуйста, введите число (например: 200)"
+MEAL_PORTIONS_FORMAT_TEXT = "🔢 Пожалуйста, введите числа через пробел (например: 150 100)"
+SESSION_EXPIRED_TEXT = "❌ Сессия устарела"
+SAVED_TEXT = "✅ Сохранено в дневник!"
+ENTRY_SAVED_TEXT = "🍽 Запись добавлена в дневник"
+MEAL_SAVED_TEXT = "🍽 Прием пищи добавлен в дневник"
+ENTRY_DELETED_TEXT = "✅ Запись удалена!"
+
+# Ниже этой уверенности Logmeal КБЖУ не ищутся: пользователю предлагают переснять фото
+MIN_RECOGNITION_PROB = 0.5
+
+
+class SessionExpired(Exception):
+    def __init__(self):
+        super().__init__("Сессия устарела")
+
+
+def format_error(error):
+    return f"❌ Ошибка: {str(error)}"
+
+
+def is_menu_request(text):
+    """Пользователь вышел из шага диалога словом 'меню'"""
+    return text.lower() == 'меню'
+
+
+def format_nutrition_response(food_name_ru, nutrition_data, portion_grams):
+    """Форматирует ответ с КБЖУ"""
+    return (
+        f"🍏 {food_name_ru}\n"
+        f"⚖️ Порция: {portion_grams}г\n\n"
+        f"Энергетическая ценность:\n"
+        f"🔥 {nutrition_data['calories']} ккал\n"
+        f"🥩 {nutrition_data['protein']}г белков\n"
+        f"🥑 {nutrition_data['fat']}г жиров\n"
+        f"🍞 {nutrition_data['carbs']}г углеводов"
+    )
+
+
+# --- Дневник --- #
+
+def format_no_entries(date_str):
+    return f"🍽 Нет записей за {date_str}"
+
+
+def format_day_entries(date_str, entries, summary):
+    """Записи за день и итог (строки get_diary_entries и get_daily_summary)"""
+    message = f"📅 Дневник питания за {date_str}:\n\n"
+
+    for entry in entries:
+        message += (
+            f"⏰ {entry[2].split()[1][:5]} | {entry[3]}\n"
+            f"⚖️ {entry[4]}г | 🔥 {entry[5]} ккал\n"
+            f"🥩 {entry[6]}г белков | 🥑 {entry[7]}г жиров | 🍞 {entry[8]}г углеводов\n\n"
+        )
+
+    message += (
+        f"📊 Итого за день:\n"
+        f"🔥 {summary['calories']:.0f} ккал\n"
+        f"🥩 {summary['protein']:.1f}г белков\n"
+        f"🥑 {summary['fat']:.1f}г жиров\n"
+        f"🍞 {summary['carbs']:.1f}г углеводов"
+    )
+    return message
+
+
+def parse_day_entries_date(text):
+    """Дата из сообщения format_day_entries (кнопки удаления не хранят дату)"""
+    return text.split("за ")[1].split(":")[0].strip()
+
+
+def parse_entry_callback(data):
+    """'delete_<id>' -> id записи"""
+    return int(data.split('_')[1])
+
+
+def parse_day_callback(data):
+    """'day_<YYYY-MM-DD>' -> дата"""
+    return data.split('_')[1]
+
+
+def parse_month_callback(data):
+    """'month_<год>_<месяц>' -> (год, месяц)"""
+    _, year, month = data.split('_')
+    return int(year), int(month)
+
+
+def format_today_summary(today_stats):
+    """Сводка за сегодня (HTML) или None, если записей нет"""
+    if today_stats['calories'] == 0:
+        return None
+
+    return (
+        "📊 <b>Съедено сегодня:</b>\n\n"
+        f"🔥 <b>Калории:</b> {today_stats['calories']:.0f} ккал\n"
+        f"🥩 <b>Белки:</b> {today_stats['protein']:.1f}г\n"
+        f"🧈 <b>Жиры:</b> {today_stats['fat']:.1f}г\n"
+        f"🍞 <b>Углеводы:</b> {today_stats['carbs']:.1f}г\n\n"
+        "Чтобы добавить запись, отправьте фото еды 📸"
+    )
+
+
+def parse_export_args(text):
+    """Разбирает '/export [csv|jsonl] [gz]' в (формат, сжатие)"""
+    args = text.split()[1:]
+    fmt = next((arg for arg in args if arg in EXPORT_FORMATS), 'csv')
+    compress = any(arg in ('gz', 'gzip') for arg in args)
+    return fmt, compress
+
+
+def format_export_caption(count):
+    return f"📤 Дневник питания: {count} записей"
+
+
+# --- Фото --- #
+
+def is_uncertain(logmeal_data):
+    """Распознавание слишком неуверенное, чтобы искать КБЖУ"""
+    return logmeal_data.get('prob', 1.0) < MIN_RECOGNITION_PROB
+
+
+def format_uncertain_photo(food_name_ru, prob):
+    return (
+        f"🤔 Я не уверен, что это ({food_name_ru})\n"
+        f"Вероятность распознавания: {prob * 100:.0f}%\n\n"
+        "Попробуйте сделать более четкое фото или введите название вручную:"
+    )
+
+
+def attach_nutrition(items, nutrition):
+    """
+    Позиции фото с КБЖУ (nutrition - в том же порядке, что items).
+    Позиции без КБЖУ отбрасываются; если не осталось ни одной - ошибка.
+    """
+    items = [dict(item, nutrition_data=nutrition_data)
+             for item, nutrition_data in zip(items, nutrition) if nutrition_data]
+    if not items:
+        raise Exception("Не удалось получить данные о питательности")
+    return items
+
+
+def photo_food_session(item, photo_id):
+    """
+    Сессия для одного блюда с фото. Название и уверенность берутся из той же позиции,
+    что и КБЖУ: если КБЖУ главного блюда не нашлось, в списке осталась другая позиция
+    """
+    return {
+        'food_name': item['food_name'],
+        'nutrition_per_100g': item['nutrition_data'],
+        'photo_id': photo_id
+    }
+
+
+def format_recognized(item):
+    return (
+        f"🍴 Распознано: {item['food_name_ru']} "
+        f"(уверенность: {item['prob'] * 100:.0f}%)\n"
+        "📝 Введите вес порции в граммах:"
+    )
+
+
+def meal_session(items, photo_id):
+    """Сессия для нескольких блюд с фото: веса вводятся одним сообщением"""
+    return {
+        'items': [
+            {
+                'food_name': item['food_name'],
+                'food_name_ru': item['food_name_ru'],
+                'nutrition_per_100g': item['nutrition_data']
+            }
+            for item in items
+        ],
+        'photo_id': photo_id
+    }
+
+
+def format_meal_question(items):
+    lines = [f"{number}. {item['food_name_ru']} ({item['prob'] * 100:.0f}%)"
+             for number, item in enumerate(items, 1)]
+    return (
+        "🍽 На фото:\n" + "\n".join(lines) + "\n\n"
+        "📝 Введите вес каждой позиции в граммах через пробел, "
+        f"например: {' '.join(['150'] * len(items))}\n"
+        "Ноль - не записывать позицию"
+    )
+
+
+def parse_meal_portions(text, count):
+    """
+    Веса позиций через пробел. None - число позиций не совпало или есть
+    отрицательный вес; ValueError - не числа или все веса нулевые.
+    """
+    portions = [float(value.replace(',', '.')) for value in text.split()]
+    if len(portions) != count or any(portion < 0 for portion in portions):
+        return None
+    if not any(portions):
+        raise ValueError("Все веса нулевые")
+    return portions
+
+
+def format_meal_portions_count(count):
+    return f"🔢 Нужно {count} чисел через пробел"
+
+
+def format_meal_summary(items, portions):
+    """КБЖУ каждой позиции с ненулевым весом и итог приема пищи"""
+    lines = []
+    totals = {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
+    for item, portion_grams in zip(items, portions):
+        if not portion_grams:
+            continue
+        nutrition = calculate_nutrition(portion_grams, item['nutrition_per_100g'])
+        lines.append(f"🍏 {item['food_name_ru']}, {portion_grams:g}г - {nutrition['calories']} ккал")
+        for key in totals:
+            totals[key] += nutrition[key]
+
+    return (
+        "\n".join(lines) + "\n\n"
+        f"Итого:\n"
+        f"🔥 {totals['calories']:.1f} ккал\n"
+        f"🥩 {totals['protein']:.1f}г белков\n"
+        f"🥑 {totals['fat']:.1f}г жиров\n"
+        f"🍞 {totals['carbs']:.1f}г углеводов"
+    )
+
+
+def meal_diary_items(meal):
+    """Позиции сохраненного приема пищи для save_meal_to_diary; None - веса еще не введены"""
+    if not meal or 'portions' not in meal:
+        return None
+    return [
+        (item['food_name'], portion_grams, calculate_nutrition(portion_grams, item['nutrition_per_100g']))
+        for item, portion_grams in zip(meal['items'], meal['portions']) if portion_grams
+    ]
+
+
+# --- Ручной ввод --- #
+
+def parse_food_name(text):
+    text = text.strip()
+    if not text:
+        raise ValueError("Название не может быть пустым")
+    return text
+
+
+def match_food_name(index, text, limit):
+    """
+    Решение по введенному названию: (запись индекса, None), если название известно
+    (в том числе с опечаткой); (None, подсказки) - есть похожие; (None, None) - искать как написано.
+    Подсказки - пары (ключ, подпись) для create_food_suggestions_keyboard.
+    """
+    entry_id = index.resolve(text)
+    if entry_id is not None:
+        return index.get(entry_id), None
+
+    suggestions = [(index.key(entry_id), index.get(entry_id)[2])
+                   for entry_id, _, _ in index.search(text, limit=limit)]
+    return None, suggestions or None
+
+
+def parse_suggestion_callback(data):
+    """'food_<ключ>' -> ключ названия или 'typed' (искать как написано)"""
+    return data.split('_', 1)[1]
+
+
+def remember_food_names(index, name, food_name, food_name_ru):
+    """Запоминает найденное название, чтобы в следующий раз найти его без сети"""
+    index.add(food_name_ru, food_name, food_name_ru)
+    if normalize_food_name(name) != normalize_food_name(food_name_ru):
+        index.add(name, food_name, food_name_ru)
+
+
+def format_not_found(food_name_ru):
+    return (
+        f"🔍 Не найдено данных для '{food_name_ru}'\n"
+        "Попробуйте уточнить название:"
+    )
+
+
+def manual_food_session(food_name_ru, nutrition_data):
+    return {
+        'food_name': food_name_ru,
+        'nutrition_per_100g': nutrition_data
+    }
+
+
+def format_found(food_name_ru):
+    return (
+        f"🍴 Найдено: {food_name_ru}\n"
+        "📝 Введите вес порции в граммах:"
+    )
+
+
+def is_retry_request(text):
+    return text == "✍️ Уточнить запрос"
+
+
+def parse_portion(text):
+    """Вес порции в граммах (ValueError - не число или не больше нуля)"""
+    portion_grams = float(text)
+    if portion_grams <= 0:
+        raise ValueError("Вес должен быть больше 0")
+    return portion_grams
+
+
+def parse_save_callback(data):
+    """'save_<вес>' -> вес порции"""
+    return float(data.split('_')[1])
+
+
+def diary_entry(food_info, portion_grams):
+    """Аргументы save_to_diary для сохраненного блюда и выбранного веса"""
+    return {
+        'food_name': food_info['food_name'],
+        'portion_grams': portion_grams,
+        'nutrition_data': calculate_nutrition(portion_grams, food_info['nutrition_per_100g']),
+        'photo_id': food_info.get('photo_id')
+    }
+
+
+# --- Рецепты --- #
+
+def parse_ingredients(text):
+    ingredients = [x.strip() for x in text.split(',') if x.strip()]
+    if len(ingredients) < 2:
+        raise ValueError("Нужно минимум 2 ингредиента")
+    return ingredients
+
+
+def format_recipes(ingredients, recipes):
+    """Готовые рецепты (HTML)"""
+    return f"🍳 <b>Рецепты из {', '.join(ingredients)}:</b>\n\n{recipes}"
+
+
+def format_recipes_progress(ingredients, text):
+    """Промежуточный текст при потоковой генерации: сообщение Telegram ограничено 4096 символами"""
+    header = f"🍳 Рецепты из {', '.join(ingredients)}:\n\n"
+    return (header + text)[:4000] + " ▌"
@@ -0,0 +1,70 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import sys
+from database import init_db, iter_diary_entries, close_connections
+
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_COLUMNS = ('date', 'food_name', 'portion_grams', 'calories', 'protein', 'fat', 'carbs')
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+
+def export_filename(chat_id, fmt='csv', compress=False):
+    return f"diary_{chat_id}.{fmt}" + (".gz" if compress else "")
+
+
+def write_export(chat_id, output, fmt='csv', compress=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Пишет дневник чата в бинарный поток output в формате CSV или JSON Lines.
+    Строки идут из базы кусками по chunk_size и сразу уходят в поток,
+    поэтому память не растет с размером дневника. Возвращает число строк.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+
+    binary = gzip.GzipFile(fileobj=output, mode='wb') if compress else output
+    text = io.TextIOWrapper(binary, encoding='utf-8', newline='', write_through=False)
+
+    count = 0
+    try:
+        if fmt == 'csv':
+            writer = csv.writer(text)
+            writer.writerow(EXPORT_COLUMNS)
+            for rows in iter_diary_entries(chat_id, chunk_size):
+                writer.writerows(rows)
+                count += len(rows)
+        else:
+            for rows in iter_diary_entries(chat_id, chunk_size):
+                for row in rows:
+                    text.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+                    text.write('\n')
+                count += len(rows)
+        text.flush()
+    finally:
+        # Отсоединяем обертки, чтобы не закрыть чужой поток output
+        text.detach()
+        if compress:
+            binary.close()
+    return count
+
+
+# Пример использования: python export.py 123456789 --format jsonl --gzip -o diary.jsonl.gz
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Выгрузка дневника питания пользователя")
+    parser.add_argument('chat_id', type=int)
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--gzip', action='store_true', help="сжать результат")
+    parser.add_argument('-o', '--output', help="файл для записи (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    init_db()
+    if args.output:
+        with open(args.output, 'wb') as f:
+            count = write_export(args.chat_id, f, args.format, args.gzip)
+    else:
+        count = write_export(args.chat_id, sys.stdout.buffer, args.format, args.gzip)
+        sys.stdout.buffer.flush()
+    print(f"📤 Выгружено записей: {count}", file=sys.stderr)
+    close_connections()
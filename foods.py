@@ -0,0 +1,272 @@
+import csv
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import threading
+from dotenv import load_dotenv
+from cache import StatsCounter
+
+load_dotenv()
+
+# Локальная база КБЖУ на 100 г: собирается из FOODS_CSV и открывается только на чтение
+# Оба пути по умолчанию - рядом с модулем, а не в текущем каталоге
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+FOODS_DB = os.getenv('FOODS_DB', os.path.join(MODULE_DIR, 'foods.db'))
+FOODS_CSV = os.getenv('FOODS_CSV', os.path.join(MODULE_DIR, 'foods.csv'))
+FOODS_LOOKUP = os.getenv('FOODS_LOOKUP', '1') == '1'
+
+FOOD_COLUMNS = ('name', 'name_ru', 'calories', 'protein', 'fat', 'carbs', 'serving_weight')
+
+_local = threading.local()
+_build_lock = threading.Lock()
+_checked = False  # база уже сверена с CSV в этом процессе
+foods_stats = StatsCounter('hits', 'misses')
+
+
+def build_foods_db(csv_path=None, db_path=None):
+    """
+    Собирает базу продуктов из CSV (колонки FOOD_COLUMNS, КБЖУ на 100 г).
+    База пишется во временный файл и подменяет старую целиком,
+    поэтому читатели никогда не видят ее наполовину собранной.
+    """
+    csv_path = csv_path or FOODS_CSV
+    db_path = db_path or FOODS_DB
+    csv_hash = file_hash(csv_path)
+    # Свой временный файл у каждого процесса: шарды могут собирать базу одновременно
+    tmp_path = f"{db_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('PRAGMA page_size=4096')
+    conn.execute('''
+    CREATE TABLE foods (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        name_ru TEXT,
+        calories REAL,
+        protein REAL,
+        fat REAL,
+        carbs REAL,
+        serving_weight REAL
+    )
+    ''')
+    # Полнотекстовый индекс по английскому и русскому названию без копии данных
+    conn.execute('''
+    CREATE VIRTUAL TABLE foods_fts USING fts5(
+        name, name_ru, content='foods', content_rowid='id', tokenize='unicode61'
+    )
+    ''')
+
+    with open(csv_path, encoding='utf-8', newline='') as f:
+        rows = [
+            (
+                normalize_name(row['name']),
+                normalize_name(row.get('name_ru') or ''),
+                float(row['calories']),
+                float(row['protein']),
+                float(row['fat']),
+                float(row['carbs']),
+                float(row.get('serving_weight') or 100)
+            )
+            for row in csv.DictReader(f)
+        ]
+
+    # Хэш исходного CSV: по нему видно, что файл обновили и базу пора пересобрать
+    conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    with conn:
+        conn.execute("INSERT INTO meta (key, value) VALUES ('csv_sha256', ?)", (csv_hash,))
+        conn.executemany('''
+        INSERT INTO foods (name, name_ru, calories, protein, fat, carbs, serving_weight)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.execute('CREATE INDEX idx_foods_name ON foods (name)')
+        conn.execute('CREATE INDEX idx_foods_name_ru ON foods (name_ru)')
+        conn.execute("INSERT INTO foods_fts (foods_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO foods_fts (foods_fts) VALUES ('optimize')")
+    conn.execute('VACUUM')
+    conn.close()
+
+    os.replace(tmp_path, db_path)
+    close_foods_db()
+    return len(rows)
+
+
+def normalize_name(name):
+    return ' '.join(name.casefold().split())
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _stored_csv_hash(db_path):
+    """Хэш CSV, из которого собрана база (None - база старая, без таблицы meta)"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'csv_sha256'").fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+
+def _ensure_foods_db():
+    """
+    Один раз за процесс: собирает базу, если ее нет или она собрана
+    из другой версии FOODS_CSV (файл обновили при деплое).
+    Возвращает False, если нет ни базы, ни CSV.
+    """
+    global _checked
+    if _checked:
+        return True
+    with _build_lock:
+        if _checked:
+            return True
+        if os.path.exists(FOODS_CSV):
+            if not os.path.exists(FOODS_DB) or _stored_csv_hash(FOODS_DB) != file_hash(FOODS_CSV):
+                print(f"🔄 Сборка базы продуктов из {FOODS_CSV}")
+                build_foods_db()
+        elif not os.path.exists(FOODS_DB):
+            return False
+        _checked = True
+    return True
+
+
+def get_foods_connection():
+    """
+    Соединение текущего потока с базой продуктов (только чтение, через mmap).
+    Если базы еще нет или FOODS_CSV изменился, база собирается заново.
+    Без базы и CSV возвращает None.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        return conn
+
+    if not _ensure_foods_db():
+        return None
+
+    conn = sqlite3.connect(f"file:{FOODS_DB}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute('PRAGMA mmap_size=67108864')
+    conn.execute('PRAGMA query_only=1')
+    _local.conn = conn
+    return conn
+
+
+def close_foods_db():
+    """Закрывает соединение текущего потока (остальные закроются вместе с потоками)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+# Слова, которые уточняют подачу, но почти не меняют КБЖУ на 100 г
+NEUTRAL_WORDS = frozenset((
+    'a', 'an', 'the', 'of', 'fresh', 'raw', 'ripe', 'plain', 'whole', 'sliced', 'chopped',
+    'small', 'medium', 'large', 'big', 'piece', 'slice', 'cup', 'bowl', 'glass', 'portion',
+    'homemade', 'grilled', 'baked', 'roasted', 'steamed', 'cooked',
+))
+
+
+def _fts_query(words):
+    """Слова запроса через OR, каждое в кавычках, чтобы они не стали синтаксисом FTS"""
+    return ' OR '.join(f'"{word}"' for word in words)
+
+
+def find_food(name):
+    """
+    Ищет продукт: сначала точное совпадение названия (по индексу), затем по
+    полнотекстовому индексу. Кандидат из индекса подходит, только если все его слова
+    есть в запросе, а лишние слова запроса - из NEUTRAL_WORDS ("grilled salmon" -> salmon,
+    но "apple pie" не станет яблоком). Из подходящих берется самое длинное название.
+    Возвращает строку (name, calories, protein, fat, carbs, serving_weight) или None.
+    """
+    conn = get_foods_connection()
+    if conn is None:
+        return None
+    name = normalize_name(name)
+    if not name:
+        return None
+
+    row = conn.execute('''
+    SELECT name, calories, protein, fat, carbs, serving_weight
+    FROM foods WHERE name = ? OR name_ru = ?
+    LIMIT 1
+    ''', (name, name)).fetchone()
+    if row:
+        return row
+
+    words = set(re.findall(r'\w+', name))
+    if not words - NEUTRAL_WORDS:
+        return None
+    candidates = conn.execute('''
+    SELECT foods.name, foods.name_ru, calories, protein, fat, carbs, serving_weight
+    FROM foods_fts JOIN foods ON foods.id = foods_fts.rowid
+    WHERE foods_fts MATCH ?
+    ORDER BY bm25(foods_fts)
+    LIMIT 20
+    ''', (_fts_query(words - NEUTRAL_WORDS),)).fetchall()
+
+    best, best_length = None, 0
+    for candidate in candidates:
+        for candidate_name in candidate[:2]:
+            candidate_words = set(re.findall(r'\w+', candidate_name))
+            if candidate_words <= words and words - candidate_words <= NEUTRAL_WORDS:
+                if len(candidate_words) > best_length:
+                    best, best_length = (candidate[0],) + candidate[2:], len(candidate_words)
+    return best
+
+
+def iter_food_names():
+    """Пары (английское, русское название) всех продуктов локальной базы"""
+    conn = get_foods_connection()
+    if conn is None:
+        return []
+    return conn.execute('SELECT name, name_ru FROM foods').fetchall()
+
+
+def get_local_nutrition(food_name):
+    """
+    КБЖУ из локальной базы в том же виде, что и parse_nutritionix_food:
+    значения на стандартную порцию и ее вес в serving_weight.
+    """
+    if not FOODS_LOOKUP:
+        return None
+
+    try:
+        row = find_food(food_name)
+    except sqlite3.Error as e:
+        print(f"⚠️ Локальная база продуктов недоступна: {e}")
+        row = None
+
+    if row is None:
+        foods_stats.add('misses')
+        return None
+
+    foods_stats.add('hits')
+    _, calories, protein, fat, carbs, serving_weight = row
+    coefficient = serving_weight / 100
+    return {
+        'calories': round(calories * coefficient, 1),
+        'protein': round(protein * coefficient, 1),
+        'fat': round(fat * coefficient, 1),
+        'carbs': round(carbs * coefficient, 1),
+        'serving_weight': serving_weight
+    }
+
+
+# Пример использования: python foods.py build [foods.csv]  |  python foods.py find "chicken breast"
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'build'
+    if command == 'build':
+        count = build_foods_db(sys.argv[2] if len(sys.argv) > 2 else None)
+        print(f"🥗 В базе продуктов: {count}")
+    elif command == 'find':
+        print(find_food(' '.join(sys.argv[2:])))
+        print(get_local_nutrition(' '.join(sys.argv[2:])))
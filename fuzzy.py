@@ -0,0 +1,180 @@
+import hashlib
+import os
+import threading
+from collections import Counter, defaultdict
+from dotenv import load_dotenv
+from database import get_known_food_names
+from foods import iter_food_names
+
+load_dotenv()
+
+# Сколько названий из дневников загружать в индекс при старте
+FUZZY_DIARY_NAMES = int(os.getenv('FUZZY_DIARY_NAMES', 20000))
+# Минимальное сходство по триграммам (коэффициент Дайса), чтобы предложить вариант
+FUZZY_MIN_SIMILARITY = float(os.getenv('FUZZY_MIN_SIMILARITY', 0.45))
+
+
+def normalize(name):
+    return ' '.join(name.casefold().replace('ё', 'е').split())
+
+
+def name_key(name):
+    """
+    Стабильный ключ названия для callback_data кнопок: в отличие от id в индексе,
+    не зависит от порядка сборки и не меняется после перезапуска бота
+    """
+    return hashlib.blake2b(normalize(name).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def trigrams(name):
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Расстояние Левенштейна с отсечением: если оно заведомо больше
+    max_distance, возвращает max_distance + 1, не досчитывая таблицу.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)
+            ))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+def allowed_typos(name):
+    """Сколько опечаток считать почти точным совпадением"""
+    if len(name) < 4:
+        return 0
+    return 1 if len(name) < 9 else 2
+
+
+class FoodNameIndex:
+    """
+    Индекс известных названий блюд для поиска с опечатками.
+    Кандидаты отбираются по общим триграммам, затем уточняются
+    расстоянием Левенштейна. У каждого названия есть английский запрос
+    для поиска КБЖУ (если известен) и русское название для ответа.
+    """
+
+    def __init__(self):
+        self._entries = []  # id -> (название, английский запрос или None, русское название)
+        self._keys = []  # id -> (нормализованное название, число его триграмм)
+        self._by_name = {}  # нормализованное название -> id
+        self._by_key = {}  # name_key() -> id
+        self._trigrams = defaultdict(set)  # триграмма -> id названий
+        self._lock = threading.Lock()
+
+    def add(self, name, query=None, name_ru=None):
+        """Добавляет название; повтор только дополняет недостающий запрос"""
+        key = normalize(name)
+        if not key:
+            return
+        with self._lock:
+            entry_id = self._by_name.get(key)
+            if entry_id is not None:
+                known_name, known_query, known_ru = self._entries[entry_id]
+                if known_query is None and query:
+                    self._entries[entry_id] = (known_name, query, known_ru)
+                return
+            entry_id = len(self._entries)
+            self._entries.append((name, query, name_ru or name))
+            self._by_name[key] = entry_id
+            self._by_key.setdefault(name_key(key), entry_id)
+            entry_trigrams = trigrams(key)
+            self._keys.append((key, len(entry_trigrams)))
+            for trigram in entry_trigrams:
+                self._trigrams[trigram].add(entry_id)
+
+    def get(self, entry_id):
+        """Запись по id (id стабильны, пока жив процесс) или None"""
+        if 0 <= entry_id < len(self._entries):
+            return self._entries[entry_id]
+        return None
+
+    def key(self, entry_id):
+        """Стабильный ключ записи (см. name_key)"""
+        return name_key(self._keys[entry_id][0])
+
+    def get_by_key(self, key):
+        """Запись по стабильному ключу или None, если такого названия в индексе больше нет"""
+        entry_id = self._by_key.get(key)
+        return self._entries[entry_id] if entry_id is not None else None
+
+    def search(self, name, limit=5):
+        """
+        Похожие названия: список (id, расстояние правки, сходство),
+        сначала с наименьшим расстоянием, затем с наибольшим сходством.
+        """
+        key = normalize(name)
+        if not key:
+            return []
+
+        entry_id = self._by_name.get(key)
+        if entry_id is not None:
+            return [(entry_id, 0, 1.0)]
+
+        query_trigrams = trigrams(key)
+        shared = Counter()
+        with self._lock:
+            for trigram in query_trigrams:
+                shared.update(self._trigrams.get(trigram, ()))
+
+            scored = []
+            for entry_id, count in shared.most_common(limit * 10):
+                entry_key, size = self._keys[entry_id]
+                similarity = 2 * count / (len(query_trigrams) + size)
+                if similarity >= FUZZY_MIN_SIMILARITY:
+                    distance = edit_distance(key, entry_key, max(allowed_typos(key), 3))
+                    scored.append((entry_id, distance, similarity))
+
+        scored.sort(key=lambda item: (item[1], -item[2]))
+        return scored[:limit]
+
+    def resolve(self, name):
+        """Точное или почти точное совпадение (не больше allowed_typos опечаток): id или None"""
+        matches = self.search(name, limit=1)
+        if matches and matches[0][1] <= allowed_typos(normalize(name)):
+            return matches[0][0]
+        return None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def build_food_name_index():
+    """Собирает индекс из локальной базы продуктов и истории дневников"""
+    index = FoodNameIndex()
+    for name, name_ru in iter_food_names():
+        if name_ru:
+            index.add(name_ru, name, name_ru)
+        index.add(name, name, name_ru)
+    for food_name, source in get_known_food_names(FUZZY_DIARY_NAMES):
+        if food_name:
+            index.add(food_name, source, food_name)
+    return index
+
+
+def get_food_name_index():
+    """Общий индекс процесса; собирается при первом обращении"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = build_food_name_index()
+    return _index
@@ -0,0 +1,94 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+# Время на установку соединения (одинаковое для всех API)
+CONNECT_TIMEOUT = 3.05
+
+# Настройки пула, таймаута чтения и повторов для каждого внешнего API.
+# idempotent - повтор запроса безопасен (GET). Остальные - POST: запрос мог дойти
+# и выполниться (Logmeal списал оплату, шард записал обновление), поэтому их
+# повторяем, только если он точно не обработан: ошибка соединения или 429/503 с Retry-After
+UPSTREAMS = {
+    'logmeal': {'pool_size': 10, 'read_timeout': 30, 'retries': 2},
+    'nutritionix': {'pool_size': 10, 'read_timeout': 10, 'retries': 3},
+    'together': {'pool_size': 4, 'read_timeout': 30, 'retries': 1},
+    'translate': {'pool_size': 10, 'read_timeout': 5, 'retries': 3, 'idempotent': True},
+    # Пересылка обновлений от маршрутизатора supervisor.py в процессы шардов
+    'shards': {'pool_size': 32, 'read_timeout': 10, 'retries': 3},
+}
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Ответы, после которых можно повторить и POST, если сервер прислал Retry-After
+RETRY_AFTER_STATUSES = (429, 503)
+RETRY_BACKOFF = 0.3
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _create_session(upstream):
+    config = UPSTREAMS[upstream]
+    idempotent = config.get('idempotent', False)
+    retry = Retry(
+        total=config['retries'],
+        # Для POST: без повторов после отправки запроса (таймаут чтения, обрыв ответа)
+        read=None if idempotent else 0,
+        other=None if idempotent else 0,
+        backoff_factor=RETRY_BACKOFF,
+        # Для POST статусы повторяются только с Retry-After (см. Retry.is_retry)
+        status_forcelist=RETRY_STATUSES if idempotent else (),
+        allowed_methods=None,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config['pool_size'],
+        max_retries=retry,
+        pool_block=False
+    )
+    session = requests.Session()
+    session.headers['Connection'] = 'keep-alive'
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(upstream):
+    """Возвращает общую keep-alive сессию для указанного API"""
+    session = _sessions.get(upstream)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(upstream)
+            if session is None:
+                session = _create_session(upstream)
+                _sessions[upstream] = session
+    return session
+
+
+def request(upstream, method, url, **kwargs):
+    """Выполняет запрос через пул соединений с таймаутами по умолчанию для API"""
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, UPSTREAMS[upstream]['read_timeout']))
+    with metrics.track('upstream', upstream):
+        response = get_session(upstream).request(method, url, **kwargs)
+    if response.status_code >= 400:
+        metrics.inc('bot_upstream_errors_total', name=upstream, error=f"HTTP {response.status_code}")
+    return response
+
+
+def get(upstream, url, **kwargs):
+    return request(upstream, 'GET', url, **kwargs)
+
+
+def post(upstream, url, **kwargs):
+    return request(upstream, 'POST', url, **kwargs)
+
+
+def close_sessions():
+    """Закрывает все сессии и их пулы соединений"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
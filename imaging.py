@@ -0,0 +1,108 @@
+import io
+import os
+import sys
+import time
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+load_dotenv()
+
+# Logmeal сам уменьшает фото примерно до 800px (processed_image_size в ответе),
+# поэтому отправлять больше нет смысла
+PHOTO_PREPROCESS = os.getenv('PHOTO_PREPROCESS', '1') == '1'
+PHOTO_TARGET_SIZE = int(os.getenv('PHOTO_TARGET_SIZE', 800))
+PHOTO_JPEG_QUALITY = int(os.getenv('PHOTO_JPEG_QUALITY', 85))
+
+
+def choose_photo_size(photo_sizes, target_size=None):
+    """
+    Выбирает самый маленький из размеров Telegram, которого хватает для распознавания.
+    Если ни один не дотягивает до target_size - берет самый большой.
+    """
+    target_size = target_size or PHOTO_TARGET_SIZE
+    if not PHOTO_PREPROCESS:
+        return photo_sizes[-1]
+
+    for size in sorted(photo_sizes, key=lambda s: s.width * s.height):
+        if max(size.width, size.height) >= target_size:
+            return size
+    return photo_sizes[-1]
+
+
+def prepare_image(image_bytes, target_size=None, quality=None):
+    """
+    Уменьшает фото до target_size по длинной стороне и пережимает в JPEG.
+    Если фото и так маленькое или результат не меньше исходника - возвращает исходник.
+    """
+    if not PHOTO_PREPROCESS:
+        return image_bytes
+    target_size = target_size or PHOTO_TARGET_SIZE
+    quality = quality or PHOTO_JPEG_QUALITY
+
+    image = Image.open(io.BytesIO(image_bytes))
+    if max(image.size) <= target_size:
+        return image_bytes
+
+    # Для JPEG декодер сразу читает уменьшенную копию - это в разы быстрее
+    image.draft('RGB', (target_size, target_size))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((target_size, target_size), Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    if output.tell() >= len(image_bytes):
+        return image_bytes
+    return output.getbuffer()
+
+
+def dhash(image_bytes, hash_size=8):
+    """
+    Перцептивный хэш (difference hash): 64 бита, которые почти не меняются
+    при пережатии, масштабировании и небольших правках фото.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft('L', (hash_size * 4, hash_size * 4))
+    pixels = list(image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def benchmark(file_path, upload=False, runs=3):
+    """Сравнивает размер и время распознавания исходного и подготовленного фото"""
+    with open(file_path, 'rb') as f:
+        original = f.read()
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        prepared = prepare_image(original)
+    prepare_ms = (time.perf_counter() - started) / runs * 1000
+
+    print(f"Исходное фото:      {len(original)} байт, {Image.open(io.BytesIO(original)).size}")
+    print(f"Подготовленное:     {len(prepared)} байт, {Image.open(io.BytesIO(prepared)).size}")
+    print(f"Экономия:           {100 - len(prepared) * 100 / len(original):.0f}%")
+    print(f"Время подготовки:   {prepare_ms:.1f} мс")
+
+    if upload:
+        from logmeal import analyze_photo_with_logmeal
+
+        for name, image in (('исходное', original), ('подготовленное', prepared)):
+            timings = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                result = analyze_photo_with_logmeal(image)
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f"Logmeal, {name}: {min(timings):.0f} мс (лучшее из {runs}), {result}")
+
+
+# Пример использования: python imaging.py ogurec.jpg [--upload]
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    benchmark(args[0] if args else "ogurec.jpg", upload='--upload' in sys.argv)
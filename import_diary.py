@@ -0,0 +1,180 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from database import (
+    init_db, insert_diary_rows, get_import_progress, delete_import_progress,
+    drop_diary_indexes, create_diary_indexes, rebuild_daily_totals, close_connections
+)
+
+IMPORT_BATCH_SIZE = 50000
+IMPORT_FORMATS = ('csv', 'jsonl')
+NUTRIENT_FIELDS = ('calories', 'protein', 'fat', 'carbs')
+DATE_FORMATS = ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y")
+
+
+def detect_format(path):
+    """Формат по расширению файла (diary.jsonl.gz -> jsonl)"""
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_records(path, fmt):
+    """Построчно читает записи из CSV (с заголовком) или JSON Lines, в том числе сжатых gzip"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_date(value):
+    """ISO 8601 (как в базе и у большинства трекеров) или русский формат 31.12.2024"""
+    value = str(value).strip()
+    try:
+        # fromisoformat написан на C и в разы быстрее strptime
+        date = datetime.fromisoformat(value)
+        return date.replace(tzinfo=None) if date.tzinfo else date
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
+def parse_number(record, field):
+    value = record.get(field)
+    if value is None or value == '':
+        raise ValueError(f"нет поля {field}")
+    number = float(value)
+    if not 0 <= number < 1e6:
+        raise ValueError(f"{field} вне допустимого диапазона: {value}")
+    return number
+
+
+def parse_record(record, chat_id=None):
+    """
+    Проверяет запись и превращает ее в строку таблицы diary.
+    Названия сохраняются как есть, без перевода. При ошибке - ValueError.
+    """
+    if chat_id is None:
+        try:
+            chat_id = int(record['chat_id'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("нет или неверный chat_id")
+
+    food_name = str(record.get('food_name') or '').strip()
+    if not food_name:
+        raise ValueError("нет названия блюда")
+
+    try:
+        date = parse_date(record.get('date', ''))
+    except ValueError:
+        raise ValueError(f"неверная дата: {record.get('date')}")
+
+    nutrients = [parse_number(record, field) for field in NUTRIENT_FIELDS]
+    return (
+        chat_id,
+        date.isoformat(' ', 'seconds'),  # то же, что strftime("%Y-%m-%d %H:%M:%S"), но быстрее
+        food_name,
+        parse_number(record, 'portion_grams'),
+        *nutrients,
+        record.get('photo_id') or None,
+        date.date().isoformat()
+    )
+
+
+def import_diary(path, fmt=None, chat_id=None, batch_size=IMPORT_BATCH_SIZE, max_errors=20, offline=False):
+    """
+    Загружает записи из файла в diary пачками по batch_size (executemany в одной транзакции).
+    С offline=True (бот остановлен) индексы diary на время загрузки снимаются и строятся
+    заново в конце, даже если загрузка прервалась; иначе запросы работающего бота шли бы
+    полным просмотром таблицы. В конце daily_totals пересчитываются.
+    Вместе с каждой пачкой в базе сохраняется номер последней обработанной записи:
+    повторный запуск с тем же файлом продолжает с места остановки.
+    Возвращает статистику: загружено, отклонено, пропущено, строк в секунду.
+    """
+    fmt = fmt or detect_format(path)
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    source = os.path.abspath(path)
+
+    skip, total_imported, rejected = get_import_progress(source) or (0, 0, 0)
+    if skip:
+        print(f"↩️ Продолжаем с записи {skip + 1} (уже загружено {total_imported})", file=sys.stderr)
+
+    if offline:
+        drop_diary_indexes()
+
+    started = time.perf_counter()
+    imported = 0
+    position = skip
+    batch = []
+    try:
+        for position, record in enumerate(read_records(path, fmt), 1):
+            if position <= skip:
+                continue
+            try:
+                batch.append(parse_record(record, chat_id))
+            except (ValueError, TypeError, AttributeError) as e:
+                rejected += 1
+                if rejected <= max_errors:
+                    print(f"⚠️ Запись {position} пропущена: {e}", file=sys.stderr)
+
+            if len(batch) >= batch_size:
+                insert_diary_rows(batch, source, position, rejected)
+                imported += len(batch)
+                batch.clear()
+                print(f"📥 {total_imported + imported} записей, "
+                      f"{imported / (time.perf_counter() - started):.0f} строк/с", file=sys.stderr)
+
+        insert_diary_rows(batch, source, position, rejected)
+        imported += len(batch)
+        insert_seconds = time.perf_counter() - started
+    finally:
+        if offline:
+            create_diary_indexes()
+
+    days = rebuild_daily_totals()
+    delete_import_progress(source)
+
+    return {
+        'imported': imported,
+        'rejected': rejected,
+        'skipped': skip,
+        'days': days,
+        'seconds': time.perf_counter() - started,
+        'rows_per_second': imported / insert_seconds if insert_seconds else 0.0,
+    }
+
+
+# Пример использования: python import_diary.py history.csv.gz --chat-id 123456789
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Массовая загрузка истории в дневник питания")
+    parser.add_argument('path', help="CSV с заголовком или JSON Lines (можно .gz)")
+    parser.add_argument('--format', choices=IMPORT_FORMATS, help="по умолчанию - по расширению")
+    parser.add_argument('--chat-id', type=int, help="chat_id для всех записей (если его нет в файле)")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument('--offline', action='store_true',
+                        help="бот остановлен: снять индексы diary на время загрузки (быстрее)")
+    args = parser.parse_args()
+
+    init_db()
+    try:
+        stats = import_diary(args.path, args.format, args.chat_id, args.batch_size, offline=args.offline)
+    finally:
+        close_connections()
+
+    print(f"✅ Загружено: {stats['imported']}, отклонено: {stats['rejected']}, "
+          f"пропущено по чекпоинту: {stats['skipped']}, дней: {stats['days']}")
+    print(f"⏱ {stats['seconds']:.1f} с, {stats['rows_per_second']:.0f} строк/с")
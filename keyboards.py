@@ -0,0 +1,145 @@
+import telebot
+import calendar
+
+
+def create_main_keyboard():
+    keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
+
+    row1 = [
+        telebot.types.KeyboardButton("🍽 Потреблено сегодня"),
+        telebot.types.KeyboardButton("📜 Дневник"),
+        telebot.types.KeyboardButton("✍️ Ввести вручную")
+    ]
+
+    row2 = [
+        telebot.types.KeyboardButton("🧑‍🍳 Что приготовить?"),
+        telebot.types.KeyboardButton("❓ Помощь")
+    ]
+
+    keyboard.add(*row1)
+    keyboard.add(*row2)
+
+    return keyboard
+
+
+def create_food_suggestions_keyboard(suggestions):
+    """Варианты названия блюда (стабильный ключ из fuzzy.name_key, подпись) и кнопка поиска как написано"""
+    markup = telebot.types.InlineKeyboardMarkup()
+    for key, label in suggestions:
+        markup.add(telebot.types.InlineKeyboardButton(label, callback_data=f"food_{key}"))
+    markup.add(telebot.types.InlineKeyboardButton("🔎 Искать как написано", callback_data="food_typed"))
+    return markup
+
+
+def create_uncertain_photo_keyboard():
+    """Фото распознано неуверенно: переснять или ввести название"""
+    markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.row(
+        telebot.types.KeyboardButton("📸 Сделать новое фото"),
+        telebot.types.KeyboardButton("✍️ Ввести вручную")
+    )
+    return markup
+
+
+def create_retry_keyboard():
+    """КБЖУ не найдены: уточнить название или вернуться в меню"""
+    markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add("✍️ Уточнить запрос", "📋 Меню")
+    return markup
+
+
+def create_save_keyboard(portion_grams):
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.add(telebot.types.InlineKeyboardButton("💾 Сохранить", callback_data=f"save_{portion_grams}"))
+    return markup
+
+
+def create_save_meal_keyboard():
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.add(telebot.types.InlineKeyboardButton("💾 Сохранить всё", callback_data="savemeal"))
+    return markup
+
+
+def create_day_entries_keyboard(entries):
+    """Кнопки удаления записей дня и возврат к календарю"""
+    markup = telebot.types.InlineKeyboardMarkup()
+    for entry in entries:
+        markup.add(
+            telebot.types.InlineKeyboardButton(
+                f"❌ Удалить {entry[3][:15]}...",
+                callback_data=f"delete_{entry[0]}"
+            )
+        )
+
+    markup.add(
+        telebot.types.InlineKeyboardButton(
+            "🔙 Назад к календарю",
+            callback_data="back_to_calendar"
+        )
+    )
+    return markup
+
+
+def generate_calendar(year, month, marked_days=0):
+    """
+    Генерирует календарь с жирным выделением дней с записями.
+    marked_days - битовая маска дней месяца (см. get_month_days)
+    """
+    cal = calendar.monthcalendar(year, month)
+    month_name = calendar.month_name[month]
+
+    keyboard = []
+
+    # Заголовок с месяцем и годом
+    keyboard.append([
+        telebot.types.InlineKeyboardButton(
+            f"<< {month_name} {year} >>",
+            callback_data="ignore"
+        )
+    ])
+
+    # Дни недели
+    week_days = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+    keyboard.append([
+        telebot.types.InlineKeyboardButton(day, callback_data="ignore")
+        for day in week_days
+    ])
+
+    # Недели
+    for week in cal:
+        week_buttons = []
+        for day in week:
+            if day == 0:
+                week_buttons.append(
+                    telebot.types.InlineKeyboardButton(" ", callback_data="ignore")
+                )
+            else:
+                date_str = f"{year}-{month:02d}-{day:02d}"
+                # Жирное выделение для дней с записями
+                day_text = f"*{day}*" if marked_days >> day & 1 else str(day)
+                week_buttons.append(
+                    telebot.types.InlineKeyboardButton(
+                        day_text,
+                        callback_data=f"day_{date_str}"
+                    )
+                )
+        keyboard.append(week_buttons)
+
+    # Кнопки навигации
+    prev_month = month - 1 if month > 1 else 12
+    prev_year = year if month > 1 else year - 1
+    next_month = month + 1 if month < 12 else 1
+    next_year = year if month < 12 else year + 1
+
+    keyboard.append([
+        telebot.types.InlineKeyboardButton(
+            "◀️ Предыдущий месяц",
+            callback_data=f"month_{prev_year}_{prev_month}"
+        ),
+        telebot.types.InlineKeyboardButton(
+            "▶️ Следующий месяц",
+            callback_data=f"month_{next_year}_{next_month}"
+        )
+    ])
+
+    return telebot.types.InlineKeyboardMarkup(keyboard)
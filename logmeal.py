@@ -0,0 +1,71 @@
+import os
+from dotenv import load_dotenv
+import http_client
+
+load_dotenv()
+
+LOGMEAL_API_KEY = os.getenv('LOGMEAL_API_KEY')
+# Адреса API можно переопределить, например для заглушек из benchmark/
+LOGMEAL_ENDPOINT = os.getenv('LOGMEAL_ENDPOINT', "https://api.logmeal.com/v2/image/segmentation/complete")
+LOGMEAL_HEADERS = {'Authorization': 'Bearer ' + LOGMEAL_API_KEY}
+
+# Несколько блюд на одном фото: минимальная вероятность позиции и их предельное число
+MEAL_ITEM_MIN_PROB = float(os.getenv('MEAL_ITEM_MIN_PROB', 0.3))
+MEAL_MAX_ITEMS = int(os.getenv('MEAL_MAX_ITEMS', 6))
+
+
+def parse_logmeal_segment(segment):
+    """Самый вероятный вариант для одного найденного на фото блюда и его рамка"""
+    recognition_result = max(segment['recognition_results'], key=lambda result: result.get('prob', 1.0))
+    bbox = segment.get('contained_bbox') or {}
+    return {
+        'food_name': recognition_result['name'],
+        'prob': float(recognition_result.get('prob', 1.0)),
+        'bbox': {key: bbox.get(key) for key in ('x', 'y', 'w', 'h')} if bbox else None,
+        'position': segment.get('food_item_position')
+    }
+
+
+def parse_logmeal_response(data):
+    """
+    Достает из ответа Logmeal все блюда на фото (items - по одному на сегмент,
+    с вероятностью и рамкой) и, как раньше, название и вероятность первого из них
+    """
+    items = [parse_logmeal_segment(segment) for segment in data['segmentation_results']
+             if segment.get('recognition_results')]
+    if not items:
+        raise ValueError("Logmeal не нашел еду на фото")
+
+    return {
+        'food_name': items[0]['food_name'],
+        'prob': items[0]['prob'],
+        'items': items
+    }
+
+
+def select_meal_items(logmeal_data):
+    """
+    Блюда с фото, в которых Logmeal достаточно уверен (первое - всегда).
+    Возвращает копии, чтобы не менять закэшированный ответ.
+    """
+    items = logmeal_data.get('items') or [logmeal_data]
+    selected = items[:1] + [item for item in items[1:] if item['prob'] >= MEAL_ITEM_MIN_PROB]
+    return [dict(item) for item in selected[:MEAL_MAX_ITEMS]]
+
+
+def analyze_photo_with_logmeal(image):
+    """
+    Распознает еду на фото через Logmeal API с проверкой вероятности.
+    image - содержимое фото в памяти: bytes, memoryview или BytesIO,
+    оно уходит в multipart-запрос как есть, без записи на диск.
+    """
+    try:
+        response = http_client.post(
+            'logmeal',
+            LOGMEAL_ENDPOINT,
+            files={'image': ('photo.jpg', image, 'image/jpeg')},
+            headers=LOGMEAL_HEADERS
+        )
+        return parse_logmeal_response(response.json())
+    except Exception as e:
+        return {'error': str(e)}
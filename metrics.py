@@ -0,0 +1,267 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Порт страницы /metrics в формате Prometheus (0 - не запускать)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Файл журнала трассировки (JSON Lines); без него журнал не ведется
+TRACE_LOG = os.getenv('TRACE_LOG')
+
+# Границы корзин гистограмм задержки, в секундах
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_counters = {}    # (метрика, метки) -> значение
+_gauges = {}
+_histograms = {}  # (метрика, метки) -> [счетчики по корзинам, сумма, количество]
+_collectors = []  # (префикс, функция статистики)
+
+# Идентификатор запроса: общий для обработчика и всех вызовов API и базы внутри него
+_correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+_trace_logger = logging.getLogger('bot.trace')
+_trace_logger.propagate = False
+if TRACE_LOG:
+    _trace_handler = logging.FileHandler(TRACE_LOG, encoding='utf-8')
+    _trace_handler.setFormatter(logging.Formatter('%(message)s'))
+    _trace_logger.addHandler(_trace_handler)
+    _trace_logger.setLevel(logging.INFO)
+
+
+def _key(metric, labels):
+    return metric, tuple(sorted(labels.items()))
+
+
+def inc(metric, value=1, **labels):
+    key = _key(metric, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def add_gauge(metric, delta, **labels):
+    key = _key(metric, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + delta
+
+
+def observe(metric, seconds, **labels):
+    key = _key(metric, labels)
+    index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+        histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+def register_stats(prefix, func):
+    """
+    Подключает готовую статистику (например, get_nutrition_cache_stats) к /metrics:
+    при каждом опросе числовые значения словаря отдаются как bot_<prefix>_<ключ>,
+    вложенные словари - с меткой name (стадии конвейера и т.п.).
+    """
+    _collectors.append((prefix, func))
+
+
+def correlation_id():
+    return _correlation_id.get()
+
+
+def trace(kind, name, **fields):
+    """Пишет событие в журнал трассировки с идентификатором текущего запроса"""
+    if not TRACE_LOG:
+        return
+    event = {'ts': round(time.time(), 3), 'cid': _correlation_id.get(), 'kind': kind, 'name': name}
+    event.update(fields)
+    _trace_logger.info(json.dumps(event, ensure_ascii=False))
+
+
+@contextmanager
+def track(kind, name):
+    """
+    Замер одного вызова: гистограмма bot_<kind>_duration_seconds, счетчик ошибок
+    bot_<kind>_errors_total (с типом исключения) и число выполняющихся сейчас bot_<kind>_in_flight.
+    """
+    add_gauge(f"bot_{kind}_in_flight", 1, name=name)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        add_gauge(f"bot_{kind}_in_flight", -1, name=name)
+        observe(f"bot_{kind}_duration_seconds", seconds, name=name)
+        if error:
+            inc(f"bot_{kind}_errors_total", name=name, error=error)
+        trace(kind, name, ms=round(seconds * 1000, 2), error=error)
+
+
+def timed(kind, name=None):
+    """Декоратор: track() вокруг каждого вызова функции (обычной или async)"""
+
+    def decorator(func):
+        label = name or func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with track(kind, label):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(kind, label):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def _chat_id(update):
+    message = getattr(update, 'message', None) or update
+    chat = getattr(message, 'chat', None)
+    return chat.id if chat is not None else None
+
+
+@contextmanager
+def request_context(update, name):
+    """
+    Замер обработчика с идентификатором запроса; chat_id попадает в журнал.
+    Обработчик, вызванный из другого обработчика, продолжает его запрос.
+    """
+    parent = _correlation_id.get()
+    token = _correlation_id.set(parent or uuid.uuid4().hex[:16])
+    if parent is None:
+        trace('update', name, chat_id=_chat_id(update))
+    try:
+        with track('handler', name):
+            yield
+    finally:
+        _correlation_id.reset(token)
+
+
+def handler(func):
+    """Декоратор обработчика бота: первый аргумент - Message или CallbackQuery"""
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(update, *args, **kwargs):
+            with request_context(update, func.__name__):
+                return await func(update, *args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(update, *args, **kwargs):
+        with request_context(update, func.__name__):
+            return func(update, *args, **kwargs)
+    return wrapper
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _collect_stats():
+    gauges = {}
+    for prefix, func in _collectors:
+        try:
+            stats = func()
+        except Exception as e:
+            print(f"⚠️ Не удалось собрать статистику {prefix}: {e}")
+            continue
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                for sub_key, sub_value in value.items():
+                    for metric, number in (sub_value.items() if isinstance(sub_value, dict) else ()):
+                        if isinstance(number, (int, float)) and not isinstance(number, bool):
+                            gauges[_key(f"bot_{prefix}_{key}_{metric}", {'name': sub_key})] = number
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges[_key(f"bot_{prefix}_{key}", {})] = value
+    return gauges
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: (list(h[0]), h[1], h[2]) for key, h in _histograms.items()}
+    gauges.update(_collect_stats())
+
+    lines = []
+    for metric_type, values in (('counter', counters), ('gauge', gauges)):
+        for name in sorted({name for name, _ in values}):
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {_format_value(value)}")
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Запускает /metrics в фоновом потоке; при port=0 ничего не делает и возвращает None"""
+    if not port:
+        return None
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"📈 Метрики: http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,194 @@
+import os
+from dotenv import load_dotenv
+import http_client
+from cache import LRUCache, StatsCounter
+from database import (get_cached_nutrition, save_cached_nutrition, get_nutrition_cache_size,
+                      get_known_food_names, translate_to_en)
+from foods import get_local_nutrition, foods_stats
+
+load_dotenv()
+
+NUTRITIONIX_APP_ID = os.getenv('NUTRITIONIX_APP_ID')
+NUTRITIONIX_APP_KEY = os.getenv('NUTRITIONIX_APP_KEY')
+NUTRITIONIX_ENDPOINT = os.getenv('NUTRITIONIX_ENDPOINT', "https://trackapi.nutritionix.com/v2/natural/nutrients")
+
+# Кэш КБЖУ: горячий слой в памяти поверх таблицы nutrition_cache
+NUTRITION_CACHE_TTL = int(os.getenv('NUTRITION_CACHE_TTL', 30 * 24 * 3600))
+NUTRITION_CACHE_MAX_ENTRIES = int(os.getenv('NUTRITION_CACHE_MAX_ENTRIES', 50000))
+nutrition_cache = LRUCache(maxsize=2000, ttl=NUTRITION_CACHE_TTL)
+nutrition_cache_stats = StatsCounter('db_hits', 'requests')
+
+
+def normalize_food_query(food_name):
+    """Ключ кэша КБЖУ: название без регистра и лишних пробелов"""
+    return ' '.join(food_name.casefold().split())
+
+
+def nutritionix_headers():
+    return {
+        'x-app-id': NUTRITIONIX_APP_ID,
+        'x-app-key': NUTRITIONIX_APP_KEY,
+        'Content-Type': 'application/json'
+    }
+
+
+def parse_nutritionix_food(food):
+    """КБЖУ на порцию из одного продукта ответа Nutritionix"""
+    return {
+        'calories': food.get('nf_calories', 0),
+        'protein': food.get('nf_protein', 0),
+        'fat': food.get('nf_total_fat', 0),
+        'carbs': food.get('nf_total_carbohydrate', 0),
+        'serving_weight': food.get('serving_weight_grams', 100)
+    }
+
+
+def get_cached_nutrition_data(query):
+    """Ищет КБЖУ по нормализованному запросу в памяти, затем в базе"""
+    nutrition_data = nutrition_cache.get(query)
+    if nutrition_data:
+        return nutrition_data
+
+    nutrition_data = get_cached_nutrition(query, NUTRITION_CACHE_TTL)
+    if nutrition_data:
+        nutrition_cache_stats.add('db_hits')
+        nutrition_cache.set(query, nutrition_data)
+    return nutrition_data
+
+
+def get_stored_nutrition_data(query):
+    """КБЖУ без сетевого запроса: локальная база продуктов, затем кэш ответов Nutritionix"""
+    return get_local_nutrition(query) or get_cached_nutrition_data(query)
+
+
+def cache_nutrition_data(query, nutrition_data):
+    """Запоминает ответ Nutritionix в обоих уровнях кэша"""
+    save_cached_nutrition(query, nutrition_data, NUTRITION_CACHE_MAX_ENTRIES)
+    nutrition_cache.set(query, nutrition_data)
+
+
+def get_nutritionix_data(food_name):
+    """Получает данные о КБЖУ (локальная база продуктов, кэш, затем Nutritionix)"""
+    query = normalize_food_query(food_name)
+
+    nutrition_data = get_stored_nutrition_data(query)
+    if nutrition_data:
+        return nutrition_data
+
+    nutrition_cache_stats.add('requests')
+    nutrition_data = request_nutritionix_data(query)
+    if nutrition_data:
+        cache_nutrition_data(query, nutrition_data)
+    return nutrition_data
+
+
+def request_nutritionix_data(food_name):
+    """Запрашивает КБЖУ у Nutritionix"""
+    payload = {'query': food_name}
+
+    response = http_client.post('nutritionix', NUTRITIONIX_ENDPOINT, json=payload,
+                                headers=nutritionix_headers())
+    if response.status_code != 200:
+        return None
+
+    foods = response.json().get('foods')
+    return parse_nutritionix_food(foods[0]) if foods else None
+
+
+def build_batch_query(queries):
+    """Один запрос на естественном языке для нескольких блюд ("rice, chicken, salad")"""
+    return ', '.join(queries)
+
+
+def match_batch_foods(queries, foods):
+    """
+    Сопоставляет продукты из ответа Nutritionix с запросами пачки: по порядку,
+    если их столько же, иначе по совпадению названия. Несопоставленные пропускаются.
+    """
+    if len(foods) == len(queries):
+        return dict(zip(queries, foods))
+    by_name = {normalize_food_query(food.get('food_name', '')): food for food in foods}
+    return {query: by_name[query] for query in queries if query in by_name}
+
+
+def request_nutritionix_batch(queries):
+    """Запрашивает КБЖУ нескольких блюд одним запросом: {запрос: КБЖУ}"""
+    response = http_client.post('nutritionix', NUTRITIONIX_ENDPOINT,
+                                json={'query': build_batch_query(queries)},
+                                headers=nutritionix_headers())
+    if response.status_code != 200:
+        return {}
+
+    matched = match_batch_foods(queries, response.json().get('foods', []))
+    return {query: parse_nutritionix_food(food) for query, food in matched.items()}
+
+
+def get_nutritionix_batch(food_names):
+    """
+    КБЖУ сразу для нескольких блюд (список в том же порядке, None - не найдено).
+    Все, чего нет в локальной базе и кэше, запрашивается у Nutritionix одним запросом;
+    по одному дозапрашиваются только блюда, которые не удалось сопоставить с ответом.
+    """
+    queries = [normalize_food_query(food_name) for food_name in food_names]
+    found = {}
+    missing = []
+    for query in dict.fromkeys(queries):
+        nutrition_data = get_stored_nutrition_data(query)
+        if nutrition_data:
+            found[query] = nutrition_data
+        else:
+            missing.append(query)
+
+    fetched = {}
+    if len(missing) > 1:
+        nutrition_cache_stats.add('requests')
+        fetched = request_nutritionix_batch(missing)
+    for query in missing:
+        if query not in fetched:
+            nutrition_cache_stats.add('requests')
+            fetched[query] = request_nutritionix_data(query)
+
+    for query, nutrition_data in fetched.items():
+        if nutrition_data:
+            cache_nutrition_data(query, nutrition_data)
+            found[query] = nutrition_data
+
+    return [found.get(query) for query in queries]
+
+
+def get_nutrition_cache_stats():
+    """Статистика кэша КБЖУ"""
+    stats = nutrition_cache.stats()
+    stats.update(nutrition_cache_stats.snapshot())
+    stats['db_size'] = get_nutrition_cache_size()
+    stats['local_hits'] = foods_stats['hits']
+    return stats
+
+
+def warm_nutrition_cache(limit=500):
+    """Заполняет кэш КБЖУ блюдами, которые уже есть в дневниках"""
+    warmed = 0
+    for food_name, source in get_known_food_names(limit):
+        try:
+            # Английский исходник из кэша переводов избавляет от обратного перевода
+            if get_nutritionix_data(source or translate_to_en(food_name)):
+                warmed += 1
+        except Exception as e:
+            print(f"⚠️ {food_name}: {e}")
+    return warmed
+
+
+def calculate_nutrition(portion_grams, nutrition_data):
+    """Пересчет КБЖУ с учетом исходного веса порции"""
+    if not nutrition_data or 'serving_weight' not in nutrition_data:
+        return None
+
+    base_weight = nutrition_data.get('serving_weight', 100)
+    coefficient = portion_grams / base_weight
+
+    return {
+        'calories': round(nutrition_data['calories'] * coefficient, 1),
+        'protein': round(nutrition_data['protein'] * coefficient, 1),
+        'fat': round(nutrition_data['fat'] * coefficient, 1),
+        'carbs': round(nutrition_data['carbs'] * coefficient, 1)
+    }
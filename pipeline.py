@@ -0,0 +1,202 @@
+import contextvars
+import queue
+import threading
+import time
+from collections import deque
+import metrics
+
+
+class StageStats:
+    """Время ожидания в очереди и время работы одной стадии"""
+
+    def __init__(self, samples=1000):
+        self.count = 0
+        self.errors = 0
+        self.wait = deque(maxlen=samples)
+        self.run = deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def record(self, wait, run, error=False):
+        with self._lock:
+            self.count += 1
+            self.errors += error
+            self.wait.append(wait)
+            self.run.append(run)
+
+    @staticmethod
+    def _percentile(samples, p):
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def snapshot(self):
+        with self._lock:
+            wait, run = list(self.wait), list(self.run)
+            count, errors = self.count, self.errors
+        return {
+            'count': count,
+            'errors': errors,
+            'wait_p50_ms': self._percentile(wait, 0.5) * 1000,
+            'run_p50_ms': self._percentile(run, 0.5) * 1000,
+            'run_p95_ms': self._percentile(run, 0.95) * 1000,
+            'run_max_ms': max(run, default=0.0) * 1000
+        }
+
+
+class Done:
+    """Результат стадии, который завершает задачу без следующих стадий"""
+
+    def __init__(self, result):
+        self.result = result
+
+
+class Job:
+    def __init__(self, user_id, payload, on_done, on_error):
+        self.user_id = user_id
+        self.payload = payload
+        self.on_done = on_done
+        self.on_error = on_error
+        self.enqueued_at = None
+        # Контекст отправителя: стадии в других потоках пишут трассировку от его имени
+        self.context = contextvars.copy_context()
+
+
+class Pipeline:
+    """
+    Конвейер из последовательных стадий.
+    У каждой стадии свой пул потоков, между стадиями - ограниченные очереди:
+    если следующая стадия не успевает, предыдущая ждет (backpressure).
+    Задачи попадают в конвейер по кругу между пользователями, и у одного
+    пользователя одновременно обрабатывается не больше per_user_limit задач.
+    """
+
+    def __init__(self, stages, queue_size=8, per_user_limit=1):
+        """stages - список (название, функция, число потоков)"""
+        self.per_user_limit = per_user_limit
+        self.stats = {name: StageStats() for name, _, _ in stages}
+
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._pending = {}      # user_id -> deque задач, ждущих допуска
+        self._rotation = deque()  # очередность пользователей для допуска
+        self._in_flight = {}
+        self._cond = threading.Condition()
+
+        for index, (name, func, workers) in enumerate(stages):
+            for n in range(workers):
+                threading.Thread(
+                    target=self._worker, args=(index, name, func),
+                    name=f"{name}-{n}", daemon=True
+                ).start()
+        threading.Thread(target=self._dispatcher, name="pipeline-dispatcher", daemon=True).start()
+
+    def submit(self, user_id, payload, on_done, on_error):
+        """
+        Ставит задачу в очередь.
+        Возвращает 0, если задача сразу уходит в работу, иначе ее позицию в очереди.
+        """
+        job = Job(user_id, payload, on_done, on_error)
+        with self._cond:
+            saturated = self._queues[0].full() or self._in_flight.get(user_id, 0) >= self.per_user_limit
+            user_queue = self._pending.setdefault(user_id, deque())
+            if not user_queue:
+                self._rotation.append(user_id)
+            user_queue.append(job)
+            position = self._position(user_id, len(user_queue)) if saturated or len(self) > 1 else 0
+            self._cond.notify_all()
+        return position
+
+    def _position(self, user_id, index):
+        """Сколько задач будет допущено раньше: при обходе по кругу - до index от каждого"""
+        return sum(min(len(jobs), index) for uid, jobs in self._pending.items() if uid != user_id) + index
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def _next_job(self):
+        for _ in range(len(self._rotation)):
+            user_id = self._rotation.popleft()
+            if self._in_flight.get(user_id, 0) >= self.per_user_limit:
+                self._rotation.append(user_id)
+                continue
+
+            jobs = self._pending[user_id]
+            job = jobs.popleft()
+            if jobs:
+                self._rotation.append(user_id)
+            else:
+                del self._pending[user_id]
+            self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+            return job
+        return None
+
+    def _dispatcher(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+            job.enqueued_at = time.perf_counter()
+            self._queues[0].put(job)  # блокируется, пока первая стадия занята
+
+    def _finish(self, job):
+        with self._cond:
+            self._in_flight[job.user_id] -= 1
+            if not self._in_flight[job.user_id]:
+                del self._in_flight[job.user_id]
+            self._cond.notify_all()
+
+    def _worker(self, index, name, func):
+        is_last = index == len(self._queues) - 1
+        while True:
+            job = self._queues[index].get()
+            started = time.perf_counter()
+            wait = started - job.enqueued_at
+            metrics.observe('bot_pipeline_wait_seconds', wait, name=name)
+            try:
+                job.payload = job.context.run(self._run_stage, name, func, job.payload)
+            except Exception as e:
+                self.stats[name].record(wait, time.perf_counter() - started, error=True)
+                self._finish(job)
+                self._notify_error(job, e)
+                continue
+            self.stats[name].record(wait, time.perf_counter() - started)
+
+            if isinstance(job.payload, Done):
+                job.payload = job.payload.result
+                is_done = True
+            else:
+                is_done = is_last
+
+            if is_done:
+                self._finish(job)
+                try:
+                    job.context.run(job.on_done, job.payload)
+                except Exception as e:
+                    self._notify_error(job, e)
+            else:
+                job.enqueued_at = time.perf_counter()
+                self._queues[index + 1].put(job)
+
+    @staticmethod
+    def _notify_error(job, error):
+        """
+        Вызывает on_error. Его собственная ошибка (например, reply_to в
+        заблокированный чат) только пишется в лог и не убивает поток стадии.
+        """
+        try:
+            job.context.run(job.on_error, error)
+        except Exception as e:
+            print(f"⚠️ Ошибка обработчика ошибки конвейера: {e}")
+
+    @staticmethod
+    def _run_stage(name, func, payload):
+        with metrics.track('pipeline', name):
+            return func(payload)
+
+    def snapshot(self):
+        """Статистика по стадиям и размер очереди ожидания"""
+        with self._cond:
+            waiting = len(self)
+        return {'waiting': waiting, 'stages': {name: s.snapshot() for name, s in self.stats.items()}}
@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from dotenv import load_dotenv
+import http_client
+from cache import StatsCounter
+from database import (get_cached_recipe_variants, touch_cached_recipe, save_cached_recipe,
+                      get_recipe_cache_size)
+
+load_dotenv()
+
+TOGETHER_API_KEY = os.getenv('TOGETHER_API_KEY')
+TOGETHER_API_ENDPOINT = os.getenv('TOGETHER_API_ENDPOINT', "https://api.together.xyz/v1/completions")
+TOGETHER_MODEL = "deepseek-ai/deepseek-v3"
+
+# Потоковая генерация: текст появляется в сообщении по мере ответа модели.
+# Telegram ограничивает частоту правок одного сообщения (около одной в секунду)
+RECIPE_STREAMING = os.getenv('RECIPE_STREAMING', '1') == '1'
+RECIPE_EDIT_INTERVAL = float(os.getenv('RECIPE_EDIT_INTERVAL', 1.5))
+
+# Кэш рецептов по набору ингредиентов: на один набор хранится до RECIPE_CACHE_VARIANTS
+# ответов: показывается тот, что дольше всех не показывали, недостающие догенерируются в фоне
+RECIPE_CACHE_TTL = int(os.getenv('RECIPE_CACHE_TTL', 7 * 24 * 3600))
+RECIPE_CACHE_VARIANTS = int(os.getenv('RECIPE_CACHE_VARIANTS', 3))
+RECIPE_CACHE_MAX_ENTRIES = int(os.getenv('RECIPE_CACHE_MAX_ENTRIES', 20000))
+# Потоки фоновой генерации вариантов: постоянный пул, а не поток (и соединение с базой) на каждый ответ
+RECIPE_VARIANT_WORKERS = int(os.getenv('RECIPE_VARIANT_WORKERS', 2))
+recipe_cache_stats = StatsCounter('hits', 'misses')
+_variants_in_progress = set()
+_variants_lock = threading.Lock()
+_variant_executor = None
+
+# Разделы, без которых ответ модели считается некорректным
+RECIPE_SECTIONS = ["• Ингредиенты:", "• Время:", "• Рецепт:"]
+
+
+def together_headers():
+    return {
+        "Authorization": f"Bearer {TOGETHER_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+
+def build_recipe_payload(ingredients, stream=False):
+    """Тело запроса к Together AI для списка ингредиентов"""
+    prompt = (
+        "Ты шеф-повар. Сгенерируй 3 разных рецепта используя ТОЛЬКО эти ингредиенты: "
+        f"{', '.join(ingredients)}.\n\n"
+        "Формат для каждого рецепта:\n"
+        "1. Название (максимум 5 слов)\n"
+        "• Ингредиенты: (только указанные)\n"
+        "• Время: (в минутах)\n"
+        "• Рецепт: (3 четких шага)\n"
+        "• КБЖУ на 100г ~ (в ккал)\n\n"
+        "Пример:\n"
+        "1. Омлет с сыром\n"
+        "• Ингредиенты: яйца, сыр\n"
+        "• Время: 10 мин\n"
+        "• Рецепт: 1. Взбейте яйца. 2. Добавьте сыр. 3. Жарьте 5 мин.\n"
+        "• КБЖУ на 100г ~ 🔥 110 ккал\n"
+        "• 🥩 14 г белков\n"
+        "• 🥑 8 г жиров\n"
+        "• 🍞 4 г углеводов"
+    )
+
+    return {
+        "model": TOGETHER_MODEL,
+        "prompt": prompt,
+        "max_tokens": 1500,
+        "temperature": 0.7,
+        "stop": ["###", "\n\n\n"],
+        "stream": stream
+    }
+
+
+def check_recipes_format(result):
+    """Проверка минимальной структуры ответа"""
+    if not all(x in result for x in RECIPE_SECTIONS):
+        raise Exception("Некорректный формат ответа")
+    return result
+
+
+def recipe_cache_key(ingredients_en):
+    """Ключ кэша: отсортированный набор ингредиентов (на английском) без регистра и повторов"""
+    return ', '.join(sorted({' '.join(ingredient.casefold().split()) for ingredient in ingredients_en}))
+
+
+def get_cached_recipes(key):
+    """
+    Рецепты из кэша: (текст или None, нужен ли еще вариант).
+    Из сохраненных вариантов берется тот, что дольше всех не показывали.
+    """
+    variants = get_cached_recipe_variants(key, RECIPE_CACHE_TTL)
+    if not variants:
+        recipe_cache_stats.add('misses')
+        return None, True
+
+    variant, text = variants[0]
+    touch_cached_recipe(key, variant)
+    recipe_cache_stats.add('hits')
+    return text, len(variants) < RECIPE_CACHE_VARIANTS
+
+
+def cache_recipes(key, text, shown=True):
+    save_cached_recipe(key, text, RECIPE_CACHE_MAX_ENTRIES, shown)
+
+
+def schedule_recipe_variant(key, ingredients):
+    """
+    Ставит в фоновый пул генерацию еще одного варианта рецептов для кэша.
+    Вызывается после ответа из кэша, поэтому пользователь не ждет, а ответы
+    со временем разнообразнее. На один набор - не больше одной генерации сразу.
+    """
+    with _variants_lock:
+        if key in _variants_in_progress:
+            return
+        _variants_in_progress.add(key)
+    _get_variant_executor().submit(add_recipe_variant, key, ingredients)
+
+
+def add_recipe_variant(key, ingredients):
+    """Генерирует и сохраняет вариант рецептов (в потоке пула schedule_recipe_variant)"""
+    try:
+        cache_recipes(key, generate_recipes_with_together(ingredients), shown=False)
+    except Exception as e:
+        print(f"⚠️ Не удалось сгенерировать вариант рецептов ({key}): {e}")
+    finally:
+        with _variants_lock:
+            _variants_in_progress.discard(key)
+
+
+def _get_variant_executor():
+    global _variant_executor
+    with _variants_lock:
+        if _variant_executor is None:
+            _variant_executor = ThreadPoolExecutor(max_workers=RECIPE_VARIANT_WORKERS,
+                                                   thread_name_prefix="recipe-variant")
+        return _variant_executor
+
+
+def get_recipe_cache_stats():
+    """Статистика кэша рецептов"""
+    counts = recipe_cache_stats.snapshot()
+    total = counts['hits'] + counts['misses']
+    return {
+        'hits': counts['hits'],
+        'misses': counts['misses'],
+        'hit_ratio': counts['hits'] / total if total else 0.0,
+        'db_size': get_recipe_cache_size()
+    }
+
+
+def parse_stream_line(line):
+    """
+    Кусок текста из строки потока Together (server-sent events, 'data: {...}').
+    Для служебных строк - пустая строка, в конце потока - None.
+    """
+    if not line.startswith('data:'):
+        return ''
+    data = line[5:].strip()
+    if data == '[DONE]':
+        return None
+
+    chunk = json.loads(data)
+    if chunk.get('error'):
+        raise Exception(f"API Error: {chunk['error'].get('message', chunk['error'])}")
+    choice = (chunk.get('choices') or [{}])[0]
+    return choice.get('text') or (choice.get('delta') or {}).get('content') or ''
+
+
+class EditThrottle:
+    """Решает, пора ли снова править сообщение: первый раз - сразу, дальше не чаще interval"""
+
+    def __init__(self, interval=RECIPE_EDIT_INTERVAL):
+        self.interval = interval
+        self._next = 0.0
+
+    def ready(self):
+        now = time.monotonic()
+        if now < self._next:
+            return False
+        self._next = now + self.interval
+        return True
+
+    def postpone(self, seconds):
+        """Telegram ответил 429 - ждем столько, сколько он просит"""
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+def stream_recipes_with_together(ingredients):
+    """Генерирует рецепты потоком: отдает куски текста по мере их появления"""
+    try:
+        response = http_client.post(
+            'together',
+            TOGETHER_API_ENDPOINT,
+            json=build_recipe_payload(ingredients, stream=True),
+            headers=together_headers(),
+            stream=True
+        )
+        with response:
+            if response.status_code != 200:
+                error_msg = response.json().get('error', {}).get('message', 'Unknown error')
+                raise Exception(f"API Error: {error_msg}")
+
+            # У text/event-stream нет charset, иначе requests декодирует как latin-1
+            response.encoding = 'utf-8'
+            for line in response.iter_lines(decode_unicode=True):
+                chunk = parse_stream_line(line)
+                if chunk is None:
+                    return
+                if chunk:
+                    yield chunk
+
+    except requests.exceptions.Timeout:
+        raise Exception("Превышено время ожидания ответа от Together AI")
+    except Exception as e:
+        raise Exception(f"Ошибка генерации рецептов: {str(e)}")
+
+
+def generate_recipes_with_together(ingredients):
+    try:
+        response = http_client.post(
+            'together',
+            TOGETHER_API_ENDPOINT,
+            json=build_recipe_payload(ingredients),
+            headers=together_headers()
+        )
+
+        # Проверка статуса ответа
+        if response.status_code != 200:
+            error_msg = response.json().get('error', {}).get('message', 'Unknown error')
+            raise Exception(f"API Error: {error_msg}")
+
+        return check_recipes_format(response.json()["choices"][0]["text"])
+
+    except requests.exceptions.Timeout:
+        raise Exception("Превышено время ожидания ответа от Together AI")
+    except Exception as e:
+        raise Exception(f"Ошибка генерации рецептов: {str(e)}")
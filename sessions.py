@@ -0,0 +1,133 @@
+import abc
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from database import get_session_data, save_session_data, delete_session_data, purge_sessions
+
+load_dotenv()
+
+# memory - только внутри процесса, sqlite - общая база для нескольких процессов бота
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_TTL = int(os.getenv('SESSION_TTL', 3600))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 10000))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', 16 * 1024 * 1024))
+
+
+def pack(data):
+    """Компактное представление записи: JSON без пробелов в UTF-8"""
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def unpack(raw):
+    return json.loads(raw)
+
+
+class SessionStore(abc.ABC):
+    """Незавершенные записи пользователей (блюдо ждет ввода веса или сохранения)"""
+
+    @abc.abstractmethod
+    def get(self, chat_id):
+        """Данные сессии или None, если ее нет или истек срок жизни"""
+
+    @abc.abstractmethod
+    def set(self, chat_id, data):
+        """Сохраняет данные сессии, продлевая срок жизни"""
+
+    @abc.abstractmethod
+    def delete(self, chat_id):
+        """Удаляет сессию (если ее нет - ничего не делает)"""
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Хранилище в памяти процесса с TTL и ограничением по числу записей и байтам.
+    При переполнении вытесняются записи, которые дольше всех не обновлялись.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES, max_bytes=SESSION_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # chat_id -> (байты, срок жизни)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        with self._lock:
+            item = self._data.get(chat_id)
+            if item is None:
+                return None
+            if item[1] <= time.monotonic():
+                self._remove(chat_id)
+                return None
+            return unpack(item[0])
+
+    def set(self, chat_id, data):
+        raw = pack(data)
+        with self._lock:
+            self._remove(chat_id)
+            self._data[chat_id] = (raw, time.monotonic() + self.ttl)
+            self._size += len(raw)
+            self._evict()
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._remove(chat_id)
+
+    def _remove(self, chat_id):
+        item = self._data.pop(chat_id, None)
+        if item is not None:
+            self._size -= len(item[0])
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._data:
+            chat_id, (raw, expires_at) = next(iter(self._data.items()))
+            if expires_at > now and len(self._data) <= self.max_entries and self._size <= self.max_bytes:
+                break
+            self._remove(chat_id)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Хранилище в таблице sessions общей базы: записи переживают перезапуск
+    и видны всем процессам бота, работающим с тем же файлом.
+    """
+
+    # Как часто (в записях) чистить устаревшие сессии
+    PURGE_EVERY = 500
+
+    def __init__(self, ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Счетчик записей: next() атомарен, в отличие от += из нескольких потоков
+        self._writes = itertools.count(1)
+
+    def get(self, chat_id):
+        raw = get_session_data(chat_id)
+        return unpack(raw) if raw is not None else None
+
+    def set(self, chat_id, data):
+        save_session_data(chat_id, pack(data), self.ttl)
+        if next(self._writes) % self.PURGE_EVERY == 0:
+            purge_sessions(self.max_entries)
+
+    def delete(self, chat_id):
+        delete_session_data(chat_id)
+
+
+def create_session_store(backend=None):
+    """Создает хранилище сессий по настройке SESSION_BACKEND"""
+    backend = backend or SESSION_BACKEND
+    if backend == 'sqlite':
+        return SQLiteSessionStore()
+    if backend == 'memory':
+        return MemorySessionStore()
+    raise ValueError(f"Неизвестное хранилище сессий: {backend}")
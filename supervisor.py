@@ -0,0 +1,328 @@
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+import requests
+import telebot
+import http_client
+from webhook import update_chat_id, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET
+
+load_dotenv()
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Telegram Bot.py')
+
+# Число шардов и порт первого из них: шард i слушает SHARD_BASE_PORT + i
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', os.cpu_count() or 2))
+SHARD_BASE_PORT = int(os.getenv('SHARD_BASE_PORT', 9000))
+# Точек на кольце у каждого шарда: чем больше, тем ровнее распределение чатов
+SHARD_VNODES = int(os.getenv('SHARD_VNODES', 160))
+# 1 - у каждого шарда свой файл дневника (food_diary.shard3.db)
+SHARD_DB_PER_SHARD = os.getenv('SHARD_DB_PER_SHARD', '0') == '1'
+# Где шарды сохраняют ожидающие шаги диалога (register_next_step_handler)
+SHARD_STATE_DIR = os.getenv('SHARD_STATE_DIR', '.handler-saves')
+# Адрес, на котором слушают шарды (0.0.0.0, если маршрутизатор на другой машине)
+SHARD_LISTEN_HOST = os.getenv('SHARD_LISTEN_HOST', '127.0.0.1')
+# Через сколько секунд перезапускать упавший шард
+SHARD_RESTART_DELAY = float(os.getenv('SHARD_RESTART_DELAY', 2))
+
+
+class HashRing:
+    """
+    Консистентное хеширование chat_id по шардам. Каждый шард занимает
+    SHARD_VNODES точек кольца; при добавлении или удалении шарда
+    переезжает только около 1/N чатов, а не почти все, как при chat_id % N.
+    """
+
+    def __init__(self, nodes, vnodes=SHARD_VNODES):
+        self.nodes = list(nodes)
+        points = sorted(
+            (self._hash(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key):
+        # md5 дает одинаковое кольцо во всех процессах и на всех машинах
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def shard_db_path(shard_id, path=None):
+    """food_diary.db -> food_diary.shard3.db"""
+    root, ext = os.path.splitext(path or os.getenv('FOOD_DIARY_DB', 'food_diary.db'))
+    return f"{root}.shard{shard_id}{ext or '.db'}"
+
+
+def shard_layout_path(path=None):
+    """food_diary.db -> food_diary.shards: число шардов, по которому разложены базы"""
+    root, _ = os.path.splitext(path or os.getenv('FOOD_DIARY_DB', 'food_diary.db'))
+    return f"{root}.shards"
+
+
+def check_shard_layout(shard_count):
+    """
+    При SHARD_DB_PER_SHARD история чата лежит в базе его шарда. Другое число
+    шардов переназначит чаты файлам без их истории, поэтому запуск с числом
+    шардов, отличным от записанного, запрещен. Смена числа шардов (бот остановлен):
+      1. для каждого chat_id из старых баз: python export.py <chat_id> -o <chat_id>.csv;
+      2. новый шард чата - HashRing(range(<новое число>)).node_for(chat_id);
+      3. FOOD_DIARY_DB=food_diary.shard<N>.db python import_diary.py <chat_id>.csv (в новые файлы);
+      4. убрать старые файлы шардов и food_diary.shards, запустить новое число шардов.
+    """
+    if not SHARD_DB_PER_SHARD:
+        return
+    path = shard_layout_path()
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            recorded = int(f.read().strip() or 0)
+        if recorded != shard_count:
+            raise SystemExit(
+                f"❌ Базы шардов разложены на {recorded} шардов, а запускается {shard_count}. "
+                f"Смена числа шардов требует переноса дневников (см. check_shard_layout в supervisor.py)"
+            )
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(str(shard_count))
+
+
+def shard_env(shard_id, port):
+    """Окружение процесса шарда: webhook на локальном порту и свои файлы состояния"""
+    env = dict(os.environ)
+    env.update({
+        'SHARD_ID': str(shard_id),
+        'WEBHOOK_HOST': SHARD_LISTEN_HOST,
+        'WEBHOOK_PORT': str(port),
+        'WEBHOOK_PATH': WEBHOOK_PATH,
+        'NEXT_STEP_SAVE_FILE': os.path.join(SHARD_STATE_DIR, f"step.shard{shard_id}.save"),
+    })
+    # Вебхук в Telegram регистрирует только маршрутизатор, секрет шардам не нужен
+    env.pop('WEBHOOK_URL', None)
+    env.pop('WEBHOOK_SECRET', None)
+    # Незавершенные записи - в базе, чтобы переживать перезапуск шарда
+    env.setdefault('SESSION_BACKEND', 'sqlite')
+    if SHARD_DB_PER_SHARD:
+        env['FOOD_DIARY_DB'] = shard_db_path(shard_id)
+    # У каждого шарда своя страница метрик: METRICS_PORT + номер шарда
+    if int(os.getenv('METRICS_PORT', 0)):
+        env['METRICS_PORT'] = str(int(os.getenv('METRICS_PORT')) + shard_id)
+    return env
+
+
+class ShardProcesses:
+    """Локальные процессы шардов; упавший процесс перезапускается"""
+
+    def __init__(self, shard_ids, base_port=SHARD_BASE_PORT):
+        self.ports = {shard_id: base_port + shard_id for shard_id in shard_ids}
+        self._processes = {}
+        self._stopping = threading.Event()
+
+    def start(self):
+        os.makedirs(SHARD_STATE_DIR, exist_ok=True)
+        for shard_id in self.ports:
+            self._spawn(shard_id)
+        threading.Thread(target=self._watch, name="shard-watch", daemon=True).start()
+
+    def _spawn(self, shard_id):
+        self._processes[shard_id] = subprocess.Popen(
+            [sys.executable, BOT_SCRIPT, 'webhook'],
+            env=shard_env(shard_id, self.ports[shard_id])
+        )
+
+    def _watch(self):
+        while not self._stopping.wait(1):
+            for shard_id, process in list(self._processes.items()):
+                if process.poll() is not None and not self._stopping.is_set():
+                    print(f"⚠️ Шард {shard_id} завершился с кодом {process.returncode}, перезапуск")
+                    time.sleep(SHARD_RESTART_DELAY)
+                    self._spawn(shard_id)
+
+    def stop(self, timeout=30):
+        """SIGTERM всем шардам: каждый дорабатывает принятые обновления и сохраняет шаги диалога"""
+        self._stopping.set()
+        for process in self._processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in self._processes.values():
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class ShardRouter:
+    """Пересылает обновления Telegram в шард, которому принадлежит чат"""
+
+    def __init__(self, shard_urls):
+        self.shard_urls = list(shard_urls)
+        self.ring = HashRing(range(len(self.shard_urls)))
+
+    def shard_for(self, update):
+        chat_id = update_chat_id(update)
+        return self.ring.node_for(chat_id if chat_id is not None else update.update_id)
+
+    def forward(self, shard_id, body):
+        """Отправляет тело обновления шарду как есть; возвращает HTTP-статус ответа"""
+        try:
+            response = http_client.post(
+                'shards', self.shard_urls[shard_id], data=body,
+                headers={'Content-Type': 'application/json'}
+            )
+            return response.status_code
+        except requests.RequestException as e:
+            print(f"⚠️ Шард {shard_id} недоступен: {e}")
+            return 503
+
+    def route(self, body):
+        update = telebot.types.Update.de_json(json.loads(body))
+        return self.forward(self.shard_for(update), body)
+
+
+def create_router_server(router, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    """
+    Точка входа вебхука Telegram. Статус шарда возвращается Telegram,
+    поэтому 503 от перегруженного шарда приводит к повторной доставке.
+    """
+
+    class RouterHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            if self.path != path:
+                return self._reply(404)
+            if secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+                return self._reply(403)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                status = router.route(body)
+            except (ValueError, TypeError, KeyError):
+                status = 400
+            self._reply(status)
+
+        def do_GET(self):
+            self._reply(200, f"ok, shards {len(router.shard_urls)}")
+
+        def _reply(self, status, text=''):
+            body = text.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), RouterHandler)
+    server.daemon_threads = True
+    return server
+
+
+def poll_updates(router, stop_event, timeout=30):
+    """
+    Забирает обновления через getUpdates и раздает их шардам. Пачка делится
+    по шардам с сохранением порядка, шарды получают свои части параллельно.
+    offset сдвигается только после того, как все шарды приняли пачку.
+    """
+    bot = telebot.TeleBot(os.getenv('TELEGRAM_BOT_TOKEN'))
+    bot.remove_webhook()
+    offset = None
+    with ThreadPoolExecutor(max_workers=len(router.shard_urls), thread_name_prefix="route") as executor:
+        while not stop_event.is_set():
+            try:
+                updates = bot.get_updates(offset=offset, timeout=timeout)
+            except Exception as e:
+                print(f"⚠️ Ошибка getUpdates: {e}")
+                stop_event.wait(3)
+                continue
+
+            batches = {}
+            for update in updates:
+                body = json.dumps(update.json, ensure_ascii=False).encode('utf-8')
+                batches.setdefault(router.shard_for(update), []).append((update.update_id, body))
+
+            failed = list(executor.map(lambda item: _deliver(router, *item), batches.items()))
+            accepted = [update.update_id for update in updates]
+            first_failed = min((update_id for update_id in failed if update_id is not None), default=None)
+            if first_failed is not None:
+                # Неотправленное запросим снова; уже принятое шардами придет повторно,
+                # но шард узнает update_id (webhook.RecentIds) и не обработает его второй раз
+                accepted = [update_id for update_id in accepted if update_id < first_failed]
+                stop_event.wait(1)
+            if accepted:
+                offset = max(accepted) + 1
+
+
+def _deliver(router, shard_id, batch):
+    """Отправляет обновления шарду по порядку; возвращает update_id первого неотправленного"""
+    for update_id, body in batch:
+        if router.forward(shard_id, body) != 200:
+            return update_id
+    return None
+
+
+def local_shard_url(shard_id):
+    return f"http://127.0.0.1:{SHARD_BASE_PORT + shard_id}{WEBHOOK_PATH}"
+
+
+# Пример использования:
+#   python supervisor.py --shards 4                       # все шарды и маршрутизатор на одной машине
+#   python supervisor.py --shards 4 --local 2,3 --no-router   # узел, на котором работают шарды 2 и 3
+#   python supervisor.py --nodes http://a:9000/telegram,http://a:9001/telegram,http://b:9002/telegram
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Запуск бота несколькими процессами с шардированием по chat_id")
+    parser.add_argument('--shards', type=int, default=SHARD_COUNT, help="число шардов")
+    parser.add_argument('--local', help="номера шардов, запускаемых на этой машине (по умолчанию все)")
+    parser.add_argument('--nodes', help="адреса всех шардов через запятую, по порядку номеров")
+    parser.add_argument('--no-router', action='store_true', help="не принимать обновления от Telegram")
+    parser.add_argument('--polling', action='store_true', help="забирать обновления через getUpdates")
+    args = parser.parse_args()
+
+    if args.nodes:
+        shard_urls = [url.strip() for url in args.nodes.split(',') if url.strip()]
+        local_ids = [int(i) for i in args.local.split(',')] if args.local else []
+    else:
+        shard_urls = [local_shard_url(i) for i in range(args.shards)]
+        local_ids = [int(i) for i in args.local.split(',')] if args.local else list(range(args.shards))
+
+    check_shard_layout(len(shard_urls))
+    processes = ShardProcesses(local_ids)
+    processes.start()
+    print(f"🟢 Запущено шардов: {len(local_ids)} из {len(shard_urls)}")
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    try:
+        if args.no_router:
+            stop_event.wait()
+        elif args.polling:
+            poll_updates(ShardRouter(shard_urls), stop_event)
+        else:
+            server = create_router_server(ShardRouter(shard_urls))
+            if WEBHOOK_URL:
+                bot = telebot.TeleBot(os.getenv('TELEGRAM_BOT_TOKEN'))
+                bot.remove_webhook()
+                bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=100)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            print(f"🌐 Маршрутизатор слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            stop_event.wait()
+            server.shutdown()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        processes.stop()
+        http_client.close_sessions()
@@ -0,0 +1,259 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+import database
+
+# Схема diary до колонки day и таблицы daily_totals
+BASELINE_DIARY_SQL = '''
+CREATE TABLE diary (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER,
+    date TEXT,
+    food_name TEXT,
+    portion_grams REAL,
+    calories REAL,
+    protein REAL,
+    fat REAL,
+    carbs REAL,
+    photo_id TEXT
+)
+'''
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Каждый тест работает со своим файлом базы во временном каталоге"""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._db_path = database.DB_PATH
+        database.close_connections()
+        database.DB_PATH = os.path.join(self._tmp.name, 'food_diary.db')
+        database._month_days_cache.clear()
+
+    def tearDown(self):
+        database.close_connections()
+        database.DB_PATH = self._db_path
+        database._month_days_cache.clear()
+        self._tmp.cleanup()
+
+    def query(self, sql, params=()):
+        return database.get_connection().execute(sql, params).fetchall()
+
+    def init_diary(self, write_behind=False):
+        """Схема и переводы названий заранее в кэше: сохранение записи не ходит в сеть"""
+        self.addCleanup(setattr, database, 'DIARY_WRITE_BEHIND', database.DIARY_WRITE_BEHIND)
+        database.DIARY_WRITE_BEHIND = write_behind
+        database.init_db()
+        for name in ('oatmeal', 'apple', 'soup'):
+            database.save_translation(name, 'ru', name.upper())
+
+    def totals(self, chat_id):
+        return self.query(
+            'SELECT day, calories, protein, fat, carbs, entry_count FROM daily_totals WHERE chat_id = ? ORDER BY day',
+            (chat_id,)
+        )
+
+    def recomputed(self, chat_id):
+        return self.query('''
+        SELECT day, SUM(calories), SUM(protein), SUM(fat), SUM(carbs), COUNT(*)
+        FROM diary WHERE chat_id = ? GROUP BY day ORDER BY day
+        ''', (chat_id,))
+
+
+class SchemaMigrationTest(DatabaseTestCase):
+    def create_baseline_db(self, rows):
+        conn = sqlite3.connect(database.DB_PATH)
+        with conn:
+            conn.execute(BASELINE_DIARY_SQL)
+            conn.executemany(
+                'INSERT INTO diary (chat_id, date, food_name, portion_grams, calories, protein, fat, carbs) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows
+            )
+        conn.close()
+
+    def test_baseline_db_gets_day_column_and_totals(self):
+        self.create_baseline_db([
+            (1, '2024-03-01 08:00:00', 'Каша', 200, 150, 5, 3, 27),
+            (1, '2024-03-01 13:30:00', 'Суп', 300, 120, 6, 4, 15),
+            (1, '2024-03-02 09:00:00', 'Яблоко', 150, 78, 0.4, 0.3, 20.7),
+            (2, '2024-03-01 19:00:00', 'Творог', 100, 121, 17, 5, 1.8),
+        ])
+
+        database.init_db()
+
+        self.assertEqual(self.query('PRAGMA user_version'), [(database.SCHEMA_VERSION,)])
+        self.assertEqual(self.query('SELECT day FROM diary ORDER BY id'),
+                         [('2024-03-01',), ('2024-03-01',), ('2024-03-02',), ('2024-03-01',)])
+        self.assertEqual(
+            self.query('SELECT chat_id, day, calories, entry_count FROM daily_totals ORDER BY chat_id, day'),
+            [(1, '2024-03-01', 270, 2), (1, '2024-03-02', 78, 1), (2, '2024-03-01', 121, 1)]
+        )
+        self.assertEqual(database.get_month_days(1, 2024, 3), 1 << 1 | 1 << 2)
+
+    def test_day_backfill_runs_once(self):
+        self.create_baseline_db([(1, '2024-03-01 08:00:00', 'Каша', 200, 150, 5, 3, 27)])
+        database.init_db()
+
+        # После миграции init_db больше не проходит по всему diary
+        with database.get_connection() as conn:
+            conn.execute('UPDATE diary SET day = NULL')
+        database.init_db()
+
+        self.assertEqual(self.query('SELECT day FROM diary'), [(None,)])
+
+    def test_new_db_starts_at_current_version(self):
+        database.init_db()
+
+        self.assertEqual(self.query('PRAGMA user_version'), [(database.SCHEMA_VERSION,)])
+        columns = {row[1] for row in self.query('PRAGMA table_info(diary)')}
+        self.assertIn('day', columns)
+
+
+class DailyTotalsTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.init_diary()
+
+    def test_saves_and_deletes_keep_totals_in_sync(self):
+        database.save_to_diary(1, 'oatmeal', 200, {'calories': 150, 'protein': 5, 'fat': 3, 'carbs': 27})
+        database.save_meal_to_diary(1, [
+            ('apple', 150, {'calories': 78, 'protein': 0.5, 'fat': 0.5, 'carbs': 20}),
+            ('soup', 300, {'calories': 120, 'protein': 6, 'fat': 4, 'carbs': 15}),
+        ])
+        database.save_to_diary(2, 'soup', 100, {'calories': 40, 'protein': 2, 'fat': 1, 'carbs': 5})
+
+        [(day, calories, protein, fat, carbs, count)] = self.totals(1)
+        self.assertEqual((calories, protein, fat, carbs, count), (348, 11.5, 7.5, 62, 3))
+        self.assertEqual(self.totals(1), self.recomputed(1))
+        self.assertEqual(database.get_daily_summary(1, day)['calories'], 348)
+
+        apple_id = self.query("SELECT id FROM diary WHERE food_name = 'APPLE'")[0][0]
+        database.delete_diary_entry(apple_id, 1)
+        self.assertEqual(self.totals(1), [(day, 270, 11, 7, 42, 2)])
+
+        # Чужую запись удалить нельзя: итоги обоих чатов не меняются
+        soup_id = self.query('SELECT id FROM diary WHERE chat_id = 2')[0][0]
+        database.delete_diary_entry(soup_id, 1)
+        self.assertEqual(self.totals(2), self.recomputed(2))
+
+    def test_deleting_last_entry_removes_day(self):
+        database.save_to_diary(1, 'apple', 100, {'calories': 52, 'protein': 0.3, 'fat': 0.2, 'carbs': 14})
+        [(entry_id, day)] = self.query('SELECT id, day FROM diary')
+        year, month = int(day[:4]), int(day[5:7])
+        self.assertTrue(database.get_month_days(1, year, month) >> int(day[8:]) & 1)
+
+        database.delete_diary_entry(entry_id, 1)
+
+        self.assertEqual(self.totals(1), [])
+        self.assertEqual(database.get_daily_summary(1, day)['calories'], 0)
+        self.assertEqual(database.get_month_days(1, year, month), 0)
+
+    def test_rebuild_matches_incremental_totals(self):
+        database.save_to_diary(1, 'oatmeal', 200, {'calories': 150, 'protein': 5, 'fat': 3, 'carbs': 27})
+        database.save_to_diary(1, 'apple', 150, {'calories': 78, 'protein': 0.5, 'fat': 0.5, 'carbs': 20})
+        database.insert_diary_rows([(1, '2024-01-05 12:00:00', 'SOUP', 300, 120, 6, 4, 15, None, '2024-01-05')])
+        incremental = self.totals(1)
+
+        self.assertEqual(database.rebuild_daily_totals(), 2)
+        self.assertEqual(self.totals(1), self.recomputed(1))
+        self.assertEqual(self.totals(1)[1:], incremental)
+
+
+class DiaryWriterShutdownTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.init_diary(write_behind=True)
+        # Сам писатель сбросит очередь не раньше чем через минуту: все строки пишет остановка
+        database._diary_writer = database.DiaryWriter(flush_interval=60, batch_size=10000)
+
+    def tearDown(self):
+        database.stop_diary_writer()
+        super().tearDown()
+
+    def test_stop_writes_every_queued_row(self):
+        def save(chat_id):
+            for _ in range(50):
+                database.save_to_diary(chat_id, 'oatmeal', 200, {'calories': 150, 'protein': 5, 'fat': 3, 'carbs': 27})
+                database.save_meal_to_diary(chat_id, [
+                    ('apple', 150, {'calories': 78, 'protein': 0.5, 'fat': 0.5, 'carbs': 20}),
+                    ('soup', 300, {'calories': 120, 'protein': 6, 'fat': 4, 'carbs': 15}),
+                ])
+
+        threads = [threading.Thread(target=save, args=(chat_id,)) for chat_id in (1, 2, 3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Отдельное соединение: чтение через database дождалось бы записи чата
+        conn = sqlite3.connect(database.DB_PATH)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM diary').fetchone(), (0,))
+
+        database.stop_diary_writer()
+
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM diary').fetchone(), (450,))
+        conn.close()
+        for chat_id in (1, 2, 3):
+            [(day, calories, protein, fat, carbs, count)] = self.totals(chat_id)
+            self.assertEqual((calories, count), (50 * 348, 150))
+            self.assertEqual(self.totals(chat_id), self.recomputed(chat_id))
+
+
+class MonthDaysCacheTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        database.init_db()
+
+    def test_mask_read_before_concurrent_write_is_not_cached(self):
+        database.insert_diary_rows([(1, '2024-03-01 12:00:00', 'SOUP', 300, 120, 6, 4, 15, None, '2024-03-01')])
+        database.rebuild_daily_totals()
+        get_connection = database.get_connection
+
+        class ReaderConnection:
+            """Выполняет запрос читателя, а затем, до записи в кэш, дает другому потоку закоммитить день"""
+
+            def execute(self, sql, params=()):
+                cursor = get_connection().execute(sql, params)
+                writer = threading.Thread(target=commit_day)
+                writer.start()
+                writer.join()
+                return cursor
+
+        def commit_day():
+            conn = get_connection()
+            with conn:
+                conn.execute(database.INSERT_DIARY_SQL,
+                             (1, '2024-03-02 12:00:00', 'APPLE', 150, 78, 0.5, 0.5, 20, None, '2024-03-02'))
+                database._add_to_daily_totals(conn, 1, '2024-03-02', {
+                    'calories': 78, 'protein': 0.5, 'fat': 0.5, 'carbs': 20
+                }, 1)
+            database._invalidate_month_days(1, '2024-03-02')
+
+        database.get_connection = ReaderConnection
+        try:
+            database.get_month_days(1, 2024, 3)
+        finally:
+            database.get_connection = get_connection
+
+        self.assertEqual(database.get_month_days(1, 2024, 3), 1 << 1 | 1 << 2)
+
+
+class CacheEvictionTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        database.init_db()
+
+    def test_nutrition_cache_is_trimmed_periodically(self):
+        nutrition_data = {'calories': 1, 'protein': 1, 'fat': 1, 'carbs': 1, 'serving_weight': 100}
+        for i in range(database.CACHE_EVICT_EVERY * 2):
+            database.save_cached_nutrition(f"food {i}", nutrition_data, max_entries=10)
+
+        # После последнего вытеснения добавилось меньше CACHE_EVICT_EVERY записей
+        self.assertLess(database.get_nutrition_cache_size(), 10 + database.CACHE_EVICT_EVERY)
+        self.assertIsNotNone(database.get_cached_nutrition(f"food {database.CACHE_EVICT_EVERY * 2 - 1}", 3600))
+
+
+if __name__ == '__main__':
+    unittest.main()
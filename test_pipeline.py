@@ -0,0 +1,30 @@
+import threading
+import unittest
+from pipeline import Pipeline
+
+
+class PipelineCallbackErrorsTest(unittest.TestCase):
+    def test_failing_callbacks_do_not_kill_stage_workers(self):
+        def stage(payload):
+            if payload == 'bad':
+                raise ValueError("стадия")
+            return payload
+
+        def broken_callback(_):
+            raise RuntimeError("reply_to упал")
+
+        # По одному потоку на стадию: если он умрет, следующая задача зависнет
+        pipeline = Pipeline([('first', stage, 1), ('second', stage, 1)])
+        done = threading.Event()
+
+        # Ошибка стадии, затем падающий on_error
+        pipeline.submit(1, 'bad', broken_callback, broken_callback)
+        # Стадии прошли, но падают и on_done, и on_error
+        pipeline.submit(2, 'ok', broken_callback, broken_callback)
+        pipeline.submit(3, 'ok', lambda payload: done.set(), broken_callback)
+
+        self.assertTrue(done.wait(5), "следующая задача не завершилась")
+
+
+if __name__ == '__main__':
+    unittest.main()
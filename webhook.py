@@ -0,0 +1,196 @@
+import json
+import os
+import queue
+import signal
+import threading
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+import telebot
+
+load_dotenv()
+
+# Адрес, на котором слушает приемник обновлений (за ним обычно nginx с TLS)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Публичный URL для setWebhook; без него вебхук не регистрируется (локальные тесты)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 100))
+# Сколько секунд ждать места в очереди, прежде чем вернуть Telegram 503 (он повторит)
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv('WEBHOOK_QUEUE_TIMEOUT', 5))
+# Сколько последних update_id помнить, чтобы не обработать повторную доставку дважды
+WEBHOOK_DEDUP_SIZE = int(os.getenv('WEBHOOK_DEDUP_SIZE', 10000))
+
+
+def update_chat_id(update):
+    """Чат, к которому относится обновление (None - если чата нет, например inline-запрос)"""
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    for event in (update.my_chat_member, update.chat_member, update.chat_join_request):
+        if event is not None:
+            return event.chat.id
+    return None
+
+
+class RecentIds:
+    """
+    Ограниченное множество недавно принятых update_id. Telegram и маршрутизатор
+    supervisor.py могут доставить обновление повторно (после 503 или таймаута),
+    а повторный save_ записал бы в дневник вторую строку.
+    """
+
+    def __init__(self, size=WEBHOOK_DEDUP_SIZE):
+        self.size = size
+        self._ids = set()
+        self._order = deque()
+        self._lock = threading.Lock()
+
+    def add(self, update_id):
+        """Запоминает id; False - если он уже был"""
+        with self._lock:
+            if update_id in self._ids:
+                return False
+            self._ids.add(update_id)
+            self._order.append(update_id)
+            if len(self._order) > self.size:
+                self._ids.discard(self._order.popleft())
+            return True
+
+    def discard(self, update_id):
+        """Забывает id, если обновление так и не приняли в работу (его доставят снова)"""
+        with self._lock:
+            self._ids.discard(update_id)
+
+
+class ChatOrderedWorkers:
+    """
+    Пул потоков, где обновления одного чата всегда попадают в один и тот же поток.
+    Разные чаты обрабатываются параллельно, а внутри чата порядок сохраняется,
+    поэтому цепочки register_next_step_handler работают как при polling.
+    """
+
+    def __init__(self, handler, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.handler = handler
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"webhook-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, item, timeout=WEBHOOK_QUEUE_TIMEOUT):
+        """Ставит обновление в очередь потока чата; False - если очередь так и не освободилась"""
+        # crc32, а не hash(): одинаковое распределение во всех процессах
+        index = zlib.crc32(str(key).encode()) % len(self._queues)
+        try:
+            self._queues[index].put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            return False
+
+    def stop(self):
+        """Дорабатывает уже принятые обновления и останавливает потоки"""
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def backlog(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                self.handler(item)
+            except Exception as e:
+                print(f"⚠️ Ошибка обработки обновления: {e}")
+
+
+def create_webhook_server(bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                          secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS):
+    """
+    HTTP-сервер, который принимает обновления Telegram и раздает их обработчикам бота.
+    Ответ Telegram отправляется сразу после постановки в очередь, не дожидаясь обработки.
+    """
+    # Обработчики должны выполняться в потоке чата, а не в пуле самого telebot
+    bot.threaded = False
+    pool = ChatOrderedWorkers(lambda update: bot.process_new_updates([update]), workers)
+    recent = RecentIds()
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            if self.path != path:
+                return self._reply(404)
+            if secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+                return self._reply(403)
+
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                update = telebot.types.Update.de_json(json.loads(body))
+            except (ValueError, TypeError, KeyError):
+                return self._reply(400)
+
+            if not recent.add(update.update_id):
+                return self._reply(200)  # повторная доставка, уже в работе
+
+            chat_id = update_chat_id(update)
+            key = chat_id if chat_id is not None else update.update_id
+            if pool.submit(key, update):
+                return self._reply(200)
+            recent.discard(update.update_id)
+            self._reply(503)
+
+        def do_GET(self):
+            # Проверка живости для балансировщика
+            self._reply(200, f"ok, backlog {pool.backlog()}")
+
+        def _reply(self, status, text=''):
+            body = text.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    server.workers = pool
+    return server
+
+
+def run_webhook(bot, url=WEBHOOK_URL, secret=WEBHOOK_SECRET, **kwargs):
+    """Регистрирует вебхук в Telegram (если задан url) и обслуживает обновления до остановки"""
+    server = create_webhook_server(bot, secret=secret, **kwargs)
+    if url:
+        bot.remove_webhook()
+        bot.set_webhook(url=url, secret_token=secret, max_connections=WEBHOOK_WORKERS * 5)
+
+    # SIGTERM (например, от supervisor.py) останавливает сервер так же, как Ctrl+C
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+
+    host, port = server.server_address[:2]
+    print(f"🌐 Вебхук слушает {host}:{port}{kwargs.get('path', WEBHOOK_PATH)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.workers.stop()